@@ -0,0 +1,221 @@
+"""Sales analytics and demand forecasts, computed for the whole catalogue at once.
+
+``history()`` reads units and revenue per medicine per day in one grouped
+query -- the nightly per-medicine rollup when it reaches yesterday, the
+sales table otherwise, as reorder.py does -- with the day already turned
+into a column number by the database. The rows go into NumPy in one
+conversion and are scattered into medicines × days matrices. Everything
+after that is array arithmetic over every medicine together; nothing
+loops per medicine:
+
+* moving averages are differences of a running sum along the day axis;
+* weekly seasonality is a medicine's mean units per weekday over its mean
+  per day (1.0 is an ordinary day), pulled towards 1.0 while it has only
+  a few days of sales;
+* the forecast is simple exponential smoothing of the series with the
+  weekday pattern taken out (one step per day, all medicines per step),
+  put back for each day ahead. Revenue is forecast units at each
+  medicine's average selling price over the history.
+
+Only closed days are read, so a forecast holds for the day: ``outlook()``
+caches it per date (and per branch, like every cache entry). The names
+and stock on hand of the medicines listed are read fresh on every call.
+
+NumPy is imported on first use, like the PDF renderer, so CLI commands and
+workers that never draw a report do not pay for it.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, literal, select
+from sqlalchemy.orm import load_only
+
+from models import db, Medicine, MedicineDailySales, Sale
+import branches
+import cache
+import stats as dashboard_stats
+
+HISTORY_DAYS = 91
+HORIZON_DAYS = 7
+ALPHA = 0.3  # smoothing weight of the newest day
+SEASONALITY_SHRINK_DAYS = 14  # days with sales at which a weekday pattern counts half
+TOP_MEDICINES = 15
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+History = namedtuple('History', 'start medicine_ids units revenue')
+Forecast = namedtuple('Forecast', 'medicine_ids days units revenue ma7 ma28 weekday_factors')
+ForecastRow = namedtuple('ForecastRow', 'medicine_id name quantity ma7 ma28 trend_pct busiest_day '
+                                        'units revenue days_of_stock')
+
+
+def numpy():
+    """``numpy``, imported on first use (see the module docstring)."""
+    import numpy
+    return numpy
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _day_number(value):
+    # Whole days on some fixed scale; only differences are used
+    if _dialect() == 'sqlite':
+        return func.julianday(value)
+    return func.extract('epoch', value) / 86400
+
+
+# ==================== HISTORY ====================
+
+def history(today=None, days=HISTORY_DAYS):
+    """Units and revenue per medicine for the ``days`` closed days before ``today``.
+
+    ``units`` and ``revenue`` are ``len(medicine_ids) × days`` float
+    matrices, oldest day first, with a row for every medicine that sold in
+    the range. Today is left out, as the day is not over.
+    """
+    np = numpy()
+    today = today or date.today()
+    start = today - timedelta(days=days)
+    rolled = dashboard_stats.rolled_through(db.session.connection())
+    if rolled is not None and rolled >= today - timedelta(days=1):
+        day = MedicineDailySales.day
+        query = (select(MedicineDailySales.medicine_id, _day_number(day) - _day_number(literal(start)),
+                        MedicineDailySales.units, MedicineDailySales.revenue)
+                 .where(day >= start, day < today))
+        if branches.current() is not None:
+            # The rollup is not branch-owned; the scoped medicine ids narrow it
+            query = query.where(MedicineDailySales.medicine_id.in_(select(Medicine.id)))
+    else:
+        day = func.date(Sale.sale_date)
+        query = (select(Sale.medicine_id, _day_number(day) - _day_number(literal(start)),
+                        func.sum(Sale.quantity), func.sum(Sale.total_amount))
+                 .where(Sale.sale_date >= datetime.combine(start, datetime.min.time()),
+                        Sale.sale_date < datetime.combine(today, datetime.min.time()),
+                        Sale.medicine_id.isnot(None))
+                 .group_by(Sale.medicine_id, day))
+
+    rows = np.array(db.session.execute(query).all(), dtype=float).reshape(-1, 4)
+    medicine_ids, row = np.unique(rows[:, 0].astype(np.int64), return_inverse=True)
+    column = np.rint(rows[:, 1]).astype(np.int64)
+    units = np.zeros((len(medicine_ids), days))
+    revenue = np.zeros((len(medicine_ids), days))
+    # One row per medicine and day, so plain assignment places every value
+    units[row, column] = rows[:, 2]
+    revenue[row, column] = rows[:, 3]
+    return History(start, medicine_ids, units, revenue)
+
+
+# ==================== SERIES ====================
+
+def moving_average(series, window):
+    """Trailing ``window``-day mean of every row at every day (over fewer days at the start)."""
+    np = numpy()
+    totals = np.cumsum(series, axis=1)
+    totals[:, window:] = totals[:, window:] - totals[:, :-window]
+    return totals / np.minimum(np.arange(1, series.shape[1] + 1), window)
+
+
+def weekdays(start, days):
+    """Weekday (Monday 0) of each of ``days`` days from ``start``."""
+    np = numpy()
+    return (start.weekday() + np.arange(days)) % 7
+
+
+def weekday_factors(series, start, shrink=SEASONALITY_SHRINK_DAYS):
+    """``rows × 7`` factors, Monday first: a row's mean per weekday over its mean per day.
+
+    A row with ``n`` days of sales keeps ``n / (n + shrink)`` of its pattern;
+    the rest is 1.0, so a medicine that sold twice does not get a weekly
+    rhythm from it.
+    """
+    np = numpy()
+    weekday = weekdays(start, series.shape[1])
+    per_weekday = np.stack([series[:, weekday == d].mean(axis=1) if (weekday == d).any()
+                            else np.zeros(len(series)) for d in range(7)], axis=1)
+    mean = series.mean(axis=1, keepdims=True)
+    factors = np.divide(per_weekday, mean, out=np.ones_like(per_weekday), where=mean > 0)
+    active = (series > 0).sum(axis=1, keepdims=True)
+    weight = active / (active + shrink)
+    return 1 + weight * (factors - 1)
+
+
+def smooth(series, alpha=ALPHA):
+    """Final level of simple exponential smoothing of every row.
+
+    Starts from each row's first-week mean, then for each day
+    ``level += alpha * (value - level)`` for all rows at once. NaN values
+    leave the level as it is.
+    """
+    np = numpy()
+    level = np.nanmean(series[:, :7], axis=1)
+    for day in range(series.shape[1]):
+        level += alpha * np.nan_to_num(series[:, day] - level)
+    return level
+
+
+# ==================== FORECAST ====================
+
+def forecast(today=None, days=HISTORY_DAYS, horizon=HORIZON_DAYS, alpha=ALPHA):
+    """``Forecast`` of units and revenue per medicine for the ``horizon`` days from ``today``.
+
+    ``units`` and ``revenue`` are ``medicines × horizon`` matrices; ``ma7``
+    and ``ma28`` the moving averages of units per day at yesterday.
+    """
+    np = numpy()
+    today = today or date.today()
+    past = history(today, days)
+    # The full pattern comes out of the history; the forecast puts back the
+    # damped one. A weekday that never sells says nothing about the level.
+    seasonal = weekday_factors(past.units, past.start, shrink=0)[:, weekdays(past.start, days)]
+    flat = np.divide(past.units, seasonal, out=np.full_like(past.units, np.nan), where=seasonal > 0)
+    level = smooth(flat, alpha)
+    factors = weekday_factors(past.units, past.start)
+    units = level[:, None] * factors[:, weekdays(today, horizon)]
+    sold = past.units.sum(axis=1)
+    price = np.divide(past.revenue.sum(axis=1), sold, out=np.zeros_like(sold), where=sold > 0)
+    return Forecast(past.medicine_ids,
+                    [today + timedelta(days=n) for n in range(horizon)],
+                    units,
+                    units * price[:, None],
+                    moving_average(past.units, 7)[:, -1],
+                    moving_average(past.units, 28)[:, -1],
+                    factors)
+
+
+def _outlook(today, limit):
+    result = forecast(today)
+    days = [(day, float(units), float(revenue))
+            for day, units, revenue in zip(result.days, result.units.sum(axis=0), result.revenue.sum(axis=0))]
+    ahead = result.units.sum(axis=1)
+    top = numpy().argsort(-ahead, kind='stable')[:limit]
+    medicines = [(int(result.medicine_ids[i]), float(ahead[i]), float(result.revenue[i].sum()),
+                  float(result.ma7[i]), float(result.ma28[i]), int(result.weekday_factors[i].argmax()))
+                 for i in top if ahead[i] > 0]
+    return days, medicines
+
+
+def outlook(today=None, limit=TOP_MEDICINES):
+    """``(days, rows)`` for the reports page, cached for the day.
+
+    ``days`` is ``[(day, units, revenue), ...]`` over the horizon for the
+    whole catalogue; ``rows`` the ``limit`` medicines with the most units
+    forecast, as ``ForecastRow``s.
+    """
+    today = today or date.today()
+    days, top = cache.remember('forecast', ('medicine_daily_sales',), (today, limit),
+                               lambda: _outlook(today, limit))
+    if not top:
+        return days, []
+    medicines = {m.id: m for m in Medicine.query.options(load_only(Medicine.name, Medicine.quantity))
+                 .filter(Medicine.id.in_([medicine_id for medicine_id, *_ in top]))}
+    rows = []
+    for medicine_id, units, revenue, ma7, ma28, busiest in top:
+        medicine = medicines.get(medicine_id)
+        if medicine is None:
+            continue
+        per_day = units / len(days)
+        rows.append(ForecastRow(medicine_id, medicine.name, medicine.quantity, ma7, ma28,
+                                (ma7 / ma28 - 1) * 100 if ma28 else None, WEEKDAYS[busiest],
+                                units, revenue, medicine.quantity / per_day if per_day else None))
+    return days, rows
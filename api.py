@@ -0,0 +1,301 @@
+"""Versioned JSON API (``/api/v1``) for POS terminals and scanners.
+
+``GET /api/v1/<resource>`` lists medicines, suppliers, sales or
+purchase-orders a page at a time with the same keyset cursors as the HTML
+pages (``next_cursor`` goes back in as ``?after=``). The query string takes:
+
+* ``fields=name,quantity`` -- only those columns are SELECTed (plus the
+  sort columns the cursor needs) and returned;
+* ``ids=3,9,14`` -- fetch exactly those records in one ``IN`` query,
+  in the order asked, with the ids that do not exist listed as ``missing``;
+* ``limit`` and the resource's filters; medicines take the inventory
+  page's ``search``, ``category``, ``stock`` and ``sort``.
+
+``/api/v1/sync/changes`` and ``/api/v1/sync/sales`` are the offline POS
+protocol: a changefeed of medicines after a version watermark and an
+idempotent batch push of queued sales (sync.py).
+
+Responses are encoded with orjson when it is installed and compressed with
+gzip, or brotli when the ``brotli`` package is installed, if the client
+accepts it.
+"""
+import gzip
+import json
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from flask import Blueprint, current_app, request, session
+
+try:
+    import orjson
+except ImportError:  # optional: the standard library encoder is used instead
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional: gzip only
+    brotli = None
+
+from listing import SortKey, paginate_keyset
+from models import db, Medicine, PurchaseOrder, Sale, Supplier
+import dbconfig
+import filters
+import stock
+import sync
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+Resource = namedtuple('Resource', 'model fields sorts default_sort conditions')
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400, **extra):
+        super().__init__(message)
+        self.status = status
+        self.extra = extra
+
+
+# ==================== ENCODING ====================
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def json_response(payload, status=200):
+    if orjson is not None:
+        body = orjson.dumps(payload, default=_default)
+    else:
+        body = json.dumps(payload, separators=(',', ':'), default=_default).encode()
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+
+@api.after_request
+def compress(response):
+    response.vary.add('Accept-Encoding')
+    if (response.direct_passthrough or 'Content-Encoding' in response.headers
+            or response.content_length is None
+            or response.content_length < current_app.config['API_COMPRESS_MIN_SIZE']):
+        return response
+    encodings = request.accept_encodings
+    if brotli is not None and encodings['br']:
+        response.set_data(brotli.compress(response.get_data(), quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif encodings['gzip']:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return json_response(dict(error=str(error), **error.extra), error.status)
+
+
+@api.before_request
+def require_login():
+    # API clients get a 401 instead of the login page redirect
+    if 'user_id' not in session:
+        raise ApiError('Login required.', 401)
+
+
+# ==================== FILTERS ====================
+
+def _date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ApiError(f'{name} must be YYYY-MM-DD.')
+
+
+def _int_arg(name):
+    value = request.args.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiError(f'{name} must be an integer.')
+
+
+def _medicine_conditions(args):
+    return filters.medicine_conditions(args.get('search', ''), args.get('category', ''),
+                                       args.get('stock', ''))
+
+
+def _supplier_conditions(args):
+    search = args.get('search')
+    return [Supplier.name.icontains(search)] if search else []
+
+
+def _sale_conditions(args):
+    conditions = []
+    medicine_id, order_id = _int_arg('medicine_id'), _int_arg('order_id')
+    start, end = _date_arg('start_date'), _date_arg('end_date')
+    if medicine_id is not None:
+        conditions.append(Sale.medicine_id == medicine_id)
+    if order_id is not None:
+        conditions.append(Sale.order_id == order_id)
+    if start:
+        conditions.append(Sale.sale_date >= start)
+    if end:
+        conditions.append(Sale.sale_date < end + timedelta(days=1))
+    return conditions
+
+
+def _purchase_order_conditions(args):
+    conditions = []
+    status = args.get('status')
+    supplier_id, medicine_id = _int_arg('supplier_id'), _int_arg('medicine_id')
+    if status and status != 'all':
+        conditions.append(PurchaseOrder.status == status)
+    if supplier_id is not None:
+        conditions.append(PurchaseOrder.supplier_id == supplier_id)
+    if medicine_id is not None:
+        conditions.append(PurchaseOrder.medicine_id == medicine_id)
+    return conditions
+
+
+def _columns(model):
+    return {column.key: getattr(model, column.key) for column in model.__mapper__.column_attrs}
+
+
+NEWEST_SALES = [SortKey(Sale.sale_date, descending=True), SortKey(Sale.id, descending=True)]
+NEWEST_ORDERS = [SortKey(PurchaseOrder.order_date, descending=True),
+                 SortKey(PurchaseOrder.id, descending=True)]
+
+RESOURCES = {
+    'medicines': Resource(Medicine, _columns(Medicine), filters.MEDICINE_SORTS, 'name',
+                          _medicine_conditions),
+    'suppliers': Resource(Supplier, _columns(Supplier),
+                          {'name': [SortKey(Supplier.name), SortKey(Supplier.id)]}, 'name',
+                          _supplier_conditions),
+    'sales': Resource(Sale, _columns(Sale), {'newest': NEWEST_SALES}, 'newest', _sale_conditions),
+    'purchase-orders': Resource(PurchaseOrder, _columns(PurchaseOrder), {'newest': NEWEST_ORDERS},
+                                'newest', _purchase_order_conditions),
+}
+
+
+# ==================== QUERIES ====================
+
+def _requested_fields(resource):
+    fields = request.args.get('fields')
+    if not fields:
+        return list(resource.fields)
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in resource.fields]
+    if unknown:
+        raise ApiError(f'Unknown fields: {", ".join(unknown)}.', available=list(resource.fields))
+    return names
+
+
+def _limit():
+    limit = _int_arg('limit') or current_app.config['LIST_PER_PAGE']
+    return max(1, min(limit, current_app.config['API_MAX_LIMIT']))
+
+
+def _ids():
+    try:
+        ids = [int(i) for i in request.args['ids'].split(',') if i.strip()]
+    except ValueError:
+        raise ApiError('ids must be a comma-separated list of integers.')
+    if len(ids) > current_app.config['API_MAX_LIMIT']:
+        raise ApiError(f'At most {current_app.config["API_MAX_LIMIT"]} ids per request.')
+    return ids
+
+
+def _by_ids(resource, names, ids):
+    """Records for ``ids`` in one query, in the order asked; ``(data, missing)``."""
+    columns = [resource.fields[name] for name in dict.fromkeys(names + ['id'])]
+    rows = db.session.query(*columns).filter(resource.model.id.in_(ids)).all() if ids else []
+    found = {row.id: row for row in rows}
+    data = [{name: getattr(found[i], name) for name in names} for i in dict.fromkeys(ids) if i in found]
+    return data, [i for i in dict.fromkeys(ids) if i not in found]
+
+
+def _page(resource, names):
+    sort = request.args.get('sort', resource.default_sort)
+    if resource.model is Medicine:
+        sort, keys = filters.medicine_sort(request.args)
+    elif sort in resource.sorts:
+        keys = resource.sorts[sort]
+    else:
+        raise ApiError(f'Unknown sort: {sort}.', available=list(resource.sorts))
+    # The cursor is built from the sort columns, so they are selected too
+    sort_names = [k.expr.key for k in keys if getattr(k.expr, 'key', None) in resource.fields]
+    columns = [resource.fields[name] for name in dict.fromkeys(names + sort_names)]
+    query = db.session.query(*columns).filter(*resource.conditions(request.args))
+    page = paginate_keyset(query, keys,
+                           after=request.args.get('after'),
+                           before=request.args.get('before'),
+                           per_page=_limit())
+    return dict(data=[{name: getattr(row, name) for name in names} for row in page],
+                next_cursor=page.next_cursor,
+                prev_cursor=page.prev_cursor)
+
+
+# ==================== ROUTES ====================
+
+def _resource(name):
+    try:
+        return RESOURCES[name]
+    except KeyError:
+        raise ApiError(f'Unknown resource: {name}.', 404, available=list(RESOURCES))
+
+
+@api.route('/<resource_name>')
+@dbconfig.replica_reads
+def list_records(resource_name):
+    resource = _resource(resource_name)
+    names = _requested_fields(resource)
+    if 'ids' in request.args:
+        data, missing = _by_ids(resource, names, _ids())
+        return json_response(dict(data=data, missing=missing))
+    return json_response(_page(resource, names))
+
+
+@api.route('/<resource_name>/<int:record_id>')
+@dbconfig.replica_reads
+def get_record(resource_name, record_id):
+    resource = _resource(resource_name)
+    data, missing = _by_ids(resource, _requested_fields(resource), [record_id])
+    if missing:
+        raise ApiError(f'{resource_name} {record_id} not found.', 404)
+    return json_response(data[0])
+
+
+# ==================== SYNC ====================
+
+@api.route('/sync/changes')
+@dbconfig.replica_reads
+def sync_changes():
+    # ?since=<version>&after=<id>, as returned by the previous page
+    page_size = current_app.config['SYNC_PAGE_SIZE']
+    limit = max(1, min(_int_arg('limit') or page_size, page_size))
+    try:
+        return json_response(sync.changes(_int_arg('since') or 0, _int_arg('after'), limit))
+    except sync.ResyncRequired as e:
+        raise ApiError(str(e), 410, resync=True)
+
+
+@api.route('/sync/sales', methods=['POST'])
+def sync_sales():
+    # {"sales": [{"client_id": "...", "created_at": "...", "lines": [...]}, ...]}
+    data = request.get_json(silent=True) or {}
+    sales = data.get('sales') if isinstance(data, dict) else None
+    if not isinstance(sales, list) or not sales:
+        raise ApiError('Expected {"sales": [{"client_id": ..., "lines": [...]}, ...]}.')
+    if len(sales) > current_app.config['SYNC_PUSH_MAX']:
+        raise ApiError(f'At most {current_app.config["SYNC_PUSH_MAX"]} sales per push.', 413)
+    parsed = []
+    for n, sale in enumerate(sales):
+        try:
+            parsed.append(sync.parse_sale(sale))
+        except ValueError as e:
+            raise ApiError(f'sales[{n}]: {e}')
+    # One transaction for the batch; a resent batch only adds what is new
+    return json_response(dict(results=stock.with_retry(lambda: sync.push(parsed))))
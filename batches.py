@@ -0,0 +1,187 @@
+"""Batch-level stock, picked first-expiry-first-out.
+
+Each delivery goes into its own ``StockBatch`` with its batch number and
+expiry date, and sales take from the batch that expires first. The
+medicine row keeps the materialized totals the inventory and dashboard
+queries read: ``quantity`` is the sum of its batches and ``expiry_date``
+the earliest expiry among batches still in stock.
+
+Sales and deliveries change both in the same transaction (see stock.py).
+Forms and imports that set a medicine's quantity directly are treated as
+stock adjustments by ``reconcile()``: extra units go into a batch labelled
+with the medicine's batch number and expiry, missing units are written off
+first-expiry-first.
+
+Every function takes a connection and works in the caller's transaction.
+"""
+from datetime import datetime
+
+from sqlalchemy import func, insert, select, update
+
+from models import Medicine, StockBatch
+import stats as dashboard_stats
+
+batch_table = StockBatch.__table__
+medicine_table = Medicine.__table__
+
+# Same column order as ix_stock_batch_fefo: dated batches first, earliest first
+FEFO_ORDER = (batch_table.c.expiry_date.is_(None), batch_table.c.expiry_date, batch_table.c.id)
+IN_STOCK = batch_table.c.quantity > 0
+
+_SNAPSHOT = (medicine_table.c.quantity, medicine_table.c.reorder_level,
+             medicine_table.c.expiry_date, medicine_table.c.category)
+
+
+def in_stock(conn, medicine_ids):
+    """In-stock batches of the medicines, in picking order per medicine."""
+    return conn.execute(
+        select(batch_table)
+        .where(batch_table.c.medicine_id.in_(list(medicine_ids)), IN_STOCK)
+        .order_by(batch_table.c.medicine_id, *FEFO_ORDER)
+    ).all()
+
+
+# ==================== MOVEMENTS ====================
+
+def add(conn, medicine_id, quantity, batch_number=None, expiry_date=None,
+        unit_cost=None, purchase_order_id=None):
+    """Put received units into a batch; returns its id.
+
+    Tops up an in-stock batch with the same number and expiry (a second
+    delivery of the same lot) instead of adding a row. Medicine totals are
+    the caller's job.
+    """
+    batch_number = batch_number or None
+    if purchase_order_id is None:
+        same = conn.execute(
+            select(batch_table.c.id).where(
+                batch_table.c.medicine_id == medicine_id, IN_STOCK,
+                batch_table.c.batch_number.is_not_distinct_from(batch_number),
+                batch_table.c.expiry_date.is_not_distinct_from(expiry_date),
+            ).limit(1)
+        ).scalar()
+        if same is not None:
+            conn.execute(update(batch_table).where(batch_table.c.id == same).values(
+                quantity=batch_table.c.quantity + quantity,
+                received_quantity=batch_table.c.received_quantity + quantity,
+            ))
+            return same
+    return conn.execute(insert(batch_table).values(
+        medicine_id=medicine_id,
+        purchase_order_id=purchase_order_id,
+        batch_number=batch_number,
+        expiry_date=expiry_date,
+        quantity=quantity,
+        received_quantity=quantity,
+        unit_cost=unit_cost,
+        received_at=datetime.utcnow(),
+    )).inserted_primary_key[0]
+
+
+def consume(conn, quantities):
+    """Take ``{medicine_id: quantity}`` out of batches, earliest expiry first.
+
+    The caller has already taken the units off the medicine totals with a
+    conditional update, which also serializes concurrent sellers of the same
+    medicine. Returns the ids of medicines whose first batch ran out (their
+    earliest expiry may have moved).
+    """
+    remaining = dict(quantities)
+    emptied = set()
+    for batch in in_stock(conn, quantities):
+        need = remaining.get(batch.medicine_id, 0)
+        if need <= 0:
+            continue
+        taken = min(batch.quantity, need)
+        conn.execute(update(batch_table).where(batch_table.c.id == batch.id)
+                     .values(quantity=batch_table.c.quantity - taken))
+        remaining[batch.medicine_id] = need - taken
+        if taken == batch.quantity:
+            emptied.add(batch.medicine_id)
+    return emptied
+
+
+def refresh_expiry(conn, medicine_ids):
+    """Set each medicine's expiry to its earliest in-stock batch.
+
+    Medicines with nothing in stock keep the date they have.
+    """
+    medicine_ids = list(medicine_ids)
+    if not medicine_ids:
+        return
+    # MIN skips NULLs: undated batches only count when nothing in stock has a date
+    wanted = dict(conn.execute(
+        select(batch_table.c.medicine_id, func.min(batch_table.c.expiry_date))
+        .where(batch_table.c.medicine_id.in_(medicine_ids), IN_STOCK)
+        .group_by(batch_table.c.medicine_id)
+    ).all())
+    current = conn.execute(
+        select(medicine_table.c.id, *_SNAPSHOT).where(medicine_table.c.id.in_(list(wanted)))
+    ).all()
+    changes = []
+    for row in current:
+        expiry = wanted[row.id]
+        if expiry != row.expiry_date:
+            conn.execute(update(medicine_table).where(medicine_table.c.id == row.id)
+                         .values(expiry_date=expiry))
+            before = tuple(row[1:])
+            changes.append((before, before[:2] + (expiry,) + before[3:]))
+    if changes:
+        dashboard_stats.apply_changes(conn, changes)
+
+
+# ==================== ADJUSTMENTS ====================
+
+def reconcile(conn, medicine_ids):
+    """Make batches add up to the medicines' quantities, then refresh expiry."""
+    medicine_ids = list(medicine_ids)
+    if not medicine_ids:
+        return
+    held = dict(conn.execute(
+        select(batch_table.c.medicine_id, func.sum(batch_table.c.quantity))
+        .where(batch_table.c.medicine_id.in_(medicine_ids), IN_STOCK)
+        .group_by(batch_table.c.medicine_id)
+    ).all())
+    medicines = conn.execute(
+        select(medicine_table.c.id, medicine_table.c.quantity,
+               medicine_table.c.batch_number, medicine_table.c.expiry_date)
+        .where(medicine_table.c.id.in_(medicine_ids))
+    ).all()
+    write_off = {}
+    for medicine in medicines:
+        difference = (medicine.quantity or 0) - held.get(medicine.id, 0)
+        if difference > 0:
+            add(conn, medicine.id, difference, medicine.batch_number, medicine.expiry_date)
+        elif difference < 0:
+            write_off[medicine.id] = -difference
+    if write_off:
+        consume(conn, write_off)
+    refresh_expiry(conn, medicine_ids)
+
+
+def relabel(conn, medicine_id, batch_number, expiry_date):
+    """Correct the number and expiry of a medicine's only batch.
+
+    Editing a medicine that holds a single batch fixes that batch, as it did
+    before batches existed. Returns False when there is not exactly one.
+    """
+    ids = conn.execute(select(batch_table.c.id)
+                       .where(batch_table.c.medicine_id == medicine_id, IN_STOCK)
+                       .limit(2)).scalars().all()
+    if len(ids) != 1:
+        return False
+    conn.execute(update(batch_table).where(batch_table.c.id == ids[0])
+                 .values(batch_number=batch_number or None, expiry_date=expiry_date))
+    return True
+
+
+def backfill(conn):
+    """Give every medicine with stock but no batches one batch holding all of it."""
+    has_batches = select(batch_table.c.id).where(batch_table.c.medicine_id == medicine_table.c.id).exists()
+    conn.execute(insert(batch_table).from_select(
+        ['medicine_id', 'batch_number', 'expiry_date', 'quantity', 'received_quantity', 'received_at'],
+        select(medicine_table.c.id, medicine_table.c.batch_number, medicine_table.c.expiry_date,
+               medicine_table.c.quantity, medicine_table.c.quantity,
+               func.coalesce(medicine_table.c.updated_at, medicine_table.c.created_at))
+        .where(medicine_table.c.quantity > 0, ~has_batches)
+    ))
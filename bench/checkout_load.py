@@ -0,0 +1,101 @@
+"""Parallel checkout load test.
+
+Starts N worker processes (like gunicorn workers), each posting sales of one
+medicine through /sales/new as fast as it can, against a fresh SQLite file.
+There is less stock than attempted sales, so the workers race for the last
+units. Passes when nothing is oversold, the stock left matches the sales
+recorded, and no request failed with a lock error.
+
+    python bench/checkout_load.py --workers 8 --sales 50 --stock 200
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _worker(args):
+    medicine_id, sales, start_at = args
+    from app import app
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 0
+        sess['username'] = 'loadtest'
+    counts = {'sold': 0, 'out_of_stock': 0, 'errors': []}
+    while time.time() < start_at:
+        time.sleep(0.001)
+    for _ in range(sales):
+        client.post('/sales/new', data={'medicine_id': medicine_id, 'quantity': 1})
+        with client.session_transaction() as sess:
+            flashes = sess.pop('_flashes', [])
+        for category, message in flashes:
+            if category == 'success':
+                counts['sold'] += 1
+            elif message.startswith('Insufficient stock'):
+                counts['out_of_stock'] += 1
+            else:
+                counts['errors'].append(message)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--sales', type=int, default=50, help='sales attempted per worker')
+    parser.add_argument('--stock', type=int, default=200, help='units in stock at the start')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pharmasync-load-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'load.db')
+    os.environ['SCHEDULER_IN_PROCESS'] = '0'  # no background jobs during the measurement
+    from app import app, db, init_db
+    from models import Medicine, Sale
+
+    init_db()
+    with app.app_context():
+        medicine = Medicine(name='Load Test Tablet', price=2.5, quantity=args.stock, reorder_level=0)
+        db.session.add(medicine)
+        db.session.commit()
+        medicine_id = medicine.id
+        db.engine.dispose()  # don't hand pooled connections to the forked workers
+
+    start_at = time.time() + 1
+    with multiprocessing.Pool(args.workers) as pool:
+        results = pool.map(_worker, [(medicine_id, args.sales, start_at)] * args.workers)
+    elapsed = time.time() - start_at
+
+    with app.app_context():
+        left = db.session.get(Medicine, medicine_id).quantity
+        sold_rows = db.session.query(db.func.coalesce(db.func.sum(Sale.quantity), 0)).scalar()
+
+    sold = sum(r['sold'] for r in results)
+    errors = [e for r in results for e in r['errors']]
+    report = dict(workers=args.workers,
+                  attempts=args.workers * args.sales,
+                  stock=args.stock,
+                  sold=sold,
+                  out_of_stock=sum(r['out_of_stock'] for r in results),
+                  errors=len(errors),
+                  lock_errors=sum('locked' in e for e in errors),
+                  stock_left=left,
+                  units_in_sales=sold_rows,
+                  oversold=max(sold_rows - args.stock, 0),
+                  seconds=round(elapsed, 2),
+                  sales_per_second=round((args.workers * args.sales) / elapsed, 1))
+    print(json.dumps(report, indent=2))
+    for message in sorted(set(errors))[:10]:
+        print('error:', message, file=sys.stderr)
+
+    consistent = left == args.stock - sold_rows and sold == sold_rows
+    sys.exit(0 if consistent and not report['oversold'] and not errors and left >= 0 else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Stock-as-of benchmark for the stock ledger.
+
+Builds a fresh SQLite ledger: ``--medicines`` medicines with opening stock,
+``--movements`` movements spread over ``--days`` days, and a checkpoint
+every ``--every`` days taken the way the nightly job takes them. Then asks
+for the stock on ``--queries`` random moments twice: with ``ledger.as_of``
+(nearest checkpoint plus the movements in between) and by replaying every
+movement since the opening checkpoint. The two must agree. Reports
+checkpoint cost and latency percentiles for both, as JSON.
+
+    python bench/ledger_as_of.py --movements 1000000 --days 365 --every 7
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHUNK = 10000
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _ms(values):
+    return dict(p50_ms=round(_percentile(values, 0.50) * 1000, 2),
+                p95_ms=round(_percentile(values, 0.95) * 1000, 2),
+                max_ms=round(max(values) * 1000, 2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--medicines', type=int, default=5000)
+    parser.add_argument('--movements', type=int, default=500000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--every', type=int, default=7, help='days between checkpoints')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pharmasync-ledger-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'ledger.db')
+    os.environ.setdefault('SCHEDULER_IN_PROCESS', '0')
+    from app import app
+    from models import db
+    import ledger
+
+    rng = random.Random(args.seed)
+    start = datetime.utcnow().replace(microsecond=0) - timedelta(days=args.days)
+    app.config['SLOW_QUERY_MS'] = float('inf')
+    with app.app_context():
+        db.create_all()
+        with db.engine.begin() as conn:
+            ledger.protect(conn)
+            conn.execute(ledger.medicine_table.insert(), [
+                dict(name=f'Medicine {i}', price=1.0, quantity=rng.randint(0, 500))
+                for i in range(args.medicines)])
+            opening = ledger.open_ledger(conn, start)
+            balances = dict(conn.execute(ledger.snapshot_table.select()
+                                         .with_only_columns(ledger.snapshot_table.c.medicine_id,
+                                                            ledger.snapshot_table.c.quantity)
+                                         .where(ledger.snapshot_table.c.checkpoint_id == opening)).all())
+
+        # Movements in time order, a checkpoint whenever --every days have passed
+        step = timedelta(days=args.days) / args.movements
+        ids = list(range(1, args.medicines + 1))
+        next_checkpoint = start + timedelta(days=args.every)
+        checkpoint_s, rows, written = [], [], 0
+        for n in range(args.movements):
+            stamp = start + step * (n + 1)
+            if stamp >= next_checkpoint:
+                with db.engine.begin() as conn:
+                    if rows:
+                        conn.execute(ledger.movement_table.insert(), rows)
+                        written, rows = written + len(rows), []
+                    started = time.perf_counter()
+                    ledger.checkpoint(conn, next_checkpoint)
+                    checkpoint_s.append(time.perf_counter() - started)
+                next_checkpoint += timedelta(days=args.every)
+            medicine_id = rng.choice(ids)
+            held = balances.get(medicine_id, 0)
+            delta = rng.randint(20, 200) if held < 20 else -rng.randint(1, min(held, 10))
+            balances[medicine_id] = held + delta
+            rows.append(dict(medicine_id=medicine_id, delta=delta, balance=held + delta,
+                             reason=ledger.RECEIPT if delta > 0 else ledger.SALE, created_at=stamp))
+            if len(rows) >= CHUNK or n == args.movements - 1:
+                with db.engine.begin() as conn:
+                    conn.execute(ledger.movement_table.insert(), rows)
+                written, rows = written + len(rows), []
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('ANALYZE')
+
+        nearest, replay = [], []
+        with db.engine.connect() as conn:
+            for _ in range(args.queries):
+                when = start + timedelta(seconds=rng.uniform(0, args.days * 86400))
+                started = time.perf_counter()
+                fast = ledger.as_of(conn, when)
+                nearest.append(time.perf_counter() - started)
+                started = time.perf_counter()
+                full = {row.medicine_id: row.quantity for row in conn.execute(ledger._totals(
+                    ledger._snapshot(opening), ledger._movements(start, when))) if row.quantity}
+                replay.append(time.perf_counter() - started)
+                if fast != full:
+                    raise SystemExit(f'as_of({when}) disagrees with the replay')
+
+    print(json.dumps(dict(medicines=args.medicines,
+                          movements=written,
+                          days=args.days,
+                          checkpoint_every_days=args.every,
+                          checkpoints=len(checkpoint_s),
+                          checkpoint_ms=_ms(checkpoint_s) if checkpoint_s else None,
+                          as_of_nearest_checkpoint=_ms(nearest),
+                          as_of_full_replay=_ms(replay)),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""Fan-out benchmark for the live stock feed.
+
+Opens ``--subscribers`` idle streams on the in-process broker (each one the
+``events.stream`` generator a ``/live/stock`` request runs, in its own
+thread, as under gthread or gevent workers), then publishes ``--events``
+stock events and measures how long each takes to reach every stream.
+Reports delivery latency percentiles, CPU time and the memory each idle
+stream adds, as JSON.
+
+    python bench/live_fanout.py --subscribers 2000 --events 50
+"""
+import argparse
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _rss_kb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.02, help='seconds between events')
+    parser.add_argument('--heartbeat', type=float, default=15)
+    args = parser.parse_args()
+
+    import events
+
+    threading.stack_size(256 * 1024)
+    broker = events.LocalBroker(1000)
+    latencies = []
+    lock = threading.Lock()
+    ready = threading.Barrier(args.subscribers + 1)
+
+    def subscriber():
+        stream = events.stream(broker, broker.last_id(), args.heartbeat, lifetime=3600)
+        next(stream)  # the retry line
+        ready.wait()
+        seen = 0
+        for message in stream:
+            if not message.startswith('id:'):
+                continue
+            payload = json.loads(message.rsplit('data: ', 1)[1])
+            with lock:
+                latencies.append(time.perf_counter() - payload['sent'])
+            seen += 1
+            if seen == args.events:
+                return
+
+    rss_before = _rss_kb()
+    threads = [threading.Thread(target=subscriber, daemon=True) for _ in range(args.subscribers)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    time.sleep(0.5)
+    rss_idle = _rss_kb()
+
+    cpu = time.process_time()
+    for i in range(args.events):
+        broker.publish(json.dumps(dict(medicine_id=i, quantity=i, delta=-1, reorder_level=10,
+                                       sent=time.perf_counter())))
+        time.sleep(args.interval)
+    for thread in threads:
+        thread.join(timeout=60)
+    cpu = time.process_time() - cpu
+
+    expected = args.subscribers * args.events
+    print(json.dumps(dict(subscribers=args.subscribers,
+                          events=args.events,
+                          delivered=len(latencies),
+                          missing=expected - len(latencies),
+                          p50_ms=round(_percentile(latencies, 0.50) * 1000, 2),
+                          p95_ms=round(_percentile(latencies, 0.95) * 1000, 2),
+                          p99_ms=round(_percentile(latencies, 0.99) * 1000, 2),
+                          max_ms=round(max(latencies) * 1000, 2),
+                          cpu_ms_per_delivery=round(cpu * 1000 / max(len(latencies), 1), 4),
+                          idle_kb_per_stream=round((rss_idle - rss_before) / args.subscribers, 1)),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""Login throughput benchmark.
+
+Creates ``--users`` accounts in a fresh SQLite file, then has ``--clients``
+threads (like the threads of a gthread worker, or a shift's worth of
+terminals) log in and out ``--logins`` times each, all at once. This is
+repeated for each password pool size in ``--hash-workers``. Reports
+logins per second, latency percentiles and how many attempts were turned
+away (503: hashing queue full, 429: throttled), as JSON.
+
+``--stored-method`` sets the hash the accounts start with. With a method
+other than the app's (e.g. ``pbkdf2:sha256:1000000``), each account's first
+login pays for the old hash and a new one, and later logins only for the
+new one.
+
+    python bench/login_throughput.py --clients 32 --logins 5 --hash-workers 1,2,4,8
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'bench-password'
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _run(app, args):
+    barrier = threading.Barrier(args.clients)
+    latencies, statuses, lock = [], {}, threading.Lock()
+
+    def client(n):
+        http = app.test_client()
+        barrier.wait()
+        for i in range(args.logins):
+            email = f'user{(n * args.logins + i) % args.users}@bench.local'
+            started = time.perf_counter()
+            response = http.post('/login', data={'email': email, 'password': PASSWORD})
+            elapsed = time.perf_counter() - started
+            http.get('/logout')
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+    return dict(seconds=round(seconds, 3),
+                logins_per_second=round(statuses.get(302, 0) / seconds, 1),
+                p50_ms=round(_percentile(latencies, 0.50) * 1000, 1),
+                p95_ms=round(_percentile(latencies, 0.95) * 1000, 1),
+                p99_ms=round(_percentile(latencies, 0.99) * 1000, 1),
+                ok=statuses.get(302, 0),
+                busy=statuses.get(503, 0),
+                throttled=statuses.get(429, 0),
+                other={code: count for code, count in statuses.items() if code not in (302, 429, 503)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--clients', type=int, default=32, help='concurrent logins')
+    parser.add_argument('--logins', type=int, default=5, help='logins per client')
+    parser.add_argument('--hash-workers', default=f'1,{os.cpu_count() or 2}',
+                        help='comma-separated PASSWORD_HASH_WORKERS values to compare')
+    parser.add_argument('--queue', type=int, default=64, help='PASSWORD_HASH_QUEUE')
+    parser.add_argument('--stored-method', default=None,
+                        help='werkzeug method of the accounts\' starting hashes (default: the app\'s)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pharmasync-login-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'login.db')
+    os.environ['SCHEDULER_IN_PROCESS'] = '0'  # no background jobs during the measurement
+    from werkzeug.security import generate_password_hash
+    from app import create_app, init_db
+    from models import db, User
+
+    init_db()
+    results = []
+    for workers in [int(n) for n in args.hash_workers.split(',')]:
+        app = create_app({'PASSWORD_HASH_WORKERS': workers,
+                          'PASSWORD_HASH_QUEUE': args.queue,
+                          # Every client shares 127.0.0.1; measure hashing, not the throttle
+                          'LOGIN_IP_BURST': 10 ** 9,
+                          'LOGIN_ACCOUNT_BURST': 10 ** 9,
+                          'SERVER_TIMING': False,
+                          'SLOW_QUERY_MS': float('inf')})
+        with app.app_context():
+            # One hash for every account: building them is not what is measured
+            stored = generate_password_hash(PASSWORD, method=args.stored_method or app.config['PASSWORD_HASH_METHOD'])
+            User.query.filter(User.email.like('%@bench.local')).delete(synchronize_session=False)
+            db.session.execute(User.__table__.insert(), [
+                dict(username=f'user{n}', email=f'user{n}@bench.local', password=stored, role='staff', branch_id=1)
+                for n in range(args.users)])
+            db.session.commit()
+        result = dict(hash_workers=workers, **_run(app, args))
+        if args.stored_method:
+            result['second_pass'] = _run(app, args)
+        results.append(result)
+
+    print(json.dumps(dict(users=args.users, clients=args.clients, logins_per_client=args.logins,
+                          cpus=os.cpu_count(), stored_method=args.stored_method, runs=results),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Report export benchmark: time to first byte and memory against rows.
+
+For each size in ``--sales``, fills a fresh SQLite file with that many
+sales over the last 30 days, then downloads ``/reports/export/sales.csv``
+and ``/reports/export/report.xlsx`` through the test client, reading the
+streamed body chunk by chunk the way a WSGI server would. Reports the
+time to the first chunk, the total time, the size and the peak Python
+memory (tracemalloc) of each download, as JSON. Peak memory should stay
+about the same from the smallest size to the largest.
+
+    python bench/report_export.py --sales 10000,100000,1000000
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CHUNK = 10000
+MEDICINES = 500
+
+
+def _download(client, url):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    response = client.get(url)
+    first = None
+    size = chunks = 0
+    for chunk in response.response:
+        if first is None:
+            first = time.perf_counter() - started
+        size += len(chunk)
+        chunks += 1
+    response.close()
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return dict(status=response.status_code, first_chunk_ms=round(first * 1000, 1), seconds=round(seconds, 2),
+                chunks=chunks, megabytes=round(size / 1e6, 1), peak_memory_mb=round(peak / 1e6, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sales', default='10000,100000', help='comma-separated numbers of sales to export')
+    parser.add_argument('--batch-size', type=int, default=None, help='EXPORT_BATCH_SIZE')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pharmasync-export-')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(directory, 'export.db')
+    os.environ['SCHEDULER_IN_PROCESS'] = '0'  # no background jobs during the measurement
+    from app import create_app, init_db
+    from models import db, Medicine, Sale
+
+    init_db()
+    config = {'SERVER_TIMING': False, 'SLOW_QUERY_MS': float('inf')}
+    if args.batch_size:
+        config['EXPORT_BATCH_SIZE'] = args.batch_size
+    app = create_app(config)
+    with app.app_context():
+        db.session.execute(Medicine.__table__.insert(), [
+            dict(name=f'Medicine {n}', category='Tablet', quantity=100, price=10.0, reorder_level=10,
+                 batch_number=f'EXP{n}', branch_id=1)
+            for n in range(MEDICINES)])
+        db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 0
+        sess['username'] = 'bench'
+
+    today = date.today()
+    query = f'start_date={today - timedelta(days=30)}&end_date={today}'
+    now = datetime.now()
+    written = 0
+    results = []
+    for total in sorted(int(n) for n in args.sales.split(',')):
+        with app.app_context():
+            while written < total:
+                count = min(CHUNK, total - written)
+                db.session.execute(Sale.__table__.insert(), [
+                    dict(medicine_id=(written + i) % MEDICINES + 1, quantity=1, unit_price=10.0, total_amount=10.0,
+                         sale_date=now - timedelta(minutes=(written + i) % (30 * 24 * 60)),
+                         customer_name='Walk-in', branch_id=1)
+                    for i in range(count)])
+                db.session.commit()
+                written += count
+        results.append(dict(sales=total,
+                            csv=_download(client, f'/reports/export/sales.csv?{query}'),
+                            xlsx=_download(client, f'/reports/export/report.xlsx?{query}')))
+
+    print(json.dumps(dict(medicines=MEDICINES, batch_size=app.config['EXPORT_BATCH_SIZE'], runs=results), indent=2))
+
+
+if __name__ == '__main__':
+    main()
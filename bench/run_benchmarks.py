@@ -0,0 +1,303 @@
+"""Route benchmarks against synthetic data, comparable between runs.
+
+Seeds a database at the chosen scale with ``seed_data.py`` (kept in
+``--data-dir`` and reused while scale, seed and date match), copies it for
+the run and drives every page through the Flask test client: the dashboard,
+the inventory with each stock filter and sort, reports at each grain, the
+PDF download, the sales list and the new-sale form and checkout.
+
+For each route it reports p50/p95/p99/mean latency, the SQL statements per
+request (from the ``Server-Timing`` header) and the peak Python memory of
+one request under tracemalloc, as JSON. The page cache is off unless
+``--with-cache`` is given, so the numbers are the work a cache miss does.
+
+``--baseline`` compares with a stored run and exits 1 when a route's p95 or
+peak memory grew by more than ``--tolerance``, or it runs more queries.
+
+    python bench/run_benchmarks.py --scale 100k --output bench-100k.json
+    python bench/run_benchmarks.py --scale 100k --baseline bench-100k.json
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import re
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+from importlib import metadata
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_QUERIES = re.compile(r'desc="(\d+) queries"')
+# Differences below this many milliseconds are timer noise, whatever the ratio
+MIN_DELTA_MS = 5.0
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def _summary(samples_ms, queries, peak_bytes):
+    return dict(samples=len(samples_ms),
+                p50_ms=round(_percentile(samples_ms, 0.50), 2),
+                p95_ms=round(_percentile(samples_ms, 0.95), 2),
+                p99_ms=round(_percentile(samples_ms, 0.99), 2),
+                mean_ms=round(sum(samples_ms) / len(samples_ms), 2),
+                queries=max(queries) if queries else None,
+                peak_kb=round(peak_bytes / 1024, 1))
+
+
+# ==================== DATA ====================
+
+def prepare_database(args):
+    """A new directory holding a copy of the seeded database as ``bench.db``."""
+    os.makedirs(args.data_dir, exist_ok=True)
+    seeded = os.path.join(args.data_dir, f'{args.scale}-seed{args.seed}-{args.today}.db')
+    if not os.path.exists(seeded):
+        partial = seeded + '.part'
+        for leftover in (partial, partial + '-wal', partial + '-shm'):
+            if os.path.exists(leftover):
+                os.unlink(leftover)
+        subprocess.run([sys.executable, os.path.join(ROOT, 'bench', 'seed_data.py'),
+                        '--scale', args.scale, '--seed', str(args.seed),
+                        '--today', args.today.isoformat(), '--database', partial],
+                       check=True, stdout=sys.stderr)
+        os.replace(partial, seeded)
+    run_dir = tempfile.mkdtemp(prefix='pharmasync-bench-')
+    shutil.copyfile(seeded, os.path.join(run_dir, 'bench.db'))
+    return run_dir
+
+
+def row_counts(db):
+    from models import Medicine, PurchaseOrder, Sale, StockBatch, Supplier
+    return {model.__tablename__: db.session.query(model).count()
+            for model in (Supplier, Medicine, StockBatch, PurchaseOrder, Sale)}
+
+
+# ==================== ROUTES ====================
+
+def routes(today):
+    """``(name, method, path, form)`` for every page benchmarked."""
+    yield 'dashboard', 'GET', '/dashboard', None
+    for stock in ('', 'low', 'out', 'expired', 'expiring'):
+        for sort in ('name', 'quantity', 'expiry', 'price'):
+            yield f'inventory stock={stock or "all"} sort={sort}', 'GET', f'/inventory?stock={stock}&sort={sort}', None
+    yield 'inventory search', 'GET', '/inventory?search=amoxi', None
+    yield 'inventory category', 'GET', '/inventory?category=Syrup', None
+    for grain in ('day', 'week', 'month'):
+        yield f'reports grain={grain}', 'GET', f'/reports?grain={grain}', None
+    year_ago = (today - timedelta(days=365)).isoformat()
+    yield 'reports year', 'GET', f'/reports?grain=month&start_date={year_ago}', None
+    yield 'download_report', 'GET', '/reports/download', None
+    yield 'sales_orders', 'GET', '/sales', None
+    yield 'new_sales_order form', 'GET', '/sales/new', None
+    yield 'new_sales_order checkout', 'POST', '/sales/new', 'basket'
+
+
+def basket(db, size=3):
+    """Form data for a sale of one unit of each of the best-stocked medicines."""
+    from models import Medicine
+    ids = [row.id for row in db.session.query(Medicine.id)
+           .order_by(Medicine.quantity.desc(), Medicine.id).limit(size)]
+    return {'medicine_id': ids, 'quantity': ['1'] * len(ids), 'customer_name': 'Benchmark'}
+
+
+def wait_for_report(app, client, timeout):
+    """Submit the default report and wait until its PDF is rendered; returns seconds."""
+    from models import db, ReportJob
+
+    started = time.perf_counter()
+    client.get('/reports/download')
+    with app.app_context():
+        while time.perf_counter() - started < timeout:
+            job = ReportJob.query.order_by(ReportJob.created_at.desc()).first()
+            if job is not None and job.status in ('done', 'failed'):
+                if job.status == 'failed':
+                    raise RuntimeError(f'Report job failed: {job.error}')
+                return time.perf_counter() - started
+            db.session.remove()
+            time.sleep(0.05)
+    raise RuntimeError('Report job did not finish in time')
+
+
+def measure(client, method, path, form, iterations, warmup):
+    def call():
+        response = client.open(path, method=method, data=form)
+        if response.status_code not in (200, 302):
+            raise RuntimeError(f'{method} {path} returned {response.status_code}')
+        response.close()
+        with client.session_transaction() as sess:
+            sess.pop('_flashes', None)
+        match = _QUERIES.search(response.headers.get('Server-Timing', ''))
+        return int(match.group(1)) if match else None
+
+    for _ in range(warmup):
+        call()
+    samples, queries = [], []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        count = call()
+        samples.append((time.perf_counter() - started) * 1000)
+        if count is not None:
+            queries.append(count)
+
+    # A separate request under tracemalloc, which slows everything it traces
+    tracemalloc.start()
+    try:
+        call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return _summary(samples, queries, peak)
+
+
+def measure_pdf(app, iterations):
+    """Render the default 30-day PDF directly, bypassing the job cache."""
+    import report_jobs
+
+    end = date.today()
+    start = end - timedelta(days=30)
+    samples, peak = [], 0
+    with app.app_context():
+        for i in range(iterations + 1):
+            traced = i == iterations
+            if traced:
+                tracemalloc.start()
+            started = time.perf_counter()
+            path = report_jobs.render_pdf(app, start, end, f'bench{i:04d}')
+            elapsed = (time.perf_counter() - started) * 1000
+            if traced:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+            else:
+                samples.append(elapsed)
+            os.unlink(path)
+    return _summary(samples, [], peak)
+
+
+# ==================== COMPARISON ====================
+
+def compare(result, baseline, tolerance):
+    """Regressions of ``result`` against ``baseline`` as readable lines."""
+    problems = []
+    for name, now in result['routes'].items():
+        before = baseline['routes'].get(name)
+        if before is None:
+            continue
+        if now['p95_ms'] > before['p95_ms'] * (1 + tolerance) and now['p95_ms'] - before['p95_ms'] > MIN_DELTA_MS:
+            problems.append(f'{name}: p95 {before["p95_ms"]} -> {now["p95_ms"]} ms')
+        if None not in (now['queries'], before['queries']) and now['queries'] > before['queries']:
+            problems.append(f'{name}: queries {before["queries"]} -> {now["queries"]}')
+        if now['peak_kb'] > before['peak_kb'] * (1 + tolerance) and now['peak_kb'] - before['peak_kb'] > 64:
+            problems.append(f'{name}: peak memory {before["peak_kb"]} -> {now["peak_kb"]} KB')
+    if baseline.get('meta', {}).get('scale') != result['meta']['scale']:
+        problems.append(f'baseline scale {baseline.get("meta", {}).get("scale")} '
+                        f'is not {result["meta"]["scale"]}')
+    return problems
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=('10k', '100k', '1m'), default='10k')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--today', type=date.fromisoformat, default=date.today(),
+                        help='date the seeded data is anchored to (YYYY-MM-DD)')
+    parser.add_argument('--iterations', type=int, default=20, help='timed requests per route')
+    parser.add_argument('--warmup', type=int, default=3, help='untimed requests per route first')
+    parser.add_argument('--pdf-iterations', type=int, default=3, help='direct PDF renders, 0 to skip')
+    parser.add_argument('--routes', default='', help='only routes whose name contains this')
+    parser.add_argument('--with-cache', action='store_true', help='leave the page cache on')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'pharmasync-bench'),
+                        help='where seeded databases are kept between runs')
+    parser.add_argument('--output', help='write the JSON here as well as to stdout')
+    parser.add_argument('--baseline', help='JSON from an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed p95 and memory growth over the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    run_dir = prepare_database(args)
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(run_dir, 'bench.db')
+    os.environ.pop('DATABASE_REPLICA_URL', None)
+    os.environ['SCHEDULER_IN_PROCESS'] = '0'  # no background jobs during the measurement
+    from app import app, db, init_db
+
+    with contextlib.redirect_stdout(sys.stderr):  # stdout is kept for the JSON
+        init_db()
+    app.config['REPORT_DIR'] = os.path.join(run_dir, 'reports')
+    if not args.with_cache:
+        app.extensions.pop('pharmasync_cache', None)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 0
+        sess['username'] = 'benchmark'
+    with app.app_context():
+        counts = row_counts(db)
+        sale_form = basket(db)
+
+    results = {}
+    report_seconds = None
+    for name, method, path, form in routes(date.today()):
+        if args.routes not in name:
+            continue
+        if name == 'download_report':
+            # The first request renders in the background; the timed ones serve the file
+            report_seconds = round(wait_for_report(app, client, timeout=600), 2)
+        print(f'{name} ...', file=sys.stderr)
+        results[name] = measure(client, method, path, sale_form if form == 'basket' else form,
+                                args.iterations, args.warmup)
+    if args.pdf_iterations and args.routes in 'report_pdf render':
+        print('report_pdf render ...', file=sys.stderr)
+        results['report_pdf render'] = measure_pdf(app, args.pdf_iterations)
+
+    result = dict(meta=dict(scale=args.scale,
+                            seed=args.seed,
+                            data_date=args.today.isoformat(),
+                            rows=counts,
+                            iterations=args.iterations,
+                            warmup=args.warmup,
+                            cache=args.with_cache,
+                            first_report_seconds=report_seconds,
+                            max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            commit=_git_commit(),
+                            python=platform.python_version(),
+                            flask=metadata.version('flask'),
+                            sqlalchemy=metadata.version('sqlalchemy'),
+                            sqlite=sqlite3.sqlite_version,
+                            platform=platform.platform(),
+                            run_at=datetime.utcnow().isoformat(timespec='seconds')),
+                  routes=results)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for problem in problems:
+            print('regression:', problem, file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Synthetic pharmacy data at benchmark scales.
+
+Fills a database with suppliers, medicines, purchase orders and sales that
+look like a real shop's, so query plans and timings mean something:
+
+* sales follow a Zipf-like curve -- a few medicines sell every day, the
+  long tail rarely -- with busier weekdays and shop hours, over a year;
+* expiry dates are spread from already expired through the next 30 days
+  to three years out, with some medicines undated;
+* stock levels include out-of-stock and below-reorder-level medicines.
+
+The same ``--seed`` and ``--today`` give the same rows. Rows are written with
+Core executemany in chunks, then the stock batches, full-text index and
+dashboard counters are brought up to date as the app would have left them.
+
+    python bench/seed_data.py --scale 100k --database /tmp/bench.db
+"""
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Rows per table; the scale names count sales
+SCALES = {
+    '10k': dict(suppliers=50, medicines=1000, purchase_orders=2000, sales=10000),
+    '100k': dict(suppliers=200, medicines=5000, purchase_orders=20000, sales=100000),
+    '1m': dict(suppliers=500, medicines=20000, purchase_orders=100000, sales=1000000),
+}
+CHUNK = 20000
+HISTORY_DAYS = 365
+
+_STEMS = ['Amoxi', 'Parace', 'Ibupro', 'Cetiri', 'Metfor', 'Atorva', 'Omepra', 'Azithro',
+          'Losar', 'Amlodi', 'Panto', 'Levo', 'Cipro', 'Doxy', 'Monte', 'Rosuva', 'Clopi',
+          'Gaba', 'Sertra', 'Predni', 'Diclo', 'Ranit', 'Fluco', 'Vilda']
+_ENDINGS = ['cillin', 'tamol', 'fen', 'zine', 'min', 'statin', 'zole', 'mycin', 'tan',
+            'pine', 'prazole', 'floxacin', 'cycline', 'lukast', 'grel', 'pentin', 'line', 'sone']
+_CATEGORIES = [('Tablet', 40), ('Capsule', 20), ('Syrup', 12), ('Injection', 8),
+               ('Ointment', 7), ('Drops', 6), ('Inhaler', 4), (None, 3)]
+_MAKERS = ['Sun Pharma', 'Cipla', 'Lupin', "Dr. Reddy's", 'Zydus', 'Torrent', 'Alkem',
+           'Mankind', 'Glenmark', 'Intas', 'Abbott', 'Pfizer', 'GSK', 'Sanofi', 'Biocon']
+_STRENGTHS = ['5mg', '10mg', '20mg', '25mg', '50mg', '100mg', '250mg', '500mg', '650mg', '1g']
+_SALE_QUANTITIES = [1] * 10 + [2] * 6 + [3] * 3 + [4, 5, 6, 10]
+# Relative traffic by weekday (Mon..Sun) and by hour of day
+_WEEKDAYS = [1.0, 1.0, 0.95, 1.0, 1.1, 1.25, 0.7]
+_HOURS = [0.1] * 7 + [0.5, 1.2, 1.5, 1.6, 1.5, 1.3, 1.2, 1.1, 1.2, 1.4, 1.7, 1.9, 1.8, 1.4, 0.9, 0.4, 0.2]
+
+
+def _chunks(rows, size=CHUNK):
+    iterator = iter(rows)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _weighted(rng, pairs):
+    values, weights = zip(*pairs)
+    return rng.choices(values, weights=weights)[0]
+
+
+def _expiry(rng, today):
+    roll = rng.random()
+    if roll < 0.05:
+        return None
+    if roll < 0.09:
+        return today - timedelta(days=rng.randint(1, 180))  # expired
+    if roll < 0.15:
+        return today + timedelta(days=rng.randint(0, 30))  # expiring soon
+    if roll < 0.35:
+        return today + timedelta(days=rng.randint(31, 180))
+    return today + timedelta(days=rng.randint(181, 1095))
+
+
+def _stock(rng, reorder_level):
+    roll = rng.random()
+    if roll < 0.08:
+        return 0
+    if roll < 0.20:
+        return rng.randint(1, reorder_level)
+    return int(rng.lognormvariate(5, 0.8)) + reorder_level + 1
+
+
+# ==================== GENERATORS ====================
+
+def suppliers(rng, count, now):
+    for i in range(count):
+        name = f'{rng.choice(_MAKERS)} Distributors {i + 1}'
+        yield dict(name=name, contact_person=f'Contact {i + 1}',
+                   email=f'orders{i + 1}@supplier.example', phone=f'+91-98{rng.randint(10000000, 99999999)}',
+                   address=f'{rng.randint(1, 400)} Industrial Area, Sector {rng.randint(1, 60)}',
+                   created_at=now - timedelta(days=rng.randint(HISTORY_DAYS, 3 * HISTORY_DAYS)))
+
+
+def medicines(rng, count, today, now):
+    for i in range(count):
+        stem, ending = rng.choice(_STEMS), rng.choice(_ENDINGS)
+        reorder_level = rng.choice([5, 10, 10, 20, 25, 50])
+        created = now - timedelta(days=rng.randint(30, 3 * HISTORY_DAYS))
+        yield dict(name=f'{stem}{ending} {rng.choice(_STRENGTHS)}',
+                   generic_name=f'{stem.lower()}{ending}',
+                   category=_weighted(rng, _CATEGORIES),
+                   manufacturer=rng.choice(_MAKERS),
+                   quantity=_stock(rng, reorder_level),
+                   price=round(rng.lognormvariate(3.5, 0.9), 2),
+                   expiry_date=_expiry(rng, today),
+                   batch_number=f'B{today.year % 100:02d}{i:07d}',
+                   location=f'Shelf {rng.choice("ABCDEFGH")}{rng.randint(1, 30)}',
+                   reorder_level=reorder_level,
+                   created_at=created, updated_at=created)
+
+
+def purchase_orders(rng, count, supplier_ids, medicine_prices, now):
+    medicine_ids = list(medicine_prices)
+    for _ in range(count):
+        medicine_id = rng.choice(medicine_ids)
+        quantity = rng.choice([50, 100, 100, 200, 250, 500])
+        unit_price = round(medicine_prices[medicine_id] * rng.uniform(0.55, 0.8), 2)
+        ordered = now - timedelta(days=rng.uniform(0, HISTORY_DAYS))
+        status = _weighted(rng, [('completed', 85), ('pending', 10), ('cancelled', 5)])
+        yield dict(supplier_id=rng.choice(supplier_ids), medicine_id=medicine_id,
+                   quantity=quantity, unit_price=unit_price,
+                   total_amount=round(quantity * unit_price, 2), status=status,
+                   order_date=ordered,
+                   delivery_date=ordered + timedelta(days=rng.randint(2, 10)) if status == 'completed' else None)
+
+
+def sales(rng, count, medicine_prices, now):
+    # Popularity is a Zipf-like curve over a shuffled medicine order
+    medicine_ids = list(medicine_prices)
+    rng.shuffle(medicine_ids)
+    cumulative = list(itertools.accumulate(1.0 / (rank + 1) ** 1.1 for rank in range(len(medicine_ids))))
+    start = now - timedelta(days=HISTORY_DAYS)
+    days = [start.date() + timedelta(days=d) for d in range(HISTORY_DAYS + 1)]
+    # Busier weekdays, and a little growth over the year
+    day_weights = list(itertools.accumulate(
+        _WEEKDAYS[day.weekday()] * (0.8 + 0.4 * i / HISTORY_DAYS) for i, day in enumerate(days)))
+    hour_weights = list(itertools.accumulate(_HOURS))
+    for chunk_start in range(0, count, CHUNK):
+        size = min(CHUNK, count - chunk_start)
+        ids = rng.choices(medicine_ids, cum_weights=cumulative, k=size)
+        sale_days = rng.choices(days, cum_weights=day_weights, k=size)
+        hours = rng.choices(range(24), cum_weights=hour_weights, k=size)
+        for medicine_id, day, hour in zip(ids, sale_days, hours):
+            sold_at = datetime.combine(day, datetime.min.time()) + timedelta(
+                hours=hour, minutes=rng.randint(0, 59), seconds=rng.randint(0, 59))
+            if sold_at > now:
+                sold_at = now - timedelta(minutes=rng.randint(1, 600))
+            quantity = rng.choice(_SALE_QUANTITIES)
+            price = medicine_prices[medicine_id]
+            yield dict(medicine_id=medicine_id, quantity=quantity, unit_price=price,
+                       total_amount=round(quantity * price, 2), sale_date=sold_at,
+                       customer_name=None if rng.random() < 0.6 else f'Customer {rng.randint(1, 5000)}')
+
+
+# ==================== SEEDING ====================
+
+def seed(db, scale, seed_value=42, today=None, log=print):
+    """Fill the app's database (inside an app context); returns row counts."""
+    from models import Medicine, PurchaseOrder, Sale, Supplier
+    import batches
+    import ledger
+    import stats
+
+    counts = SCALES[scale]
+    rng = random.Random(seed_value)
+    today = today or date.today()
+    now = datetime.combine(today, datetime.min.time()).replace(hour=21)
+
+    with db.engine.begin() as conn:
+        def insert(model, rows):
+            started, written = time.perf_counter(), 0
+            for chunk in _chunks(rows):
+                conn.execute(model.__table__.insert(), chunk)
+                written += len(chunk)
+            log(f'{model.__tablename__}: {written} rows in {time.perf_counter() - started:.1f}s')
+
+        insert(Supplier, suppliers(rng, counts['suppliers'], now))
+        insert(Medicine, medicines(rng, counts['medicines'], today, now))
+        supplier_ids = [row[0] for row in conn.execute(Supplier.__table__.select().with_only_columns(Supplier.id))]
+        medicine_prices = dict(conn.execute(Medicine.__table__.select().with_only_columns(Medicine.id, Medicine.price)).all())
+        insert(PurchaseOrder, purchase_orders(rng, counts['purchase_orders'], supplier_ids, medicine_prices, now))
+        insert(Sale, sales(rng, counts['sales'], medicine_prices, now))
+
+        batches.backfill(conn)
+        # The generated stock enters the ledger as opening balances
+        ledger.correct(conn, ledger.OPENING, reference='seed')
+        stats.rebuild(conn, today)
+    if conn.dialect.name == 'sqlite':
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('ANALYZE')
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='10k')
+    parser.add_argument('--database', required=True, help='SQLite file (created) or database URL')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--today', type=date.fromisoformat, default=None,
+                        help='date the data is anchored to (YYYY-MM-DD), default today')
+    args = parser.parse_args()
+
+    url = args.database if '://' in args.database else 'sqlite:///' + os.path.abspath(args.database)
+    os.environ['DATABASE_URL'] = url
+    from app import app, db, init_db
+
+    init_db()
+    app.config['SLOW_QUERY_MS'] = float('inf')  # the chunked inserts are slow by design
+    with app.app_context():
+        seed(db, args.scale, args.seed, args.today)
+
+
+if __name__ == '__main__':
+    main()
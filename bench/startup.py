@@ -0,0 +1,261 @@
+"""Startup benchmark: import time and per-worker memory.
+
+Each run starts a fresh interpreter that imports the app, the way a
+gunicorn master with ``preload_app`` does, and then forks ``--workers``
+workers from it. If ``gunicorn.conf.py`` exists, its ``on_starting``,
+``pre_fork`` and ``post_fork`` hooks run as gunicorn would call them. Each
+worker then serves its first requests and renders one PDF report. Reported
+as JSON, as the median over ``--runs``:
+
+* ``import_s``: seconds to import the app, and the modules it loaded
+  (whether xhtml2pdf is among them) -- the start-up cost of every process
+  that is not a preloading master: CLI commands, the scheduler sidecar,
+  workers without ``preload_app``;
+* the master's RSS once it is ready to fork (after ``on_starting``);
+* per worker: RSS, and its unique (USS) and proportional (PSS) set size
+  from ``/proc/self/smaps_rollup``, right after the fork, after the first
+  requests and after the first PDF. USS is the memory a worker adds to the
+  machine; pages still shared with the master are not in it.
+
+``--no-preload`` forks the workers first and has each import the app,
+as plain ``gunicorn -w 4 app:app`` without ``preload_app`` does. Point
+``--root`` at another checkout (``git worktree add``) to measure it with the
+same script, and compare the two with ``--baseline``:
+
+    python bench/startup.py --output startup.json
+    python bench/startup.py --root ../pharmasync-old --no-preload --output before.json
+    python bench/startup.py --baseline before.json
+
+Memory figures need Linux; elsewhere only RSS (as the peak) is reported.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGES = ('/dashboard', '/inventory', '/reports')
+WORKER_FIELDS = ('fork', 'requests', 'pdf')
+
+
+# ==================== MEMORY ====================
+
+def memory_kb():
+    """``dict(rss=, uss=, pss=)`` of this process in KB (None where unavailable)."""
+    usage = dict(rss=None, uss=None, pss=None)
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            fields = {}
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    fields[parts[0].rstrip(':')] = int(parts[1])
+        usage.update(rss=fields['Rss'], pss=fields['Pss'],
+                     uss=fields['Private_Clean'] + fields['Private_Dirty'])
+    except (OSError, KeyError):
+        # ru_maxrss is the peak, in KB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['rss'] = peak // 1024 if sys.platform == 'darwin' else peak
+    return usage
+
+
+# ==================== PROBE (one fresh interpreter) ====================
+
+def _hooks(root):
+    path = os.path.join(root, 'gunicorn.conf.py')
+    if not os.path.exists(path):
+        return {}
+    import runpy
+    return runpy.run_path(path)
+
+
+def _import_app():
+    started = time.perf_counter()
+    import app as module
+    return module, dict(import_s=round(time.perf_counter() - started, 4),
+                        modules=len(sys.modules),
+                        pdf_loaded='xhtml2pdf' in sys.modules)
+
+
+def _worker(module, hooks, report_dir, write):
+    if 'post_fork' in hooks:
+        hooks['post_fork'](None, None)
+    result = dict(fork=memory_kb())
+    if module is None:
+        # Without preload every worker imports the app itself
+        module, imported = _import_app()
+        result.update(imported)
+    app = module.app
+
+    started = time.perf_counter()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 0
+        sess['username'] = 'startup'
+    for page in PAGES:
+        response = client.get(page)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {page} returned {response.status_code}')
+    result['first_requests_s'] = round(time.perf_counter() - started, 4)
+    result['requests'] = memory_kb()
+
+    import report_jobs
+    app.config['REPORT_DIR'] = report_dir
+    started = time.perf_counter()
+    with app.app_context():
+        end = date.today()
+        report_jobs.render_pdf(app, end - timedelta(days=30), end, f'startup{os.getpid()}')
+    result['first_pdf_s'] = round(time.perf_counter() - started, 4)
+    result['pdf'] = memory_kb()
+    write(result)
+
+
+def probe(args):
+    """Start the master and the workers and print one JSON line of measurements."""
+    sys.path.insert(0, args.root)
+    os.chdir(args.root)
+    result = dict(interpreter=memory_kb(), workers=[])
+    module, hooks = None, {}
+    if args.preload:
+        module, imported = _import_app()
+        result.update(imported, master=memory_kb())
+        hooks = _hooks(args.root)
+        if 'on_starting' in hooks:
+            hooks['on_starting'](None)
+    result['master_ready'] = memory_kb()
+
+    for _ in range(args.workers):
+        if 'pre_fork' in hooks:
+            hooks['pre_fork'](None, None)
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            status = 0
+            try:
+                def write(data):
+                    with os.fdopen(write_fd, 'w') as pipe:
+                        json.dump(data, pipe)
+                _worker(module, hooks, args.report_dir, write)
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+        os.close(write_fd)
+        # One worker at a time, so they do not compete for the CPU
+        with os.fdopen(read_fd) as pipe:
+            data = pipe.read()
+        _, status = os.waitpid(pid, 0)
+        if status or not data:
+            raise SystemExit(f'worker {pid} failed')
+        result['workers'].append(json.loads(data))
+    print(json.dumps(result))
+
+
+# ==================== DRIVER ====================
+
+def _median(values):
+    values = [v for v in values if v is not None]
+    return round(statistics.median(values), 4) if values else None
+
+
+def summarize(runs):
+    workers = [w for run in runs for w in run['workers']]
+    # The app is imported by the master with preload, by each worker without
+    imports = [x for x in runs + workers if 'import_s' in x]
+    summary = dict(import_s=_median(x['import_s'] for x in imports),
+                   modules=_median(x['modules'] for x in imports),
+                   pdf_loaded_at_import=any(x['pdf_loaded'] for x in imports),
+                   master_rss_kb=_median(r['master_ready']['rss'] for r in runs),
+                   first_requests_s=_median(w['first_requests_s'] for w in workers),
+                   first_pdf_s=_median(w['first_pdf_s'] for w in workers))
+    for stage in WORKER_FIELDS:
+        for key in ('rss', 'uss', 'pss'):
+            summary[f'worker_{stage}_{key}_kb'] = _median(w[stage][key] for w in workers)
+    return summary
+
+
+def prepare_database(root, directory):
+    """An initialized, empty database for the probes (created outside them)."""
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(directory, 'startup.db'))
+    subprocess.run([sys.executable, '-c', 'import app; app.init_db()'], cwd=root, env=env,
+                   check=True, stdout=subprocess.DEVNULL)
+    return env
+
+
+def compare(result, baseline):
+    """``before -> after`` lines for every figure in both runs."""
+    lines = []
+    for key, after in result['summary'].items():
+        before = baseline['summary'].get(key)
+        if isinstance(after, (int, float)) and not isinstance(after, bool) and before:
+            lines.append(f'{key:<26} {before:>12} -> {after:<12} ({(after - before) / before:+.0%})')
+        elif before != after:
+            lines.append(f'{key:<26} {before!s:>12} -> {after}')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--root', default=ROOT, help='checkout to measure')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters to measure')
+    parser.add_argument('--workers', type=int, default=2, help='workers forked per run')
+    parser.add_argument('--no-preload', dest='preload', action='store_false',
+                        help='fork first and import the app in each worker (gunicorn without preload_app)')
+    parser.add_argument('--output', help='write the JSON here as well as to stdout')
+    parser.add_argument('--baseline', help='JSON from an earlier run to compare with')
+    parser.add_argument('--probe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--report-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.root = os.path.abspath(args.root)
+
+    if args.probe:
+        probe(args)
+        return
+
+    directory = tempfile.mkdtemp(prefix='pharmasync-startup-')
+    env = prepare_database(args.root, directory)
+    env['SCHEDULER_IN_PROCESS'] = '0'
+    runs = []
+    for i in range(args.runs):
+        print(f'run {i + 1}/{args.runs} ...', file=sys.stderr)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--probe',
+                                 '--root', args.root, '--workers', str(args.workers),
+                                 *([] if args.preload else ['--no-preload']),
+                                 '--report-dir', os.path.join(directory, 'reports')],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    result = dict(meta=dict(root=args.root,
+                            runs=args.runs,
+                            workers=args.workers,
+                            preload=args.preload,
+                            preload_hooks=args.preload and os.path.exists(os.path.join(args.root, 'gunicorn.conf.py')),
+                            python=platform.python_version(),
+                            platform=platform.platform(),
+                            run_at=datetime.utcnow().isoformat(timespec='seconds')),
+                  summary=summarize(runs),
+                  runs=runs)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            for line in compare(result, json.load(f)):
+                print(line, file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Branches: several pharmacies in one installation.
+
+Stock, suppliers, purchase orders, sales and report jobs belong to a branch
+(``BranchOwned`` in models.py). A logged-in user works in their branch:
+``before_request`` puts it in ``g.branch_id``, and a ``do_orm_execute``
+hook adds ``branch_id = :branch`` for those models to every ORM SELECT,
+UPDATE and DELETE -- joins, subqueries and ``session.get()`` included --
+with ``with_loader_criteria``. Views, the API and the reports need no
+filter of their own, and rows inserted meanwhile default to the branch.
+Core statements on the tables themselves (the conditional stock UPDATEs in
+stock.py, the counters in stats.py) are not ORM statements and add
+``scope()`` or an explicit ``branch_id`` condition instead.
+
+Every index of those tables starts with ``branch_id``, so a branch's page
+reads its own slice of the index, in the order the page wants, however
+many other branches share the table.
+
+Outside a request -- scheduled jobs, CLI commands -- no branch is current
+and queries see every branch; ``use()`` enters one for a block. A branch
+can also keep its data in a database of its own (``BRANCH_DATABASES``,
+routed by dbconfig.RoutingSession); ``databases()`` runs a block once for
+the shared database and once inside each of those, which is how the
+nightly jobs and the cross-branch rollup reach them.
+
+Admins may switch to any branch. The rollup report
+(``reporting.branch_rollup``) compares all of them with one query grouped
+by ``branch_id`` per figure, not one query per branch.
+"""
+from contextlib import contextmanager
+
+from flask import g, session
+from sqlalchemy import event, true
+from sqlalchemy.orm import with_loader_criteria
+
+from models import db, Branch, BranchOwned
+import dbconfig
+
+ADMIN_ROLE = 'admin'
+
+
+def current():
+    """The current branch id, or None when every branch is visible."""
+    return dbconfig.current_branch()
+
+
+def scope(column):
+    """``column = <current branch>`` for Core statements; always true when none is current."""
+    branch_id = dbconfig.current_branch()
+    return true() if branch_id is None else column == branch_id
+
+
+@contextmanager
+def use(branch_id):
+    """Work in ``branch_id`` for the block (None: every branch)."""
+    previous = g.get('branch_id')
+    g.branch_id = branch_id
+    try:
+        yield branch_id
+    finally:
+        g.branch_id = previous
+
+
+def databases():
+    """Yield once per database: None for the shared one (every branch in it
+    visible), then each branch with a database of its own, inside ``use()``."""
+    with use(None):
+        yield None
+    for branch_id in sorted(dbconfig.branch_engines(db)):
+        with use(branch_id):
+            yield branch_id
+
+
+def by_code(code):
+    return Branch.query.filter_by(code=code).first()
+
+
+def can_switch():
+    return session.get('role') == ADMIN_ROLE
+
+
+# ==================== QUERY SCOPING ====================
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _scope_to_branch(state):
+    branch_id = dbconfig.current_branch()
+    if branch_id is None or state.is_column_load or state.is_relationship_load:
+        return
+    if state.is_select or state.is_update or state.is_delete:
+        # branch_id is a closure variable, so the cached statement takes it as a parameter
+        state.statement = state.statement.options(with_loader_criteria(
+            BranchOwned, lambda cls: cls.branch_id == branch_id, include_aliases=True))
+
+
+# ==================== SETUP ====================
+
+def _enter_branch():
+    if 'user_id' in session:
+        g.branch_id = session.get('branch_id', dbconfig.DEFAULT_BRANCH)
+
+
+def init_app(app):
+    app.before_request(_enter_branch)
@@ -0,0 +1,474 @@
+"""Bulk import and export of medicines, suppliers and sales.
+
+Imports read CSV, JSON (an array of objects) or JSON Lines one record at a
+time, so a file of any size is never held in memory. Each record is checked
+against the model's columns (types, lengths, required fields); good records
+are written ``BATCH_SIZE`` at a time with ``bulk_insert_mappings`` /
+``bulk_update_mappings`` and one commit per batch, bad ones are reported by
+line and skipped.
+
+* Medicines with a ``batch_number`` already in the database update that
+  medicine instead of adding a duplicate; only the non-empty values in the
+  file are changed.
+* Sales name their medicine by ``medicine_id`` or ``batch_number``;
+  ``unit_price`` defaults to the medicine's price and ``total_amount`` to
+  quantity * unit price. Imported sales are history: stock is not touched.
+* ``id``, ``branch_id``, ``created_at``, ``updated_at`` and
+  ``change_version`` columns (as written by the export) are accepted and
+  ignored, so an export can be re-imported; a re-imported medicine gets a
+  new change version, so terminals sync it again (sync.py). Records join the current branch, and medicines are matched
+  by batch number within it (branches.py).
+
+Dashboard counters are updated with the same deltas the ORM hook applies,
+and medicine quantity changes are appended to the stock ledger.
+
+Exports walk the current branch's rows in primary-key order ``BATCH_SIZE``
+at a time and yield text chunks for a streamed response or file.
+"""
+import csv
+import io
+import itertools
+import json
+import os
+from collections import namedtuple
+from datetime import date, datetime
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Medicine, Sale, Supplier
+import batches
+import branches
+import ledger
+import stats as dashboard_stats
+
+BATCH_SIZE = 1000
+FORMATS = ('csv', 'json', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+IGNORED_COLUMNS = ('id', 'branch_id', 'created_at', 'updated_at', 'change_version')
+
+Entity = namedtuple('Entity', 'model fields lookups write')
+Field = namedtuple('Field', 'name parse required default')
+
+
+class ImportResult:
+    def __init__(self, entity):
+        self.entity = entity
+        self.inserted = 0
+        self.updated = 0
+        self.errors = []  # (line, message)
+
+    def error(self, line, message):
+        self.errors.append((line, message))
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def to_dict(self):
+        return dict(entity=self.entity,
+                    inserted=self.inserted,
+                    updated=self.updated,
+                    errors=[dict(line=line, error=message) for line, message in self.errors])
+
+
+# ==================== SCHEMA ====================
+
+def _text(length=None):
+    def parse(value):
+        value = str(value).strip()
+        if length and len(value) > length:
+            raise ValueError(f'longer than {length} characters')
+        return value
+    return parse
+
+
+def _integer(value):
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return int(str(value).strip())
+
+
+def _number(value):
+    return float(str(value).strip()) if not isinstance(value, (int, float)) else float(value)
+
+
+def _date(value):
+    return date.fromisoformat(str(value).strip()[:10])
+
+
+def _datetime(value):
+    value = str(value).strip()
+    return datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+
+
+_PARSERS = {db.Integer: _integer, db.Float: _number, db.Date: _date, db.DateTime: _datetime}
+
+
+def _fields(model):
+    """Import fields derived from the model's columns."""
+    fields = {}
+    for column in model.__table__.columns:
+        if column.name in IGNORED_COLUMNS:
+            continue
+        parse = next((p for t, p in _PARSERS.items() if isinstance(column.type, t)), None)
+        if parse is None:
+            parse = _text(getattr(column.type, 'length', None))
+        default = column.default.arg if column.default is not None and column.default.is_scalar else None
+        required = not column.nullable and column.default is None
+        fields[column.name] = Field(column.name, parse, required, default)
+    return fields
+
+
+def parse_record(entity, record):
+    """Validate one raw record into column values. Raises ValueError."""
+    values = {}
+    problems = []
+    for key, raw in record.items():
+        if key in entity.fields:
+            field = entity.fields[key]
+        elif key in entity.lookups:
+            field = entity.lookups[key]
+        else:
+            continue  # unknown keys are rejected once, at the header (see _check_columns)
+        if raw is None or (isinstance(raw, str) and not raw.strip()):
+            continue  # empty means "not given": the default on insert, unchanged on update
+        try:
+            values[key] = field.parse(raw)
+        except (TypeError, ValueError) as e:
+            problems.append(f'{key}: invalid value {raw!r} ({e})')
+    for field in entity.fields.values():
+        if field.required and field.name not in values and not _derived(entity, field.name):
+            problems.append(f'{field.name} is required')
+    for key in ('quantity', 'price', 'unit_price', 'total_amount', 'reorder_level'):
+        if values.get(key) is not None and values[key] < 0:
+            problems.append(f'{key} must not be negative')
+    if problems:
+        raise ValueError('; '.join(problems))
+    return values
+
+
+def _derived(entity, name):
+    # Sale columns filled in from the medicine when left out of the file
+    return entity.model is Sale and name in ('medicine_id', 'unit_price', 'total_amount')
+
+
+def _check_columns(entity, columns):
+    unknown = [c for c in columns
+               if c not in entity.fields and c not in entity.lookups and c not in IGNORED_COLUMNS]
+    if unknown:
+        raise ValueError(f'Unknown column(s) for {entity.model.__tablename__}: {", ".join(unknown)}')
+
+
+# ==================== WRITERS ====================
+
+_SNAPSHOT = ('quantity', 'reorder_level', 'expiry_date', 'category')
+
+
+def _write_medicines(session, rows, result):
+    keyed, inserts = {}, []
+    for line, values in rows:
+        key = values.get('batch_number')
+        if key:
+            # A batch number repeated in the file: the later row wins
+            keyed.setdefault(key, {}).update(values)
+        else:
+            inserts.append(values)
+
+    existing = {}
+    if keyed:
+        found = session.execute(
+            select(Medicine.id, Medicine.batch_number, *[getattr(Medicine, k) for k in _SNAPSHOT])
+            .where(Medicine.batch_number.in_(list(keyed)))
+            .order_by(Medicine.id)
+        ).all()
+        for row in found:
+            existing.setdefault(row.batch_number, row)
+
+    defaults = {f.name: f.default for f in MEDICINES.fields.values()}
+    updates, changes = [], []
+    now = datetime.utcnow()
+    for key, values in keyed.items():
+        row = existing.get(key)
+        if row is None:
+            inserts.append(values)
+            continue
+        before = tuple(getattr(row, k) for k in _SNAPSHOT)
+        after = tuple(values[k] if k in values else getattr(row, k) for k in _SNAPSHOT)
+        updates.append(dict(values, id=row.id, updated_at=now))
+        changes.append((before, after))
+
+    inserts = [dict(defaults, **values, created_at=now, updated_at=now) for values in inserts]
+    changes.extend((None, tuple(values[k] for k in _SNAPSHOT)) for values in inserts)
+    if inserts:
+        # return_defaults fills in the new ids, which the batches need
+        session.bulk_insert_mappings(Medicine, inserts, return_defaults=True)
+    if updates:
+        session.bulk_update_mappings(Medicine, updates)
+    conn = session.connection()
+    if changes:
+        dashboard_stats.apply_changes(conn, changes)
+    # Imported quantities are stock adjustments against the batches
+    batches.reconcile(conn, [values['id'] for values in inserts + updates])
+    # changes lists the updates first, in the same order
+    movements = [(values['id'], (after[0] or 0) - (before[0] or 0), after[0] or 0)
+                 for values, (before, after) in zip(updates, changes)]
+    movements += [(values['id'], values['quantity'] or 0, values['quantity'] or 0) for values in inserts]
+    ledger.record(conn, ledger.IMPORT, movements, reference='import')
+    return len(inserts), len(updates)
+
+
+def _write_suppliers(session, rows, result):
+    now = datetime.utcnow()
+    mappings = [dict(values, created_at=now) for _, values in rows]
+    session.bulk_insert_mappings(Supplier, mappings)
+    return len(mappings), 0
+
+
+def _write_sales(session, rows, result):
+    ids = {v['medicine_id'] for _, v in rows if v.get('medicine_id') is not None}
+    batches = {v['batch_number'] for _, v in rows if v.get('medicine_id') is None and v.get('batch_number')}
+    found = session.execute(
+        select(Medicine.id, Medicine.batch_number, Medicine.price)
+        .where(Medicine.id.in_(ids) | Medicine.batch_number.in_(batches))
+        .order_by(Medicine.id)
+    ).all()
+    by_id = {row.id: row for row in found}
+    by_batch = {}
+    for row in found:
+        by_batch.setdefault(row.batch_number, row)
+
+    now = datetime.utcnow()
+    mappings, sales = [], []
+    for line, values in rows:
+        values = dict(values)
+        batch_number = values.pop('batch_number', None)
+        medicine = by_id.get(values['medicine_id']) if values.get('medicine_id') is not None \
+            else by_batch.get(batch_number)
+        if medicine is None:
+            result.error(line, 'medicine not found' if values.get('medicine_id') is not None or batch_number
+                         else 'medicine_id or batch_number is required')
+            continue
+        values['medicine_id'] = medicine.id
+        if values.get('unit_price') is None:
+            values['unit_price'] = medicine.price
+        if values.get('total_amount') is None:
+            values['total_amount'] = values['quantity'] * values['unit_price']
+        if values.get('sale_date') is None:
+            values['sale_date'] = now
+        mappings.append(values)
+        sales.append((values['sale_date'], values['total_amount'], 1))
+    if mappings:
+        session.bulk_insert_mappings(Sale, mappings)
+        dashboard_stats.apply_changes(session.connection(), sales=sales)
+    return len(mappings), 0
+
+
+MEDICINES = Entity(Medicine, _fields(Medicine), {}, _write_medicines)
+SUPPLIERS = Entity(Supplier, _fields(Supplier), {}, _write_suppliers)
+SALES = Entity(Sale, _fields(Sale),
+               {'batch_number': Field('batch_number', _text(100), False, None)}, _write_sales)
+
+ENTITIES = {'medicines': MEDICINES, 'suppliers': SUPPLIERS, 'sales': SALES}
+
+
+# ==================== READERS ====================
+
+def detect_format(filename, default='csv'):
+    ext = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    if ext == 'jsonl':
+        return 'ndjson'
+    return ext if ext in FORMATS else default
+
+
+def read_csv(stream):
+    """``(line, record)`` pairs from a CSV text stream with a header row."""
+    reader = csv.DictReader(stream)
+    for record in reader:
+        if None in record:
+            yield reader.line_num, ValueError('more values than header columns')
+            continue
+        if not any((v or '').strip() for v in record.values()):
+            continue
+        yield reader.line_num, record
+
+
+def _json_array(stream, chunk_size=1 << 16):
+    # Items of a JSON array whose opening '[' has already been read
+    decoder = json.JSONDecoder()
+    buf, pos, eof, number = '', 0, False, 0
+
+    def more():
+        nonlocal buf, pos, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buf, pos = buf[pos:] + chunk, 0
+
+    def skip_space():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            more()
+
+    while True:
+        skip_space()
+        if pos >= len(buf):
+            raise ValueError('JSON array is not closed')
+        if buf[pos] == ']':
+            return
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                more()
+                continue
+            if end == len(buf) and not eof:
+                # The item may continue in the next chunk
+                more()
+                continue
+            break
+        pos = end
+        number += 1
+        yield number, value
+        skip_space()
+        if pos < len(buf) and buf[pos] == ',':
+            pos += 1
+        elif pos >= len(buf) or buf[pos] != ']':
+            raise ValueError(f'expected "," or "]" after item {number}')
+
+
+def _json_lines(first, stream):
+    lines = itertools.chain([first + stream.readline()], stream)
+    for number, text in enumerate(lines, 1):
+        if not text.strip():
+            continue
+        try:
+            yield number, json.loads(text)
+        except ValueError as e:
+            yield number, e
+
+
+def read_json(stream):
+    """``(number, record)`` pairs from a JSON array or JSON Lines stream."""
+    head = stream.read(1)
+    while head and head.isspace():
+        head = stream.read(1)
+    items = _json_array(stream) if head == '[' else _json_lines(head, stream)
+    for number, value in items:
+        if not isinstance(value, (dict, Exception)):
+            value = ValueError('expected a JSON object')
+        yield number, value
+
+
+def read_records(stream, fmt):
+    return read_csv(stream) if fmt == 'csv' else read_json(stream)
+
+
+# ==================== IMPORT ====================
+
+def _write_batch(entity, batch, result):
+    session = db.session
+    try:
+        inserted, updated = entity.write(session, batch, result)
+        session.commit()
+    except SQLAlchemyError as e:
+        session.rollback()
+        if len(batch) == 1:
+            result.error(batch[0][0], str(getattr(e, 'orig', e)))
+            return
+        # Retry row by row so only the offending rows are reported and skipped
+        for row in batch:
+            _write_batch(entity, [row], result)
+        return
+    result.inserted += inserted
+    result.updated += updated
+
+
+def import_records(entity_name, records, batch_size=BATCH_SIZE):
+    """Validate and write ``(line, record)`` pairs; returns an ``ImportResult``."""
+    entity = ENTITIES[entity_name]
+    result = ImportResult(entity_name)
+    batch = []
+    checked = set()
+    try:
+        for line, record in records:
+            if isinstance(record, Exception):
+                result.error(line, str(record))
+                continue
+            columns = frozenset(record)
+            if columns not in checked:
+                _check_columns(entity, columns)
+                checked.add(columns)
+            try:
+                batch.append((line, parse_record(entity, record)))
+            except ValueError as e:
+                result.error(line, str(e))
+            if len(batch) >= batch_size:
+                _write_batch(entity, batch, result)
+                batch = []
+    except ValueError as e:
+        # Unknown columns or a file that can no longer be parsed: stop here
+        result.error(None, str(e))
+    if batch:
+        _write_batch(entity, batch, result)
+    result.errors.sort(key=lambda error: (error[0] is None, error[0] or 0))
+    return result
+
+
+def import_file(entity_name, stream, fmt, batch_size=BATCH_SIZE):
+    """Import a text stream in ``fmt`` (csv, json or ndjson)."""
+    return import_records(entity_name, read_records(stream, fmt), batch_size)
+
+
+# ==================== EXPORT ====================
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
+def export_rows(entity_name, batch_size=BATCH_SIZE):
+    """Batches of row dicts in id order, one keyset query per batch."""
+    table = ENTITIES[entity_name].model.__table__
+    last_id = None
+    while True:
+        query = select(table).where(branches.scope(table.c.branch_id)).order_by(table.c.id).limit(batch_size)
+        if last_id is not None:
+            query = query.where(table.c.id > last_id)
+        rows = db.session.execute(query).mappings().all()
+        if not rows:
+            return
+        yield [{key: _plain(value) for key, value in row.items()} for row in rows]
+        last_id = rows[-1]['id']
+        if len(rows) < batch_size:
+            return
+
+
+def export_chunks(entity_name, fmt, batch_size=BATCH_SIZE):
+    """The table as ``fmt`` text, one chunk per batch of rows."""
+    columns = [c.name for c in ENTITIES[entity_name].model.__table__.columns]
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns)
+        writer.writeheader()
+        for rows in export_rows(entity_name, batch_size):
+            writer.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+    elif fmt == 'ndjson':
+        for rows in export_rows(entity_name, batch_size):
+            yield ''.join(json.dumps(row) + '\n' for row in rows)
+    else:
+        separator = '[\n'
+        for rows in export_rows(entity_name, batch_size):
+            yield separator + ',\n'.join(json.dumps(row) for row in rows)
+            separator = ',\n'
+        yield '[]\n' if separator == '[\n' else '\n]\n'
+
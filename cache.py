@@ -0,0 +1,284 @@
+"""Cache for rendered pages and query results, invalidated by writes.
+
+Every cache key includes the *generation* of the tables its content was
+read from. A committed transaction that wrote to a table bumps that table's
+generation, so entries built from the old data are never asked for again
+and age out of the LRU; nothing has to find and delete them.
+
+Writes are seen at the engine: each INSERT/UPDATE/DELETE run in a session's
+transaction (ORM flushes, bulk writes, the Core statements in stock.py and
+batches.py) records its table, ``after_commit`` bumps those tables and a
+rollback forgets them. Raw ``text()`` writes are not seen; use SQL
+expression constructs for anything that changes cached tables.
+
+The default backend is an in-process LRU. With several gunicorn workers,
+set ``CACHE_URL`` to a Redis server (needs the ``redis`` package) so the
+workers share entries and generations; with the in-process backend a
+worker only notices another worker's writes once ``CACHE_TTL`` runs out.
+
+Keys also name the current branch (branches.py), as every query is scoped
+to it; the generations are per table, not per branch, so a write in one
+branch invalidates the others' entries for that table too.
+
+``cached_page`` also makes pages conditional: the ETag is the cache key
+and Last-Modified the last write to the page's tables, so a browser
+revalidating an unchanged page gets a 304 without the view running.
+Values that must be current each time a page is served (the live stock
+feed's last event id) are ``volatile``: the cached body keeps a marker in
+their place, filled in on every response.
+"""
+import hashlib
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from functools import wraps
+
+from flask import current_app, g, has_app_context, make_response, request, session
+from sqlalchemy import event
+
+from models import db
+import dbconfig
+
+_DIRTY = 'cache_dirty_tables'
+
+
+# ==================== BACKENDS ====================
+
+class MemoryCache:
+    """Least-recently-used entries in this process, each kept ``ttl`` seconds."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # Generations count this process's writes only, so keys and ETags
+        # must not be confused with another worker's
+        self.namespace = uuid.uuid4().hex
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._modified = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def generations(self, tables):
+        """``([generation, ...], last write time or None)`` for ``tables``."""
+        with self._lock:
+            modified = [self._modified[t] for t in tables if t in self._modified]
+            return [self._generations.get(t, 0) for t in tables], max(modified, default=None)
+
+    def bump(self, tables, now):
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+                self._modified[table] = now
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Entries and generations shared by every worker, kept in Redis."""
+
+    namespace = 'shared'
+
+    def __init__(self, url, ttl, prefix='pharmasync:'):
+        # Optional dependency: only needed when CACHE_URL is set
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self._redis.get(self.prefix + key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self._redis.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def generations(self, tables):
+        pipe = self._redis.pipeline()
+        pipe.hmget(self.prefix + 'generation', tables)
+        pipe.hmget(self.prefix + 'modified', tables)
+        generations, modified = pipe.execute()
+        return ([int(g or 0) for g in generations],
+                max((float(m) for m in modified if m), default=None))
+
+    def bump(self, tables, now):
+        pipe = self._redis.pipeline()
+        for table in tables:
+            pipe.hincrby(self.prefix + 'generation', table, 1)
+        pipe.hset(self.prefix + 'modified', mapping={table: now for table in tables})
+        pipe.execute()
+
+    def clear(self):
+        for key in self._redis.scan_iter(self.prefix + 'v:*'):
+            self._redis.delete(key)
+
+
+def backend(app=None):
+    """The app's cache backend, or None when caching is switched off."""
+    app = app or current_app
+    return app.extensions.get('pharmasync_cache')
+
+
+# ==================== INVALIDATION ====================
+
+def _record_write(conn, clauseelement, multiparams, params, execution_options):
+    tables = conn.info.get(_DIRTY)
+    if tables is not None and getattr(clauseelement, 'is_dml', False):
+        tables.add(clauseelement.table.name)
+
+
+@event.listens_for(db.session, 'after_begin')
+def _track_transaction(session, transaction, connection):
+    # The connection records into the session's set for this transaction
+    connection.info[_DIRTY] = session.info.setdefault(_DIRTY, set())
+
+
+@event.listens_for(db.session, 'after_commit')
+def _bump_generations(session):
+    tables = session.info.pop(_DIRTY, None)
+    if tables and has_app_context() and backend() is not None:
+        backend().bump(sorted(tables), time.time())
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_writes(session):
+    session.info.pop(_DIRTY, None)
+
+
+# ==================== KEYS ====================
+
+def _key(*parts):
+    return 'v:' + hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def remember(name, tables, args, compute):
+    """``compute()``, cached under ``name`` and ``args`` until one of ``tables`` is written."""
+    cache = backend()
+    if cache is None:
+        return compute()
+    generations, _ = cache.generations(tables)
+    key = _key('query', name, args, dbconfig.current_branch(), cache.namespace, generations)
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value)
+    return value
+
+
+def cached_page(*tables):
+    """Serve a GET view from the cache while ``tables`` are unchanged.
+
+    The key covers the view arguments, the query string, the logged-in
+    user (pages show their name), their branch and today's date (expiry
+    filters and default report ranges move with it). Requests with pending flash
+    messages bypass the cache in both directions.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = backend()
+            if cache is None or request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            generations, modified = cache.generations(tables)
+            key = _key('page', request.endpoint, sorted(kwargs.items()),
+                       sorted(request.args.items(multi=True)), session.get('user_id'),
+                       dbconfig.current_branch(), date.today().isoformat(), cache.namespace, generations)
+            cached = cache.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                response = current_app.response_class(_fill(body), mimetype=mimetype)
+            else:
+                # Volatile values render as markers while the view runs (see volatile)
+                g.cache_volatile = values = {}
+                try:
+                    response = make_response(view(*args, **kwargs))
+                finally:
+                    g.cache_volatile = None
+                if response.is_streamed:
+                    return response
+                body = response.get_data()
+                response.set_data(_fill(body, values))
+                if response.status_code != 200 or session.modified:
+                    return response
+                cache.set(key, (body, response.mimetype))
+
+            response.set_etag(key[2:])
+            if modified is not None:
+                response.last_modified = datetime.fromtimestamp(modified, timezone.utc)
+            # Pages are per user and must be revalidated every time
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+
+# ==================== VOLATILE VALUES ====================
+
+_VOLATILE = {}
+
+
+def volatile(name, compute):
+    """A template function for ``compute()``, which cached pages must not keep.
+
+    Inside a ``cached_page`` view it returns a marker, which the cached body
+    keeps; the response gets the value computed while the view ran and each
+    later hit a fresh ``compute()``. Values go in as they are, so they must
+    need no escaping in HTML or URLs.
+    """
+    marker = f'__volatile_{name}__'
+    _VOLATILE[marker.encode()] = compute
+
+    def value():
+        values = g.get('cache_volatile') if has_app_context() else None
+        if values is None:
+            return compute()
+        if marker.encode() not in values:
+            values[marker.encode()] = compute()
+        return marker
+    return value
+
+
+def _fill(body, values=None):
+    for marker, compute in _VOLATILE.items():
+        if marker in body:
+            value = values[marker] if values and marker in values else compute()
+            body = body.replace(marker, str(value).encode())
+    return body
+
+
+# ==================== SETUP ====================
+
+def init_app(app):
+    """Create the configured backend and watch the app's engines for writes."""
+    if app.config['CACHE_URL']:
+        app.extensions['pharmasync_cache'] = RedisCache(app.config['CACHE_URL'], app.config['CACHE_TTL'])
+    elif app.config['CACHE_MAX_ENTRIES']:
+        app.extensions['pharmasync_cache'] = MemoryCache(app.config['CACHE_MAX_ENTRIES'], app.config['CACHE_TTL'])
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_execute', _record_write)
@@ -0,0 +1,289 @@
+"""The ``flask`` command line (``flask --app app <command>``)."""
+from datetime import timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from dbcheck import capture_selects, explain, full_scans, partial_indexes
+from models import db, Branch, Medicine, JobRun, User
+import branches
+import bulk_io
+import dbconfig
+import jobs  # registers the scheduled jobs run-job chooses from
+import ledger
+import migrations
+import reorder
+import scheduler
+import stats as dashboard_stats
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade():
+    """Create missing tables and apply pending schema migrations."""
+    db.create_all()
+    for branch_id, applied in migrations.upgrade_all(db).items():
+        where = f'Branch {branch_id} database: ' if branch_id else ''
+        click.echo(where + (f'Applied migrations: {applied}' if applied else 'Schema is up to date.'))
+    click.echo(f'Schema version: {migrations.current_version(db.engine)}')
+
+@click.command('stats-rebuild')
+@with_appcontext
+def stats_rebuild():
+    """Recompute the dashboard counters and daily sales buckets from scratch."""
+    for _ in branches.databases():
+        dashboard_stats.rebuild(db.session.connection())
+    db.session.commit()
+    click.echo('Dashboard stats rebuilt.')
+
+def _branch_id(code):
+    branch = branches.by_code(code)
+    if branch is None:
+        raise click.ClickException(f'No branch {code!r}; see flask branch-list.')
+    return branch.id
+
+@click.command('branch-add')
+@click.argument('code')
+@click.argument('name')
+@with_appcontext
+def branch_add(code, name):
+    """Add a branch. Its own database, if any, goes in BRANCH_DATABASES under the id printed."""
+    if branches.by_code(code) is not None:
+        raise click.ClickException(f'Branch {code!r} already exists.')
+    branch = Branch(code=code, name=name)
+    db.session.add(branch)
+    db.session.commit()
+    click.echo(f'Branch {branch.code} added with id {branch.id}.')
+
+@click.command('branch-list')
+@with_appcontext
+def branch_list():
+    """List the branches and how many users each has."""
+    counts = dict(db.session.query(User.branch_id, db.func.count(User.id)).group_by(User.branch_id).all())
+    for branch in Branch.query.order_by(Branch.id):
+        click.echo(f'{branch.id:>4}  {branch.code:<12} {branch.name:<30} {counts.get(branch.id, 0)} user(s)')
+
+@click.command('user-branch')
+@click.argument('email')
+@click.argument('code')
+@with_appcontext
+def user_branch(email, code):
+    """Move a user to another branch (from their next login)."""
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f'No user {email!r}.')
+    user.branch_id = _branch_id(code)
+    db.session.commit()
+    click.echo(f'{user.username} now works in {code}.')
+
+@click.command('reorder')
+@click.option('--dry-run', is_flag=True, help='Only list what would be ordered.')
+@with_appcontext
+def reorder_command(dry_run):
+    """Create draft purchase orders for medicines that will run out within their lead time."""
+    result = reorder.run(dry_run=dry_run)
+    if dry_run:
+        for s in result.suggestions:
+            click.echo(f'medicine {s.medicine_id}: order {s.quantity} from supplier {s.supplier_id} '
+                       f'({s.daily_demand:g}/day, reorder point {s.reorder_point:g}, position {s.position})')
+    click.echo(f'{len(result.suggestions)} to order, {result.orders_created} drafts created, '
+               f'{len(result.no_supplier)} without a supplier; {result.checked} medicines in {result.seconds}s.')
+
+@click.command('scheduler')
+@with_appcontext
+def scheduler_command():
+    """Run the job scheduler in the foreground (a sidecar to SCHEDULER_IN_PROCESS=0 workers)."""
+    runner = scheduler.Scheduler(current_app._get_current_object())
+    click.echo(f'Scheduler {runner.owner}: {", ".join(sorted(scheduler.JOBS))}')
+    try:
+        runner.run()
+    except KeyboardInterrupt:
+        runner.stop()
+
+@click.command('run-job')
+@click.argument('name', type=click.Choice(sorted(scheduler.JOBS)))
+@with_appcontext
+def run_job_command(name):
+    """Run one scheduled job now, recording it in the run history."""
+    app = current_app._get_current_object()
+    run = db.session.get(JobRun, scheduler.run_job(app, scheduler.JOBS[name], scheduler.worker_id()))
+    click.echo(f'{run.job}: {run.status} in {run.duration_ms:.0f} ms' + (f' ({run.result})' if run.result else ''))
+    if run.status != 'ok':
+        click.echo(run.error, err=True)
+        raise SystemExit(1)
+
+@click.command('job-history')
+@click.option('--limit', default=20, show_default=True)
+@with_appcontext
+def job_history(limit):
+    """List the latest scheduled job runs."""
+    for run in scheduler.history(limit):
+        duration = f'{run.duration_ms:.0f} ms' if run.duration_ms is not None else '-'
+        click.echo(f'{run.started_at:%Y-%m-%d %H:%M:%S}  {run.job:<20} {run.status:<8} {duration:>10}  {run.result or ""}')
+
+@click.command('stock-as-of')
+@click.argument('day', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.option('--medicine', 'medicine_ids', type=int, multiple=True, help='Only these medicine ids.')
+@with_appcontext
+def stock_as_of(day, medicine_ids):
+    """Print the stock at the end of DAY (UTC), rebuilt from the ledger."""
+    try:
+        quantities = ledger.as_of(db.session.connection(), day + timedelta(days=1), medicine_ids or None)
+    except LookupError as e:
+        raise click.ClickException(str(e))
+    for medicine_id in medicine_ids or sorted(quantities):
+        click.echo(f'{medicine_id}\t{quantities.get(medicine_id, 0)}')
+    click.echo(f'{sum(quantities.values())} units of {len(quantities)} medicine(s) in stock.', err=True)
+
+@click.command('stock-verify')
+@click.option('--fix', is_flag=True, help='Record an adjustment for every difference found.')
+@with_appcontext
+def stock_verify(fix):
+    """Check that the stock ledger adds up to every medicine's quantity."""
+    conn = db.session.connection()
+    differences = ledger.correct(conn) if fix else ledger.verify(conn)
+    for medicine_id, expected, quantity in differences:
+        click.echo(f'medicine {medicine_id}: ledger {expected}, quantity {quantity} ({quantity - expected:+d})')
+    if fix:
+        db.session.commit()
+        click.echo(f'{len(differences)} adjustment(s) recorded.')
+    elif differences:
+        click.echo(f'{len(differences)} medicine(s) differ; --fix records them as adjustments.')
+        raise SystemExit(1)
+    else:
+        click.echo('The ledger matches every medicine.')
+
+@click.command('import-data')
+@click.argument('entity', type=click.Choice(list(bulk_io.ENTITIES)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(bulk_io.FORMATS), help='Defaults to the file extension.')
+@click.option('--batch-size', default=bulk_io.BATCH_SIZE, show_default=True)
+@click.option('--branch', 'branch_code', help='Branch code to load into; defaults to the first branch.')
+@with_appcontext
+def import_data(entity, path, fmt, batch_size, branch_code):
+    """Bulk-load medicines, suppliers or sales from a CSV, JSON or JSON Lines file."""
+    branch_id = _branch_id(branch_code) if branch_code else dbconfig.DEFAULT_BRANCH
+    with open(path, encoding='utf-8-sig', newline='') as stream, branches.use(branch_id):
+        result = bulk_io.import_file(entity, stream, fmt or bulk_io.detect_format(path), batch_size)
+    for line, message in result.errors:
+        click.echo(f'line {line}: {message}' if line else message, err=True)
+    click.echo(f'{result.inserted} inserted, {result.updated} updated, {len(result.errors)} rejected.')
+    if not result.ok:
+        raise SystemExit(1)
+
+@click.command('export-data')
+@click.argument('entity', type=click.Choice(list(bulk_io.ENTITIES)))
+@click.option('--format', 'fmt', type=click.Choice(bulk_io.FORMATS), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-')
+@click.option('--branch', 'branch_code', help='Only this branch; every branch in the database by default.')
+@with_appcontext
+def export_data(entity, fmt, output, branch_code):
+    """Write a table as CSV, JSON or JSON Lines, streamed in batches."""
+    with branches.use(_branch_id(branch_code) if branch_code else None):
+        for chunk in bulk_io.export_chunks(entity, fmt):
+            output.write(chunk)
+
+# Pages whose queries db-check explains. {medicine_id} is filled in from the data.
+DB_CHECK_URLS = [
+    '/dashboard',
+    '/inventory',
+    '/inventory?sort=quantity',
+    '/inventory?sort=expiry',
+    '/inventory?sort=price',
+    '/inventory?category=Tablet&stock=low',
+    '/inventory?stock=out',
+    '/inventory?stock=expired',
+    '/inventory?stock=expiring',
+    '/inventory?stock=expired&sort=name',
+    '/inventory?search=para',
+    '/medicine/{medicine_id}',
+    '/purchase-orders',
+    '/purchase-orders?status=pending',
+    '/purchase-orders?status=draft',
+    '/suppliers',
+    '/sales',
+    '/sales/new',
+    '/reports',
+    '/reports?grain=month',
+    '/reports/download',
+    '/reports/branches',
+    '/reports/export/report.xlsx',
+    '/api/v1/medicines?fields=name,quantity',
+    '/api/v1/medicines?stock=expiring&fields=name,expiry_date',
+    '/api/v1/medicines?ids=1,2,3',
+    '/api/v1/sales?fields=id,sale_date,total_amount',
+    '/api/v1/sales?medicine_id={medicine_id}',
+    '/api/v1/purchase-orders?status=pending',
+    '/api/v1/suppliers',
+    '/api/v1/sync/changes',
+    '/api/v1/sync/changes?since=1',
+]
+
+# Full scans that are expected, keyed by (url, table)
+DB_CHECK_ALLOWED_SCANS = {
+    ('/inventory?stock=expired&sort=name', 'medicine'): 'name order cannot come from the expiry index; the walk stops after one page',
+    ('/inventory?stock=expired', 'medicine'): 'walks the nulls-last expiry index in order; expired rows come first, so it stops after one page',
+    ('/suppliers', 'supplier'): 'the suppliers page lists every supplier',
+    ('/reports', 'medicine'): 'stock value and the per-category stock breakdown sum every medicine',
+    ('/reports?grain=month', 'medicine'): 'stock value and the per-category stock breakdown sum every medicine',
+    ('/reports/branches', 'medicine'): 'stock value sums every medicine of every branch',
+    ('/reports/branches', 'branch'): 'the rollup lists every branch',
+}
+
+@click.command('db-check')
+@with_appcontext
+def db_check():
+    """EXPLAIN QUERY PLAN every page's queries and fail on full table scans."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('db-check reads SQLite query plans; point it at a SQLite database.')
+
+    app = current_app._get_current_object()
+    first_medicine = db.session.query(Medicine.id).order_by(Medicine.id).first()
+    # Plans are read from the primary, so every query has to run there, and
+    # run at all rather than come from the cache
+    app.config['REPLICA_READS'] = False
+    app.extensions.pop('pharmasync_cache', None)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = 0
+        sess['username'] = 'db-check'
+        sess['role'] = branches.ADMIN_ROLE  # for the cross-branch pages
+
+    failures = 0
+    for template in DB_CHECK_URLS:
+        if '{medicine_id}' in template and first_medicine is None:
+            click.echo(f'SKIP {template} (no medicines)')
+            continue
+        url = template.format(medicine_id=first_medicine.id if first_medicine else 0)
+        with capture_selects(db.engine) as statements:
+            # Buffered, so a streamed body's queries run inside the capture
+            response = client.get(url, buffered=True)
+        if response.status_code != 200:
+            click.echo(f'FAIL {url}: HTTP {response.status_code}')
+            failures += 1
+            continue
+
+        with db.engine.connect() as conn:
+            partial = partial_indexes(conn)
+            for statement, parameters in statements:
+                plan = explain(conn, statement, parameters)
+                for table in full_scans(statement, plan, partial):
+                    reason = DB_CHECK_ALLOWED_SCANS.get((template, table))
+                    if reason:
+                        click.echo(f'ok   {url}: full scan of {table} ({reason})')
+                    else:
+                        click.echo(f'FAIL {url}: full scan of {table}\n     {" ".join(statement.split())}')
+                        failures += 1
+        click.echo(f'     {url}: {len(statements)} queries checked')
+
+    if failures:
+        click.echo(f'{failures} problem(s) found.')
+        raise SystemExit(1)
+    click.echo('No unexpected full table scans.')
+
+COMMANDS = (db_upgrade, stats_rebuild, branch_add, branch_list, user_branch, reorder_command, scheduler_command,
+            run_job_command, job_history, stock_as_of, stock_verify, import_data, export_data, db_check)
+
+def init_app(app):
+    for command in COMMANDS:
+        app.cli.add_command(command)
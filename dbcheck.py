@@ -0,0 +1,66 @@
+"""Query plan checks for the SQL the pages actually run.
+
+``capture_selects`` records every SELECT sent to the engine while a block
+runs (e.g. while the test client renders a page); ``full_scans`` reads the
+SQLite plan of one of them and reports the tables it reads end to end.
+"""
+import re
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# "SCAN medicine" (3.36+) / "SCAN TABLE medicine" (older), optionally
+# followed by "USING [COVERING] INDEX ix_...".
+_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(?: USING (COVERING )?INDEX (\w+))?')
+_LIMIT = re.compile(r'\bLIMIT\b', re.IGNORECASE)
+_WHERE = re.compile(r'\bWHERE\b', re.IGNORECASE)
+
+
+@contextmanager
+def capture_selects(engine):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def explain(connection, statement, parameters):
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+    return [row[-1] for row in rows]
+
+
+def partial_indexes(connection):
+    rows = connection.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE '% WHERE %'"
+    )
+    return {row[0] for row in rows}
+
+
+def full_scans(statement, plan, partial=()):
+    """Tables that ``statement`` reads end to end, according to ``plan``.
+
+    Accepted: index-only (covering) scans, scans of a partial index (which
+    only holds the matching rows), virtual-table (full-text) index lookups,
+    and walking an index in order when the query has a LIMIT and nothing to
+    filter on, since it stops after one page.
+    Everything else that SCANs rather than SEARCHes is reported.
+    """
+    bounded_walk = _LIMIT.search(statement) and not _WHERE.search(statement)
+    tables = []
+    for line in plan:
+        match = _SCAN.match(line)
+        if not match or match.group(2) or match.group(3) in partial:
+            continue
+        if 'VIRTUAL TABLE INDEX' in line or match.group(1).startswith('sqlite_'):
+            continue  # FTS lookups plan as a virtual-table "scan"; catalog reads are tiny
+        if match.group(3) and bounded_walk:
+            continue
+        tables.append(match.group(1))
+    return tables
@@ -0,0 +1,203 @@
+"""Engine configuration.
+
+The database comes from the environment (``DATABASE_URL``, falling back to
+a local SQLite file) so each deployment picks its own backend; the queries
+stick to SQL that SQLite and PostgreSQL both run.
+
+Server databases get a connection pool sized per worker process: with
+gunicorn, every worker holds up to ``DB_POOL_SIZE + DB_MAX_OVERFLOW``
+connections, connections are checked with a ping before use and recycled
+before the server or a proxy drops them as idle.
+
+SQLite runs in WAL mode so readers never wait for the writer, and every
+connection gets a busy timeout so a writer waits for the write lock instead
+of failing straight away with "database is locked". The timeout goes in
+through ``SQLALCHEMY_ENGINE_OPTIONS``; WAL and the pragmas that go with it
+are set on each new connection.
+
+When ``DATABASE_REPLICA_URL`` is set it becomes the ``replica`` bind, and
+views wrapped in ``replica_reads`` run their SELECTs there. Writes, flushes
+and anything run on ``db.session.connection()`` stay on the primary. A
+replica may lag the primary, so only pages that can show slightly old
+figures (dashboard, inventory, reports) read from it.
+
+Branches normally share the one database, their rows told apart by
+``branch_id`` (branches.py). A branch listed in ``BRANCH_DATABASES`` keeps
+its data in a database of its own instead: it becomes the ``branch-<id>``
+bind, and while that branch is current every statement goes there except
+those on the tables all branches share (users, branches, the scheduler's).
+
+Engines are created with the app but connect on first use. If a process
+that already holds connections forks (a gunicorn master with
+``preload_app`` that touched the database), each child calls
+``after_fork`` so it opens its own instead of sharing the parent's sockets.
+"""
+from functools import wraps
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql import Select
+from sqlalchemy.sql.util import find_tables
+
+REPLICA_BIND = 'replica'
+BRANCH_BIND_PREFIX = 'branch-'
+DEFAULT_BRANCH = 1
+
+# Tables kept in the primary database even for a branch with its own
+SHARED_TABLES = frozenset(('user', 'branch', 'job_run', 'scheduler_lock', 'schema_version'))
+
+
+def database_url(url):
+    """Normalize a URL from the environment; ``postgres://`` is what many hosts hand out."""
+    if url and url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def is_sqlite(uri):
+    return make_url(uri).get_backend_name() == 'sqlite'
+
+
+def _is_memory(uri):
+    return is_sqlite(uri) and make_url(uri).database in (None, '', ':memory:')
+
+
+def engine_options(config, uri=None):
+    """``SQLALCHEMY_ENGINE_OPTIONS`` for the configured database (or ``uri``)."""
+    uri = uri or config['SQLALCHEMY_DATABASE_URI']
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    connect_args = dict(options.get('connect_args') or {})
+    if is_sqlite(uri):
+        # sqlite3's timeout is the busy timeout, in seconds
+        connect_args.setdefault('timeout', config['SQLITE_BUSY_TIMEOUT'])
+    options['connect_args'] = connect_args
+    if not _is_memory(uri):
+        # In-memory SQLite lives in a single connection and cannot be pooled
+        options.setdefault('pool_size', config['DB_POOL_SIZE'])
+        options.setdefault('max_overflow', config['DB_MAX_OVERFLOW'])
+        options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+        options.setdefault('pool_recycle', config['DB_POOL_RECYCLE'])
+        options.setdefault('pool_pre_ping', True)
+    return options
+
+
+def branch_databases(value):
+    """``{branch_id: url}`` from ``BRANCH_DATABASES``: ``2=sqlite:///branch2.db;3=postgresql://...``."""
+    result = {}
+    for item in (value or '').split(';'):
+        if item.strip():
+            branch_id, _, url = item.partition('=')
+            result[int(branch_id)] = database_url(url.strip())
+    return result
+
+
+def branch_bind(branch_id):
+    return f'{BRANCH_BIND_PREFIX}{branch_id}'
+
+
+def binds(config):
+    """``SQLALCHEMY_BINDS``: the read replica and per-branch databases, when configured."""
+    result = dict(config.get('SQLALCHEMY_BINDS') or {})
+    # Bind options are merged over SQLALCHEMY_ENGINE_OPTIONS, so each bind
+    # states all of its own (its backend may differ)
+    own = {**config, 'SQLALCHEMY_ENGINE_OPTIONS': None}
+    replica = database_url(config.get('DATABASE_REPLICA_URL'))
+    if replica:
+        result[REPLICA_BIND] = dict(engine_options(own, replica), url=replica)
+    for branch_id, url in (config.get('BRANCH_DATABASES') or {}).items():
+        result[branch_bind(branch_id)] = dict(engine_options(own, url), url=url)
+    return result
+
+
+def branch_engines(db):
+    """``{branch_id: engine}`` for the branches with a database of their own."""
+    return {int(key[len(BRANCH_BIND_PREFIX):]): engine for key, engine in db.engines.items()
+            if key and key.startswith(BRANCH_BIND_PREFIX)}
+
+
+# ==================== READ REPLICA ====================
+
+def replica_reads(view):
+    """Send the view's SELECTs to the read replica, if there is one."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.replica_reads = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _use_replica():
+    return (has_app_context() and g.get('replica_reads', False)
+            and current_app.config.get('REPLICA_READS', True))
+
+
+# ==================== BRANCHES ====================
+
+def current_branch():
+    """The branch the current request or ``branches.use()`` block works in; None for all."""
+    return g.get('branch_id') if has_app_context() else None
+
+
+def _shared(mapper, clause):
+    if mapper is not None:
+        return mapper.local_table.name in SHARED_TABLES
+    if clause is not None:
+        tables = find_tables(clause, include_crud=True)
+        return bool(tables) and all(table.name in SHARED_TABLES for table in tables)
+    return False
+
+
+def _branch_engine(db, mapper, clause):
+    branch_id = current_branch()
+    if branch_id is None:
+        return None
+    engine = db.engines.get(branch_bind(branch_id))
+    if engine is None or _shared(mapper, clause):
+        return None
+    return engine
+
+
+class RoutingSession(Session):
+    """``db.session`` routed to the current branch's own database, if it has one, and
+    to the replica for SELECTs inside ``replica_reads`` views."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            engine = _branch_engine(self._db, mapper, clause)
+            if engine is not None:
+                return engine
+        if bind is None and not self._flushing and isinstance(clause, Select) and _use_replica():
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+# ==================== CONNECTION SETUP ====================
+
+def _sqlite_pragmas(wal):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if wal:
+            # Persistent in the file; ignored for in-memory databases
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
+    return on_connect
+
+
+def init_app(app, db):
+    """Attach the per-connection setup to the app's engines."""
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', _sqlite_pragmas(app.config['SQLITE_WAL']))
+
+
+def after_fork(app, db):
+    """Forget pooled connections inherited from the parent, without closing them for it."""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
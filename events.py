@@ -0,0 +1,251 @@
+"""Live stock changes, pushed to the counter terminals as Server-Sent Events.
+
+Every committed change to a medicine's stock -- a sale at a till or through
+the POS API, a completed purchase order, an edit -- is published as one
+small event::
+
+    {"medicine_id": 12, "quantity": 37, "delta": -3, "reorder_level": 10}
+
+and the inventory, dashboard and new-sale pages, which keep ``/live/stock``
+open, update that one row in place (templates/live_stock.html) instead of
+being reloaded and running every query again. Events are tagged with the
+branch they happened in and a stream only sends its own branch's.
+
+Events are queued on the session as the writes happen and published from
+``after_commit``, so a sale that is rolled back (out of stock, a lock
+retried by ``stock.with_retry``) is never announced. Each event has an id.
+A page opens the stream after the last event id it was rendered with, and
+a browser that reconnects sends the last id it saw (``Last-Event-ID``), so
+nothing in between is lost. When the broker has already dropped those
+events, the browser gets ``resync`` and reloads instead. An id the broker
+cannot place -- from another worker's in-process broker, or from before a
+restart -- resumes from the broker's latest event rather than reloading:
+the page may have come from another worker, or from the shared page cache,
+and this process never had anything in between to send. Pages cached by
+``cache.cached_page`` get the id when they are served, not the one they
+were first rendered with (``cache.volatile``).
+
+The default broker lives in the process: a deque of the latest events and
+one ``threading.Event`` every stream waits on, so an idle terminal costs a
+waiting thread or greenlet and nothing per event. It only reaches terminals
+connected to the same process. With several workers, set ``EVENTS_URL`` to a
+Redis server (needs the ``redis`` package) and events go through a Redis
+stream shared by all of them. Any other broker needs only ``publish``,
+``last_id``, ``resume`` and ``read``.
+
+An open stream occupies whatever serves it, so on sync gunicorn workers
+every terminal would hold a worker. gunicorn.conf.py runs gevent workers,
+where a waiting stream is a parked greenlet. A stream never holds a
+database connection, and it ends after ``EVENTS_STREAM_SECONDS``; the
+browser then reconnects where it left off.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+
+from models import db
+import cache
+import dbconfig
+
+_PENDING = 'stock_events'
+
+# Milliseconds a browser waits before reconnecting a closed stream
+RETRY_MS = 3000
+
+
+# ==================== BROKERS ====================
+
+class LocalBroker:
+    """The latest ``backlog`` events of this process, waited on by its streams."""
+
+    def __init__(self, backlog):
+        self.backlog = backlog
+        self._reset()
+
+    def _reset(self):
+        # Ids are only meaningful within one process; a forked worker starts afresh
+        self._pid = os.getpid()
+        self._epoch = uuid.uuid4().hex[:8]
+        self._events = deque(maxlen=self.backlog)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        # Set and replaced on every publish: waking the streams takes no lock,
+        # where a Condition would hand its lock to each of them in turn
+        self._published = threading.Event()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def publish(self, data, branch_id=None):
+        self._check_fork()
+        with self._lock:
+            self._sequence += 1
+            self._events.append((self._sequence, branch_id, data))
+            published, self._published = self._published, threading.Event()
+        published.set()
+
+    def last_id(self):
+        self._check_fork()
+        return f'{self._epoch}-{self._sequence}'
+
+    def resume(self, after):
+        """``after``, or the latest id when it comes from another process."""
+        self._check_fork()
+        epoch, _, number = (after or '').partition('-')
+        return after if epoch == self._epoch and number.isdigit() else self.last_id()
+
+    def read(self, after, timeout):
+        """``([(id, branch_id, data), ...], complete)`` for the events after ``after``.
+
+        Waits up to ``timeout`` seconds when there are none yet. ``complete``
+        is False when some of them are no longer kept, or ``after`` comes
+        from another process (``resume`` it first).
+        """
+        self._check_fork()
+        epoch, _, number = (after or '').partition('-')
+        if epoch != self._epoch or not number.isdigit():
+            return [], False
+        after = int(number)
+        published = self._published
+        if self._sequence == after:
+            published.wait(timeout)
+        with self._lock:
+            kept = list(self._events)
+            sequence = self._sequence
+        oldest = kept[0][0] if kept else sequence + 1
+        if after > sequence or after < oldest - 1:
+            return [], False
+        return [(f'{self._epoch}-{n}', branch_id, data)
+                for n, branch_id, data in kept[after - oldest + 1:]], True
+
+
+class RedisBroker:
+    """Events in a Redis stream, shared by every worker."""
+
+    def __init__(self, url, backlog, key='pharmasync:stock-events'):
+        # Optional dependency: only needed when EVENTS_URL is set
+        import redis
+        self._redis = redis.Redis.from_url(url)
+        self.backlog = backlog
+        self.key = key
+
+    @staticmethod
+    def _order(event_id):
+        milliseconds, _, sequence = event_id.partition('-')
+        return int(milliseconds), int(sequence or 0)
+
+    def publish(self, data, branch_id=None):
+        fields = {'data': data} if branch_id is None else {'data': data, 'branch': branch_id}
+        self._redis.xadd(self.key, fields, maxlen=self.backlog, approximate=True)
+
+    def last_id(self):
+        last = self._redis.xrevrange(self.key, count=1)
+        return last[0][0].decode() if last else '0-0'
+
+    def resume(self, after):
+        try:
+            self._order(after or '')
+        except ValueError:
+            return self.last_id()
+        return after
+
+    def read(self, after, timeout):
+        try:
+            position = self._order(after)
+        except ValueError:
+            return [], False
+        first = self._redis.xrange(self.key, count=1)
+        if first and after != '0-0' and self._order(first[0][0].decode()) > position:
+            return [], False
+        reply = self._redis.xread({self.key: after}, count=self.backlog, block=int(timeout * 1000))
+        return [(event_id.decode(), int(fields[b'branch']) if b'branch' in fields else None,
+                 fields[b'data'].decode())
+                for _, entries in reply for event_id, fields in entries], True
+
+
+def broker(app=None):
+    app = app or current_app
+    return app.extensions.get('pharmasync_events')
+
+
+def last_event_id():
+    """The id a page rendered now should open its stream after."""
+    return broker().last_id()
+
+
+# ==================== PUBLISHING ====================
+
+def stock_changed(medicine_id, quantity, delta, reorder_level):
+    """Announce a medicine's new stock to its branch once the current transaction commits."""
+    db.session.info.setdefault(_PENDING, []).append((dbconfig.current_branch(), dict(
+        medicine_id=medicine_id, quantity=quantity, delta=delta, reorder_level=reorder_level)))
+
+
+@event.listens_for(db.session, 'after_commit')
+def _publish(session):
+    pending = session.info.pop(_PENDING, None)
+    if not pending or not has_app_context() or broker() is None:
+        return
+    try:
+        for branch_id, payload in pending:
+            # Encoded once here rather than by every stream that sends it
+            broker().publish(json.dumps(payload, separators=(',', ':')), branch_id)
+    except Exception:
+        # The change is committed; a terminal that misses it catches up on reload
+        current_app.logger.exception('Publishing %d stock event(s) failed', len(pending))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard(session):
+    session.info.pop(_PENDING, None)
+
+
+# ==================== STREAM ====================
+
+def _message(name, data, event_id=None):
+    head = f'id: {event_id}\n' if event_id else ''
+    return f'{head}event: {name}\ndata: {data}\n\n'
+
+
+def stream(source, after, heartbeat, lifetime, branch_id=None):
+    """The ``text/event-stream`` body: events after ``after`` for ``lifetime`` seconds.
+
+    With ``branch_id``, only that branch's events (and untagged ones) are sent.
+
+    An idle stream sends a comment every ``heartbeat`` seconds, which keeps
+    proxies from closing it and ends the generator once the browser is gone.
+    """
+    yield f'retry: {RETRY_MS}\n\n'
+    ends = time.monotonic() + lifetime
+    while time.monotonic() < ends:
+        events, complete = source.read(after, min(heartbeat, max(ends - time.monotonic(), 0)))
+        if not complete:
+            yield _message('resync', '{}')
+            return
+        sent = False
+        for event_id, event_branch, data in events:
+            after = event_id
+            if branch_id is None or event_branch is None or event_branch == branch_id:
+                yield _message('stock', data, event_id)
+                sent = True
+        if not sent:
+            yield ': keep-alive\n\n'
+
+
+# ==================== SETUP ====================
+
+def init_app(app):
+    """Create the configured broker and give templates ``live_stock_since()``."""
+    if app.config['EVENTS_URL']:
+        app.extensions['pharmasync_events'] = RedisBroker(app.config['EVENTS_URL'], app.config['EVENTS_BACKLOG'])
+    else:
+        app.extensions['pharmasync_events'] = LocalBroker(app.config['EVENTS_BACKLOG'])
+    # Filled in as each page is served, cached ones too
+    app.add_template_global(cache.volatile('live_stock_since', last_event_id), 'live_stock_since')
@@ -0,0 +1,56 @@
+"""Medicine list filters shared by the inventory page and the JSON API.
+
+Both take the same query-string parameters (``search``, ``category``,
+``stock``, ``sort``) and must agree on what they mean, so the conditions
+and the keyset orderings are defined once here.
+"""
+from datetime import date, timedelta
+
+from listing import SortKey
+from models import Medicine
+import search as medicine_search
+
+EXPIRING_DAYS = 30
+
+MEDICINE_SORTS = {
+    'name': [SortKey(Medicine.name), SortKey(Medicine.id)],
+    'quantity': [SortKey(Medicine.quantity, descending=True), SortKey(Medicine.id)],
+    # Medicines without an expiry date go last
+    'expiry': [SortKey(Medicine.expiry_date.is_(None), value=lambda m: m.expiry_date is None),
+               SortKey(Medicine.expiry_date), SortKey(Medicine.id)],
+    'price': [SortKey(Medicine.price, descending=True), SortKey(Medicine.id)],
+}
+
+
+def medicine_conditions(search='', category='', stock_status='', today=None):
+    """WHERE clauses for the inventory filters; empty values filter nothing."""
+    today = today or date.today()
+    conditions = []
+    if search:
+        # Full-text index lookup (prefix + typo tolerant), see search.py
+        conditions.append(medicine_search.filter_clause(search))
+    if category and category != 'all':
+        conditions.append(Medicine.category == category)
+    if stock_status == 'low':
+        conditions.append(Medicine.quantity <= Medicine.reorder_level)
+    elif stock_status == 'out':
+        conditions.append(Medicine.quantity == 0)
+    elif stock_status == 'expired':
+        conditions.append(Medicine.expiry_date < today)
+    elif stock_status == 'expiring':
+        conditions.append(Medicine.expiry_date.between(today, today + timedelta(days=EXPIRING_DAYS)))
+    return conditions
+
+
+def medicine_sort(args):
+    """``(name, keys)`` for the requested sort.
+
+    Expiry filters list soonest first unless asked otherwise, so the expiry
+    index both filters and orders the page.
+    """
+    sort = args.get('sort', 'name')
+    if args.get('stock') in ('expired', 'expiring') and 'sort' not in args:
+        sort = 'expiry'
+    if sort not in MEDICINE_SORTS:
+        sort = 'name'
+    return sort, MEDICINE_SORTS[sort]
@@ -0,0 +1,57 @@
+"""gunicorn settings, read from the working directory: ``gunicorn -w 4 app:app``.
+
+The master imports the app once (``preload_app``) and forks every worker
+from it, so the workers start without importing Flask, SQLAlchemy and the
+models again and share those pages with the master until they write to
+them. Building the app opens no connections and starts no threads (see
+app.py); ``post_fork`` still drops any pooled connection a worker might
+inherit, and ``pre_fork`` moves everything the master has allocated out of
+reach of the garbage collector, whose bookkeeping writes would otherwise
+copy the shared pages into every worker.
+
+The PDF renderer and NumPy are left out of the app's imports (see
+``report_jobs.pdf_renderer`` and ``analytics.numpy``), but any worker may
+render a report, so the master imports them once in ``on_starting``
+rather than each worker importing its own copy.
+
+Workers are gevent workers. The inventory, dashboard and new-sale pages
+keep ``/live/stock`` open (events.py); on a sync worker each open page
+would hold a whole worker for ``EVENTS_STREAM_SECONDS``, so four terminals
+would take every worker of ``-w 4``. Here an open stream is a parked
+greenlet, and a worker holds up to ``worker_connections`` of them. The
+standard library is patched as gunicorn reads this file, before
+``preload_app`` imports the app, so the locks, connection pools and events
+the app creates are gevent's.
+"""
+import gc
+import sys
+
+preload_app = True
+worker_class = 'gevent'
+worker_connections = 1000
+
+if 'gunicorn' in sys.modules:
+    # Only when gunicorn reads this file; bench/startup.py runs its hooks unpatched
+    from gevent import monkey
+
+    monkey.patch_all()
+
+
+def on_starting(server):
+    import analytics
+    import report_jobs
+
+    report_jobs.pdf_renderer()
+    analytics.numpy()
+
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from app import app
+    from models import db
+    import dbconfig
+
+    dbconfig.after_fork(app, db)
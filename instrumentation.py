@@ -0,0 +1,262 @@
+"""Per-request performance instrumentation.
+
+Every request records how many SQL statements it ran, the time spent in the
+database, the time spent rendering templates and the total. The figures go
+out two ways:
+
+* a ``Server-Timing`` header on each response, so the browser's network tab
+  shows ``db``, ``render`` and ``total`` for that page;
+* ``/metrics`` in the Prometheus text format, aggregated per endpoint:
+  request counts and latency histograms, and a histogram of statements per
+  request that makes N+1 loops (a lazy load per row in a template) stand out.
+
+Statements slower than ``SLOW_QUERY_MS`` are logged and the latest
+``SLOW_QUERY_SAMPLES`` of them kept with their SQL, readable as JSON from
+``/metrics/slow-queries``.
+
+Both show every branch's traffic and the SQL text, so they are for signed-in
+admins and for a scraper sending ``Authorization: Bearer <METRICS_TOKEN>``;
+anyone else gets a 404 (a 401 once a token is set).
+
+The hooks are SQLAlchemy's ``before/after_cursor_execute``, Flask's
+``before_render_template``/``template_rendered`` signals and the request
+lifecycle. Each costs a couple of ``perf_counter()`` calls, and the
+aggregates are dictionary updates under one lock, so this is left on in
+production. Metrics are per process; with several gunicorn workers each
+worker is scraped on its own.
+"""
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+from flask import abort, current_app, g, has_request_context, jsonify, request, session
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+import branches
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250)
+
+_QUERY_STARTS = 'instrumentation_query_starts'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+
+
+class Metrics:
+    """Aggregates for one process, keyed by endpoint."""
+
+    def __init__(self, slow_samples):
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)  # (endpoint, method, status) -> count
+        self.duration = defaultdict(lambda: Histogram(DURATION_BUCKETS))
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))
+        self.db_seconds = defaultdict(float)
+        self.render_seconds = defaultdict(float)
+        self.slow_queries = deque(maxlen=slow_samples)
+
+    def record(self, endpoint, method, status, timing, elapsed):
+        with self.lock:
+            self.requests[endpoint, method, status] += 1
+            self.duration[endpoint].observe(elapsed)
+            self.queries[endpoint].observe(timing.queries)
+            self.db_seconds[endpoint] += timing.db
+            self.render_seconds[endpoint] += timing.render
+
+
+class RequestTiming:
+    __slots__ = ('start', 'queries', 'db', 'render', 'render_start')
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.render = 0.0
+        self.render_start = []
+
+
+def metrics(app=None):
+    return (app or current_app).extensions['pharmasync_metrics']
+
+
+def _timing():
+    return g.get('_timing') if has_request_context() else None
+
+
+def _endpoint():
+    # The route, not the path, so 404s and ids don't explode the label set
+    return request.url_rule.endpoint if request.url_rule else 'unmatched'
+
+
+# ==================== SQL ====================
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault(_QUERY_STARTS, []).append(time.perf_counter())
+
+
+def _after_cursor_execute(app):
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get(_QUERY_STARTS)
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        timing = _timing()
+        if timing is not None:
+            timing.queries += 1
+            timing.db += elapsed
+        if elapsed * 1000 >= app.config['SLOW_QUERY_MS']:
+            endpoint = _endpoint() if has_request_context() else None
+            sample = dict(endpoint=endpoint, ms=round(elapsed * 1000, 2),
+                          sql=' '.join(statement.split()), at=datetime.utcnow().isoformat())
+            metrics(app).slow_queries.append(sample)
+            app.logger.warning('Slow query (%.1f ms) in %s: %s', sample['ms'], endpoint, sample['sql'])
+    return after_cursor_execute
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None:
+        starts = context.connection.info.get(_QUERY_STARTS)
+        if starts:
+            starts.pop()
+
+
+# ==================== TEMPLATES ====================
+
+def _render_started(sender, template, context, **extra):
+    timing = _timing()
+    if timing is not None:
+        timing.render_start.append(time.perf_counter())
+
+
+def _render_finished(sender, template, context, **extra):
+    timing = _timing()
+    if timing is not None and timing.render_start:
+        started = timing.render_start.pop()
+        # Nested renders are already inside the outer one
+        if not timing.render_start:
+            timing.render += time.perf_counter() - started
+
+
+# ==================== REQUESTS ====================
+
+def _start_request():
+    g._timing = RequestTiming()
+
+
+def _finish_request(response):
+    timing = _timing()
+    if timing is None:
+        return response
+    elapsed = time.perf_counter() - timing.start
+    endpoint = _endpoint()
+    if endpoint not in ('metrics', 'slow_queries'):
+        metrics().record(endpoint, request.method, response.status_code, timing, elapsed)
+    if current_app.config['SERVER_TIMING']:
+        response.headers.add('Server-Timing', server_timing(timing, elapsed))
+    return response
+
+
+def server_timing(timing, elapsed):
+    return (f'db;dur={timing.db * 1000:.1f};desc="{timing.queries} queries", '
+            f'render;dur={timing.render * 1000:.1f}, '
+            f'total;dur={elapsed * 1000:.1f}')
+
+
+# ==================== EXPOSITION ====================
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def _histogram_lines(name, endpoint, histogram):
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        yield f'{name}_bucket{_labels(endpoint=endpoint, le=bound)} {count}'
+    yield f'{name}_bucket{_labels(endpoint=endpoint, le="+Inf")} {histogram.total}'
+    yield f'{name}_sum{_labels(endpoint=endpoint)} {histogram.sum}'
+    yield f'{name}_count{_labels(endpoint=endpoint)} {histogram.total}'
+
+
+def render_metrics(data):
+    """The aggregates in the Prometheus text exposition format."""
+    with data.lock:
+        lines = ['# HELP pharmasync_requests_total Requests handled.',
+                 '# TYPE pharmasync_requests_total counter']
+        for (endpoint, method, status), count in sorted(data.requests.items()):
+            lines.append(f'pharmasync_requests_total{_labels(endpoint=endpoint, method=method, status=status)} {count}')
+
+        lines += ['# HELP pharmasync_request_duration_seconds Time to build the response.',
+                  '# TYPE pharmasync_request_duration_seconds histogram']
+        for endpoint, histogram in sorted(data.duration.items()):
+            lines.extend(_histogram_lines('pharmasync_request_duration_seconds', endpoint, histogram))
+
+        lines += ['# HELP pharmasync_request_queries SQL statements per request.',
+                  '# TYPE pharmasync_request_queries histogram']
+        for endpoint, histogram in sorted(data.queries.items()):
+            lines.extend(_histogram_lines('pharmasync_request_queries', endpoint, histogram))
+
+        lines += ['# HELP pharmasync_db_seconds_total Time spent in SQL statements.',
+                  '# TYPE pharmasync_db_seconds_total counter']
+        for endpoint, seconds in sorted(data.db_seconds.items()):
+            lines.append(f'pharmasync_db_seconds_total{_labels(endpoint=endpoint)} {seconds}')
+
+        lines += ['# HELP pharmasync_render_seconds_total Time spent rendering templates.',
+                  '# TYPE pharmasync_render_seconds_total counter']
+        for endpoint, seconds in sorted(data.render_seconds.items()):
+            lines.append(f'pharmasync_render_seconds_total{_labels(endpoint=endpoint)} {seconds}')
+
+        lines += ['# HELP pharmasync_slow_query_samples Slow statements held in /metrics/slow-queries.',
+                  '# TYPE pharmasync_slow_query_samples gauge',
+                  f'pharmasync_slow_query_samples {len(data.slow_queries)}']
+    return '\n'.join(lines) + '\n'
+
+
+def _check_access():
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') == f'Bearer {token}':
+        return
+    if session.get('role') != branches.ADMIN_ROLE:
+        abort(401 if token else 404)
+
+
+def metrics_view():
+    _check_access()
+    return current_app.response_class(render_metrics(metrics()),
+                                      mimetype='text/plain; version=0.0.4')
+
+
+def slow_queries_view():
+    _check_access()
+    return jsonify(list(metrics().slow_queries))
+
+
+# ==================== SETUP ====================
+
+def init_app(app, db):
+    """Hook the app's engines, templates and requests, and add the metrics routes."""
+    app.extensions['pharmasync_metrics'] = Metrics(app.config['SLOW_QUERY_SAMPLES'])
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute(app))
+            event.listen(engine, 'handle_error', _handle_error)
+    before_render_template.connect(_render_started, app)
+    template_rendered.connect(_render_finished, app)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    app.add_url_rule('/metrics/slow-queries', 'slow_queries', slow_queries_view)
@@ -0,0 +1,87 @@
+"""The scheduled jobs (see scheduler.py for how and where they run).
+
+Jobs run outside any branch, so they cover every branch in the shared
+database, and ``branches.databases()`` repeats them in each branch's own
+database when there are any.
+"""
+import os
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import delete, select, update
+
+from models import db, JobRun, PurchaseOrder, ReportJob
+from scheduler import job
+import branches
+import filters
+import ledger
+import reorder
+import stats as dashboard_stats
+import sync
+
+
+@job('expiry-sweep', at='00:05')
+def expiry_sweep(app):
+    """Move the dashboard to the new day and count expired/expiring batch stock."""
+    results = [dashboard_stats.sweep_expiry(db.session.connection(), date.today(), filters.EXPIRING_DAYS)
+               for _ in branches.databases()]
+    return results[0] if len(results) == 1 else results
+
+
+@job('daily-sales-rollup', at='00:15')
+def daily_sales_rollup(app):
+    """Roll yesterday's sales (and late imports) into the per-medicine daily table."""
+    days = [dashboard_stats.roll_up(db.session.connection(), date.today(),
+                                    lookback=app.config['ROLLUP_LOOKBACK_DAYS'])
+            for _ in branches.databases()]
+    return f'{max(days)} day(s) rolled'
+
+
+@job('stock-snapshot', at='00:30')
+def stock_snapshot(app):
+    """Checkpoint the stock ledger once the last checkpoint is STOCK_SNAPSHOT_DAYS old."""
+    taken = [ledger.checkpoint_if_due(db.session.connection(), app.config['STOCK_SNAPSHOT_DAYS'])
+             for _ in branches.databases()]
+    return ', '.join(f'checkpoint {checkpoint_id}' if checkpoint_id else 'not due' for checkpoint_id in taken)
+
+
+@job('reorder', at='06:00')
+def reorder_drafts(app):
+    results = [reorder.run() for _ in branches.databases()]
+    return (f'{sum(r.orders_created for r in results)} draft(s), '
+            f'{sum(len(r.no_supplier) for r in results)} without a supplier')
+
+
+@job('cleanup', at='03:00')
+def cleanup(app):
+    """Discard stale automatic drafts, old report files, old changefeed tombstones and old run history."""
+    config = app.config
+    now = datetime.utcnow()
+    drafts = reports = tombstones = 0
+    for _ in branches.databases():
+        # Unapproved drafts count as on order and would hold back fresh ones
+        drafts += db.session.execute(
+            update(PurchaseOrder.__table__)
+            .where(PurchaseOrder.status == 'draft',
+                   PurchaseOrder.order_date < now - timedelta(days=config['REORDER_DRAFT_DAYS']))
+            .values(status='cancelled')
+        ).rowcount
+
+        old_reports = db.session.execute(
+            select(ReportJob.id, ReportJob.file_path)
+            .where(ReportJob.status.in_(('done', 'failed')),
+                   ReportJob.created_at < now - timedelta(days=config['REPORT_RETENTION_DAYS']))
+        ).all()
+        for _, path in old_reports:
+            if path and os.path.exists(path):
+                os.unlink(path)
+        if old_reports:
+            db.session.execute(delete(ReportJob.__table__)
+                               .where(ReportJob.id.in_([job_id for job_id, _ in old_reports])))
+        reports += len(old_reports)
+        tombstones += sync.prune_tombstones(now - timedelta(days=config['SYNC_TOMBSTONE_DAYS']))
+
+    runs = db.session.execute(
+        delete(JobRun.__table__)
+        .where(JobRun.started_at < now - timedelta(days=config['SCHEDULER_HISTORY_DAYS']))
+    ).rowcount
+    return dict(stale_drafts=drafts, report_files=reports, tombstones=tombstones, job_runs=runs)
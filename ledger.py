@@ -0,0 +1,240 @@
+"""The stock ledger: every change to a medicine's quantity, in order.
+
+``Medicine.quantity`` is the stock now, updated in place. Every write that
+changes it also appends a ``StockMovement`` in the same transaction: the
+delta, the balance it left, why (``SALE``, ``RECEIPT``, ``ADJUSTMENT``,
+...), the order or import behind it and the user who made it. A movement
+is never changed or deleted -- on SQLite triggers reject UPDATE and DELETE
+(elsewhere, grant the application INSERT and SELECT only) -- so rows only
+ever go on the end of the table and of its ``created_at`` indexes.
+
+Replaying the ledger from the start to answer "what was in stock on
+date X" would read the whole history, so checkpoints record every
+medicine's quantity at a moment (``StockCheckpoint`` and its
+``StockSnapshot`` rows, zeros left out). The ``stock-snapshot`` job adds
+one every ``STOCK_SNAPSHOT_DAYS``, built from the previous checkpoint plus
+the movements since in one INSERT ... SELECT. ``as_of(when)`` starts from
+the checkpoint nearest ``when`` and adds (or, from a later checkpoint,
+takes back) only the movements in between.
+
+The first checkpoint holds the stock as it was when the ledger began
+(migration 7); nothing earlier can be rebuilt. ``verify()`` compares the
+ledger with the medicines, and ``correct()`` records an adjustment for each
+difference it finds (stock changed by raw SQL, data loaded before the
+ledger existed).
+"""
+from datetime import datetime, timedelta
+
+from flask import has_request_context, session
+from sqlalchemy import func, insert, literal, select, union_all, update
+
+from models import Medicine, StockCheckpoint, StockMovement, StockSnapshot
+
+SALE = 'sale'
+RECEIPT = 'receipt'
+ADJUSTMENT = 'adjustment'
+IMPORT = 'import'
+OPENING = 'opening'
+REMOVAL = 'removal'
+
+# Movements are stamped when written, before their transaction commits, so a
+# checkpoint stays this far behind the clock to include every one in flight
+SETTLE = timedelta(minutes=5)
+
+movement_table = StockMovement.__table__
+checkpoint_table = StockCheckpoint.__table__
+snapshot_table = StockSnapshot.__table__
+medicine_table = Medicine.__table__
+
+APPEND_ONLY_SQL = [
+    """CREATE TRIGGER IF NOT EXISTS stock_movement_no_update BEFORE UPDATE ON stock_movement BEGIN
+        SELECT RAISE(ABORT, 'stock_movement is append-only');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS stock_movement_no_delete BEFORE DELETE ON stock_movement BEGIN
+        SELECT RAISE(ABORT, 'stock_movement is append-only');
+    END""",
+]
+
+
+def protect(conn):
+    """Make the ledger append-only (SQLite)."""
+    if conn.dialect.name == 'sqlite':
+        for statement in APPEND_ONLY_SQL:
+            conn.exec_driver_sql(statement)
+
+
+# ==================== MOVEMENTS ====================
+
+def _user_id():
+    return session.get('user_id') if has_request_context() else None
+
+
+def record(conn, reason, changes, reference=None):
+    """Append ``[(medicine_id, delta, balance), ...]``; zero deltas are skipped.
+
+    Call it in the transaction that changes the quantities. Returns the
+    number of movements written.
+    """
+    now = datetime.utcnow()
+    user_id = _user_id()
+    rows = [dict(medicine_id=medicine_id, delta=delta, balance=balance, reason=reason,
+                 reference=reference, user_id=user_id, created_at=now)
+            for medicine_id, delta, balance in changes if delta]
+    if rows:
+        conn.execute(insert(movement_table), rows)
+    return len(rows)
+
+
+def history(conn, medicine_id, since=None, limit=10):
+    """A medicine's latest movements, newest first.
+
+    SQLite may give a new medicine the id of a deleted one; pass its
+    ``created_at`` as ``since`` to leave out the old one's history.
+    """
+    stmt = select(movement_table).where(movement_table.c.medicine_id == medicine_id)
+    if since is not None:
+        stmt = stmt.where(movement_table.c.created_at >= since)
+    return conn.execute(
+        stmt.order_by(movement_table.c.created_at.desc(), movement_table.c.id.desc()).limit(limit)
+    ).all()
+
+
+# ==================== CHECKPOINTS ====================
+
+def _snapshot(checkpoint_id, medicine_ids=None):
+    stmt = select(snapshot_table.c.medicine_id, snapshot_table.c.quantity) \
+        .where(snapshot_table.c.checkpoint_id == checkpoint_id)
+    if medicine_ids is not None:
+        stmt = stmt.where(snapshot_table.c.medicine_id.in_(medicine_ids))
+    return stmt
+
+
+def _movements(start, end=None, sign=1, medicine_ids=None):
+    """Movements stamped from ``start`` up to (not including) ``end``, as quantities."""
+    stmt = select(movement_table.c.medicine_id, (movement_table.c.delta * sign).label('quantity')) \
+        .where(movement_table.c.created_at >= start)
+    if end is not None:
+        stmt = stmt.where(movement_table.c.created_at < end)
+    if medicine_ids is not None:
+        stmt = stmt.where(movement_table.c.medicine_id.in_(medicine_ids))
+    return stmt
+
+
+def _totals(*parts):
+    both = union_all(*parts).subquery()
+    return select(both.c.medicine_id, func.sum(both.c.quantity).label('quantity')) \
+        .group_by(both.c.medicine_id)
+
+
+def _nearest(conn, when, later=False):
+    taken_at = checkpoint_table.c.taken_at
+    return conn.execute(
+        select(checkpoint_table)
+        .where(taken_at > when if later else taken_at <= when)
+        .order_by(taken_at if later else taken_at.desc())
+        .limit(1)
+    ).first()
+
+
+def _write_checkpoint(conn, taken_at, quantities):
+    """Store ``quantities`` (a SELECT of medicine_id, quantity) as the checkpoint at ``taken_at``."""
+    checkpoint_id = conn.execute(insert(checkpoint_table).values(
+        taken_at=taken_at, created_at=datetime.utcnow())).inserted_primary_key[0]
+    rows = quantities.subquery()
+    conn.execute(insert(snapshot_table).from_select(
+        ['checkpoint_id', 'medicine_id', 'quantity'],
+        select(literal(checkpoint_id), rows.c.medicine_id, rows.c.quantity).where(rows.c.quantity != 0)
+    ))
+    medicines, units = conn.execute(
+        select(func.count(), func.coalesce(func.sum(snapshot_table.c.quantity), 0))
+        .where(snapshot_table.c.checkpoint_id == checkpoint_id)
+    ).one()
+    conn.execute(update(checkpoint_table).where(checkpoint_table.c.id == checkpoint_id)
+                 .values(medicines=medicines, units=units))
+    return checkpoint_id
+
+
+def open_ledger(conn, at=None):
+    """The first checkpoint: the stock as it is now. Does nothing once there is one."""
+    if conn.execute(select(checkpoint_table.c.id).limit(1)).first() is not None:
+        return None
+    return _write_checkpoint(conn, at or datetime.utcnow(),
+                             select(medicine_table.c.id.label('medicine_id'), medicine_table.c.quantity))
+
+
+def checkpoint(conn, at=None):
+    """Record every medicine's stock as of ``at`` (default ``SETTLE`` ago); returns its id."""
+    at = at or datetime.utcnow() - SETTLE
+    previous = _nearest(conn, at)
+    if previous is None:
+        raise LookupError(f'No stock checkpoint at or before {at:%Y-%m-%d %H:%M}; the ledger starts later.')
+    if previous.taken_at == at:
+        return previous.id
+    return _write_checkpoint(conn, at, _totals(_snapshot(previous.id), _movements(previous.taken_at, at)))
+
+
+def checkpoint_if_due(conn, every_days):
+    """Take a checkpoint when the latest is ``every_days`` old; returns its id or None."""
+    at = datetime.utcnow() - SETTLE
+    latest = _nearest(conn, datetime.max)
+    if latest is not None and at - latest.taken_at < timedelta(days=every_days):
+        return None
+    return checkpoint(conn, at)
+
+
+# ==================== POINT IN TIME ====================
+
+def quantities_as_of(conn, when, medicine_ids=None):
+    """A SELECT of ``medicine_id, quantity`` as of ``when`` (UTC), zeros included.
+
+    Starts from whichever checkpoint is closer to ``when``: the one before
+    plus the movements since, or the one after minus the movements up to
+    it. Raises ``LookupError`` for a moment before the ledger began.
+    """
+    if medicine_ids is not None:
+        medicine_ids = list(medicine_ids)
+    before = _nearest(conn, when)
+    if before is None:
+        first = _nearest(conn, datetime.min, later=True)
+        started = f'{first.taken_at:%Y-%m-%d %H:%M} UTC' if first else 'when the ledger is created'
+        raise LookupError(f'Stock history starts at {started}.')
+    after = _nearest(conn, when, later=True)
+    if after is not None and after.taken_at - when < when - before.taken_at:
+        totals = _totals(_snapshot(after.id, medicine_ids), _movements(when, after.taken_at, -1, medicine_ids))
+    else:
+        totals = _totals(_snapshot(before.id, medicine_ids), _movements(before.taken_at, when, 1, medicine_ids))
+    return totals
+
+
+def as_of(conn, when, medicine_ids=None):
+    """``{medicine_id: quantity}`` as of ``when`` (UTC), leaving out zeros; see ``quantities_as_of``."""
+    return {row.medicine_id: row.quantity
+            for row in conn.execute(quantities_as_of(conn, when, medicine_ids)) if row.quantity}
+
+
+# ==================== RECONCILIATION ====================
+
+def verify(conn):
+    """``[(medicine_id, ledger, quantity)]`` for medicines the ledger disagrees with.
+
+    The ledger's figure is the latest checkpoint plus every movement since;
+    a deleted medicine counts as zero.
+    """
+    latest = _nearest(conn, datetime.max)
+    if latest is None:
+        raise LookupError('The stock ledger has no opening checkpoint; run flask db-upgrade.')
+    expected = {row.medicine_id: row.quantity
+                for row in conn.execute(_totals(_snapshot(latest.id), _movements(latest.taken_at)))}
+    actual = dict(conn.execute(select(medicine_table.c.id, medicine_table.c.quantity)
+                               .where(medicine_table.c.quantity != 0)).all())
+    return sorted((medicine_id, expected.get(medicine_id) or 0, actual.get(medicine_id) or 0)
+                  for medicine_id in set(expected) | set(actual)
+                  if (expected.get(medicine_id) or 0) != (actual.get(medicine_id) or 0))
+
+
+def correct(conn, reason=ADJUSTMENT, reference='stock-verify'):
+    """Record a movement for each difference ``verify()`` finds; returns them."""
+    differences = verify(conn)
+    record(conn, reason, [(medicine_id, quantity - ledger, quantity)
+                          for medicine_id, ledger, quantity in differences], reference)
+    return differences
@@ -0,0 +1,146 @@
+"""Keyset (cursor) pagination shared by the list pages.
+
+Instead of OFFSET, each page remembers the sort key of its last row and the
+next page starts strictly after it, so page N costs the same as page 1 and
+the query can walk an index on the sort columns.
+"""
+import base64
+import json
+from datetime import date, datetime
+
+from sqlalchemy import and_, literal, or_
+
+DEFAULT_PER_PAGE = 50
+
+
+class SortKey:
+    """One column of a keyset ordering.
+
+    ``value`` pulls the matching Python value off a loaded row; it defaults
+    to the attribute named after the column.
+    """
+
+    def __init__(self, expr, descending=False, value=None):
+        self.expr = expr
+        self.descending = descending
+        self.value = value or (lambda row, key=expr.key: getattr(row, key))
+
+    def order_by(self, reverse=False):
+        descending = self.descending != reverse
+        return self.expr.desc() if descending else self.expr.asc()
+
+    def after(self, value, reverse=False):
+        descending = self.descending != reverse
+        value = literal(value, self.expr.type)
+        return self.expr < value if descending else self.expr > value
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+
+# ==================== CURSOR ENCODING ====================
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return ['dt', value.isoformat()]
+    if isinstance(value, date):
+        return ['d', value.isoformat()]
+    return ['v', value]
+
+
+def _load_value(tagged):
+    tag, value = tagged
+    if tag == 'dt':
+        return datetime.fromisoformat(value)
+    if tag == 'd':
+        return date.fromisoformat(value)
+    return value
+
+
+def encode_cursor(values):
+    raw = json.dumps([_dump_value(v) for v in values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, size):
+    """Return the list of key values in ``token`` or None if it is unusable."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = [_load_value(v) for v in json.loads(raw)]
+    except (ValueError, TypeError):
+        return None
+    return values if len(values) == size else None
+
+
+# ==================== PAGINATION ====================
+
+def _keyset_filter(keys, values, reverse):
+    # (a, b, c) after (x, y, z)  ==  a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+    # A NULL key value has nothing strictly after it; nullable columns are
+    # expected to be preceded by an ``expr.is_(None)`` key that groups them.
+    clauses = []
+    for i, key in enumerate(keys):
+        if values[i] is None:
+            continue
+        equal = [k.expr == v for k, v in zip(keys[:i], values[:i])]
+        clauses.append(and_(*equal, key.after(values[i], reverse)))
+    return or_(*clauses)
+
+
+def paginate_keyset(query, keys, after=None, before=None, per_page=DEFAULT_PER_PAGE):
+    """Fetch one page of ``query`` ordered by ``keys``.
+
+    ``after``/``before`` are cursors from a previous page's ``next_cursor`` /
+    ``prev_cursor``. The last key should be unique (normally the primary key)
+    so the ordering is total. Runs exactly one SELECT.
+    """
+    after_values = decode_cursor(after, len(keys))
+    before_values = decode_cursor(before, len(keys)) if after_values is None else None
+    reverse = before_values is not None
+    anchor = before_values if reverse else after_values
+
+    if anchor is not None:
+        query = query.filter(_keyset_filter(keys, anchor, reverse))
+    rows = query.order_by(*[k.order_by(reverse) for k in keys]).limit(per_page + 1).all()
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if reverse:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor([k.value(row) for k in keys])
+
+    if not rows:
+        return KeysetPage(rows)
+    if reverse:
+        # Walking backwards: there is always a newer page (the one we came from)
+        return KeysetPage(rows,
+                          next_cursor=cursor_for(rows[-1]),
+                          prev_cursor=cursor_for(rows[0]) if has_more else None)
+    return KeysetPage(rows,
+                      next_cursor=cursor_for(rows[-1]) if has_more else None,
+                      prev_cursor=cursor_for(rows[0]) if anchor is not None else None)
@@ -0,0 +1,243 @@
+"""Versioned schema migrations.
+
+``db.create_all()`` only creates missing tables, so anything that changes an
+existing table (new indexes, new columns) is written here as a numbered
+migration. Applied versions are recorded in the ``schema_version`` table and
+``upgrade()`` runs whatever is still pending, each in its own transaction.
+
+Migrations must be idempotent: a fresh database already has the current
+schema from ``create_all()`` and will still run every migration once.
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, insert, inspect, select
+from sqlalchemy.schema import CreateIndex, DropIndex
+
+import batches
+import dbconfig
+import ledger
+import search
+import stats as dashboard_stats
+
+MIGRATIONS = []
+
+_version_meta = MetaData()
+schema_version = Table(
+    'schema_version', _version_meta,
+    Column('version', Integer, primary_key=True),
+    Column('description', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, description):
+    """Register ``fn(connection, metadata)`` as migration ``version``."""
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return decorator
+
+
+def _indexes(metadata, names):
+    wanted = set(names)
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                yield index
+                wanted.discard(index.name)
+    if wanted:
+        raise LookupError(f'Indexes not declared on any model: {", ".join(sorted(wanted))}')
+
+
+def create_indexes(connection, metadata, *names):
+    """Create the named indexes declared on the models, skipping existing ones.
+
+    An index on a column that a later migration adds is left to that one.
+    """
+    for index in _indexes(metadata, names):
+        if {c.name for c in index.columns} <= _columns(connection, index.table.name):
+            connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def recreate_indexes(connection, metadata, *names):
+    """Drop and create the named indexes again, for indexes whose columns changed."""
+    for index in _indexes(metadata, names):
+        connection.execute(DropIndex(index, if_exists=True))
+        connection.execute(CreateIndex(index))
+
+
+def _columns(connection, table_name):
+    return {c['name'] for c in inspect(connection).get_columns(table_name)}
+
+
+def add_column(connection, table_name, column_ddl):
+    """``ALTER TABLE ... ADD COLUMN`` unless the column is already there."""
+    column_name = column_ddl.split()[0]
+    if column_name not in _columns(connection, table_name):
+        table = connection.dialect.identifier_preparer.quote(table_name)
+        connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column_ddl}')
+
+
+def applied_versions(engine):
+    _version_meta.create_all(engine)
+    with engine.connect() as conn:
+        return {row.version for row in conn.execute(schema_version.select())}
+
+
+def current_version(engine):
+    return max(applied_versions(engine), default=0)
+
+
+def upgrade(engine, metadata):
+    """Apply pending migrations in order. Returns the versions applied."""
+    done = applied_versions(engine)
+    applied = []
+    for version, description, fn in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            fn(conn, metadata)
+            conn.execute(schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.utcnow()
+            ))
+        applied.append(version)
+    return applied
+
+
+def upgrade_all(db):
+    """``upgrade()`` the primary database and every per-branch one; ``{branch_id or None: versions}``."""
+    applied = {None: upgrade(db.engine, db.metadata)}
+    for branch_id, engine in sorted(dbconfig.branch_engines(db).items()):
+        db.metadata.create_all(engine)
+        applied[branch_id] = upgrade(engine, db.metadata)
+    return applied
+
+
+# ==================== MIGRATIONS ====================
+
+@migration(1, 'Indexes for hot filters and sorts')
+def _hot_path_indexes(conn, metadata):
+    create_indexes(
+        conn, metadata,
+        'ix_medicine_name_id',
+        'ix_medicine_category_name_id',
+        'ix_medicine_quantity_id',
+        'ix_medicine_price_id',
+        'ix_medicine_expiry_date',
+        'ix_medicine_expiry_nulls_last',
+        'ix_medicine_low_stock',
+        'ix_sale_sale_date_id',
+        'ix_sale_sale_date_totals',
+        'ix_sale_medicine_id_sale_date',
+        'ix_purchase_order_order_date_id',
+        'ix_purchase_order_status_order_date_id',
+        'ix_purchase_order_medicine_id_order_date',
+        'ix_supplier_name_id',
+    )
+
+
+@migration(2, 'Full-text search index over medicine names')
+def _medicine_search_index(conn, metadata):
+    # SQLite only; elsewhere search keeps using LIKE
+    if search.fts5_supported(conn):
+        search.create_index(conn)
+
+
+@migration(3, 'Batch number lookup for bulk import upserts')
+def _batch_number_index(conn, metadata):
+    create_indexes(conn, metadata, 'ix_medicine_batch_number')
+
+
+@migration(4, 'Sales orders: a header for multi-line sales')
+def _sales_orders(conn, metadata):
+    metadata.tables['sales_order'].create(conn, checkfirst=True)
+    add_column(conn, 'sale', 'order_id INTEGER REFERENCES sales_order(id)')
+    create_indexes(conn, metadata, 'ix_sale_order_id')
+
+
+@migration(5, 'Stock batches for first-expiry-first-out picking')
+def _stock_batches(conn, metadata):
+    metadata.tables['stock_batch'].create(conn, checkfirst=True)
+    create_indexes(conn, metadata, 'ix_stock_batch_fefo', 'ix_stock_batch_expiry')
+    # Existing stock becomes one batch per medicine, labelled as before
+    batches.backfill(conn)
+
+
+@migration(6, 'Scheduled jobs: run history, leader lock, per-medicine daily rollup')
+def _scheduled_jobs(conn, metadata):
+    for name in ('job_run', 'scheduler_lock', 'medicine_daily_sales'):
+        metadata.tables[name].create(conn, checkfirst=True)
+    create_indexes(conn, metadata, 'ix_job_run_job_started_at', 'ix_medicine_daily_sales_medicine_day')
+    add_column(conn, 'dashboard_stats', 'expired_stock_units INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'dashboard_stats', 'expired_batches INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'dashboard_stats', 'expiring_batches INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'dashboard_stats', 'expiry_swept_on DATE')
+
+
+@migration(7, 'Stock movement ledger with checkpoints')
+def _stock_ledger(conn, metadata):
+    for name in ('stock_movement', 'stock_checkpoint', 'stock_snapshot'):
+        metadata.tables[name].create(conn, checkfirst=True)
+    create_indexes(conn, metadata, 'ix_stock_movement_medicine_created_at', 'ix_stock_movement_created_at')
+    ledger.protect(conn)
+    # The ledger continues from the stock as it is now
+    ledger.open_ledger(conn)
+
+
+@migration(8, 'Branches: branch_id on branch data, branch-leading indexes')
+def _branches(conn, metadata):
+    branch_table = metadata.tables['branch']
+    branch_table.create(conn, checkfirst=True)
+    if conn.execute(select(branch_table.c.id).where(branch_table.c.id == dbconfig.DEFAULT_BRANCH)).first() is None:
+        conn.execute(insert(branch_table).values(id=dbconfig.DEFAULT_BRANCH, code='MAIN', name='Main branch',
+                                                 created_at=datetime.utcnow()))
+    # Everything so far belongs to the first branch
+    for table in ('user', 'medicine', 'supplier', 'purchase_order', 'sales_order', 'sale', 'report_job'):
+        add_column(conn, table, f'branch_id INTEGER NOT NULL DEFAULT {dbconfig.DEFAULT_BRANCH} REFERENCES branch(id)')
+    recreate_indexes(
+        conn, metadata,
+        'ix_medicine_name_id',
+        'ix_medicine_category_name_id',
+        'ix_medicine_quantity_id',
+        'ix_medicine_price_id',
+        'ix_medicine_expiry_nulls_last',
+        'ix_medicine_expiry_date',
+        'ix_medicine_batch_number',
+        'ix_medicine_low_stock',
+        'ix_supplier_name_id',
+        'ix_purchase_order_order_date_id',
+        'ix_purchase_order_status_order_date_id',
+        'ix_sales_order_created_at_id',
+        'ix_sale_sale_date_id',
+        'ix_sale_sale_date_totals',
+        'ix_report_job_range_version',
+    )
+    # The daily revenue buckets gain branch_id in their key; they are
+    # derived from the sales, so the table is recreated and refilled
+    if 'branch_id' not in _columns(conn, 'daily_sales'):
+        daily_sales = metadata.tables['daily_sales']
+        daily_sales.drop(conn)
+        daily_sales.create(conn)
+        if conn.execute(select(metadata.tables['dashboard_stats'].c.id)).first() is not None:
+            dashboard_stats.rebuild_branch(conn, dbconfig.DEFAULT_BRANCH)
+
+
+@migration(9, 'POS sync: medicine change versions, tombstones, client sale ids')
+def _pos_sync(conn, metadata):
+    for name in ('change_counter', 'medicine_tombstone'):
+        metadata.tables[name].create(conn, checkfirst=True)
+    add_column(conn, 'medicine', 'change_version BIGINT NOT NULL DEFAULT 0')
+    add_column(conn, 'sales_order', 'client_id VARCHAR(64)')
+    create_indexes(conn, metadata, 'ix_medicine_change_version', 'ix_sales_order_client_id',
+                   'ix_medicine_tombstone_change_version', 'ix_medicine_tombstone_deleted_at')
+    # Existing medicines are the first version; plain SQL, so updated_at is left alone
+    counter = metadata.tables['change_counter']
+    if conn.execute(select(counter.c.id)).first() is None:
+        conn.execute(insert(counter).values(id=1, version=1, pruned_through=0))
+        conn.exec_driver_sql('UPDATE medicine SET change_version = 1')
+
+
+@migration(10, 'Covering index for the branch rollup of completed purchase orders')
+def _purchase_rollup_index(conn, metadata):
+    create_indexes(conn, metadata, 'ix_purchase_order_status_order_date_totals')
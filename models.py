@@ -0,0 +1,331 @@
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import insert, update
+from sqlalchemy.orm import declared_attr
+from datetime import datetime
+
+import dbconfig
+
+# SELECTs in replica_reads views go to the read replica bind (see dbconfig.py)
+db = SQLAlchemy(session_options={'class_': dbconfig.RoutingSession})
+
+# ==================== BRANCHES ====================
+
+class Branch(db.Model):
+    # A pharmacy location. Its stock, suppliers, orders and sales carry its id
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(20), unique=True, nullable=False)
+    name = db.Column(db.String(200), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+def _current_branch():
+    return dbconfig.current_branch() or dbconfig.DEFAULT_BRANCH
+
+class BranchOwned:
+    # Rows of one branch. Queries only see the current branch's (branches.py);
+    # new rows join it unless given a branch_id (rows inserted outside the app: the first branch)
+    @declared_attr
+    def branch_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('branch.id'), nullable=False, default=_current_branch,
+                         server_default=str(dbconfig.DEFAULT_BRANCH))
+
+def change_version(conn):
+    """The version of the transaction on ``conn`` for the POS changefeed (sync.py).
+
+    The counter row is bumped once per transaction (and savepoint) and
+    stays locked until commit, so versions become visible in increasing
+    order.
+    """
+    key = (conn.get_transaction(), conn.get_nested_transaction())
+    cached = conn.info.get('change_version')
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    counter = ChangeCounter.__table__
+    version = conn.execute(update(counter).where(counter.c.id == 1)
+                           .values(version=counter.c.version + 1).returning(counter.c.version)).scalar()
+    if version is None:
+        version = 1
+        conn.execute(insert(counter).values(id=1, version=version))
+    conn.info['change_version'] = (key, version)
+    return version
+
+def _change_version(context):
+    return change_version(context.connection)
+
+class User(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), unique=True, nullable=False)
+    email = db.Column(db.String(120), unique=True, nullable=False)
+    password = db.Column(db.String(200), nullable=False)
+    role = db.Column(db.String(50), default='staff')
+    branch_id = db.Column(db.Integer, db.ForeignKey('branch.id'), nullable=False, default=dbconfig.DEFAULT_BRANCH,
+                          server_default=str(dbconfig.DEFAULT_BRANCH))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class Medicine(BranchOwned, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    generic_name = db.Column(db.String(200))
+    category = db.Column(db.String(100))
+    manufacturer = db.Column(db.String(200))
+    quantity = db.Column(db.Integer, default=0)
+    price = db.Column(db.Float, nullable=False)
+    expiry_date = db.Column(db.Date)
+    batch_number = db.Column(db.String(100))
+    description = db.Column(db.Text)
+    location = db.Column(db.String(100))
+    reorder_level = db.Column(db.Integer, default=10)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Set on every insert and update, by the ORM and Core statements alike
+    change_version = db.Column(db.BigInteger, nullable=False, default=_change_version, onupdate=_change_version,
+                               server_default='0')
+    
+    __table_args__ = (
+        # Every query is scoped to one branch, so branch_id leads each index.
+        # Inventory sorts (id is the keyset tie-breaker)
+        db.Index('ix_medicine_name_id', 'branch_id', 'name', 'id'),
+        db.Index('ix_medicine_category_name_id', 'branch_id', 'category', 'name', 'id'),
+        db.Index('ix_medicine_quantity_id', 'branch_id', 'quantity', 'id'),
+        db.Index('ix_medicine_price_id', 'branch_id', 'price', 'id'),
+        db.Index('ix_medicine_expiry_nulls_last', 'branch_id', db.text('(expiry_date IS NULL)'), 'expiry_date', 'id'),
+        # Expired / expiring-soon range filters
+        db.Index('ix_medicine_expiry_date', 'branch_id', 'expiry_date'),
+        # Bulk import upserts match on batch number
+        db.Index('ix_medicine_batch_number', 'branch_id', 'batch_number'),
+        # Only low-stock rows are indexed, so the dashboard reads just those
+        db.Index('ix_medicine_low_stock', 'branch_id', 'quantity',
+                 sqlite_where=db.text('quantity <= reorder_level'),
+                 postgresql_where=db.text('quantity <= reorder_level')),
+        # The POS changefeed reads a branch's changes in version order
+        db.Index('ix_medicine_change_version', 'branch_id', 'change_version', 'id'),
+    )
+
+class Supplier(BranchOwned, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    contact_person = db.Column(db.String(200))
+    email = db.Column(db.String(120))
+    phone = db.Column(db.String(20))
+    address = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_supplier_name_id', 'branch_id', 'name', 'id'),
+    )
+
+class PurchaseOrder(BranchOwned, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'))
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'))
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    total_amount = db.Column(db.Float, nullable=False)
+    status = db.Column(db.String(50), default='pending')  # pending, completed, cancelled
+    order_date = db.Column(db.DateTime, default=datetime.utcnow)
+    delivery_date = db.Column(db.DateTime)
+    notes = db.Column(db.Text)
+    supplier = db.relationship('Supplier', backref='purchase_orders')
+    medicine = db.relationship('Medicine', backref='purchase_orders')
+    
+    __table_args__ = (
+        db.Index('ix_purchase_order_order_date_id', 'branch_id', 'order_date', 'id'),
+        db.Index('ix_purchase_order_status_order_date_id', 'branch_id', 'status', 'order_date', 'id'),
+        db.Index('ix_purchase_order_medicine_id_order_date', 'medicine_id', 'order_date'),
+        # The branch rollup sums completed orders of every branch at once, so status leads
+        db.Index('ix_purchase_order_status_order_date_totals', 'status', 'order_date', 'branch_id', 'total_amount'),
+    )
+
+class SalesOrder(BranchOwned, db.Model):
+    # One checkout (invoice); each line is a Sale row
+    id = db.Column(db.Integer, primary_key=True)
+    customer_name = db.Column(db.String(200))
+    total_amount = db.Column(db.Float, nullable=False, default=0)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    client_id = db.Column(db.String(64))  # the POS terminal's id for an offline sale, which makes pushes idempotent
+    lines = db.relationship('Sale', backref='order', order_by='Sale.id')
+    
+    __table_args__ = (
+        db.Index('ix_sales_order_created_at_id', 'branch_id', 'created_at', 'id'),
+        db.Index('ix_sales_order_client_id', 'branch_id', 'client_id', unique=True),
+    )
+
+class Sale(BranchOwned, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('sales_order.id'))  # NULL for sales recorded before orders
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'))
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Float, nullable=False)
+    total_amount = db.Column(db.Float, nullable=False)
+    sale_date = db.Column(db.DateTime, default=datetime.utcnow)
+    customer_name = db.Column(db.String(200))
+    medicine = db.relationship('Medicine', backref='sales')
+    
+    __table_args__ = (
+        db.Index('ix_sale_sale_date_id', 'branch_id', 'sale_date', 'id'),
+        # Covers the revenue / top-seller aggregates (and the per-branch rollup) without touching the table
+        db.Index('ix_sale_sale_date_totals', 'branch_id', 'sale_date', 'medicine_id', 'quantity', 'total_amount'),
+        db.Index('ix_sale_medicine_id_sale_date', 'medicine_id', 'sale_date'),
+        db.Index('ix_sale_order_id', 'order_id'),
+    )
+
+# ==================== STOCK BATCHES ====================
+
+class StockBatch(db.Model):
+    # Stock on hand per received batch. Medicine.quantity is the sum of these and
+    # Medicine.expiry_date the earliest in-stock expiry (kept in sync by batches.py)
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), nullable=False)
+    purchase_order_id = db.Column(db.Integer, db.ForeignKey('purchase_order.id'))
+    batch_number = db.Column(db.String(100))
+    expiry_date = db.Column(db.Date)
+    quantity = db.Column(db.Integer, nullable=False, default=0)  # units left
+    received_quantity = db.Column(db.Integer, nullable=False, default=0)
+    unit_cost = db.Column(db.Float)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    medicine = db.relationship('Medicine', backref=db.backref(
+        'batches', cascade='all, delete-orphan', order_by='StockBatch.id'))
+    
+    __table_args__ = (
+        # First-expiry-first-out picking; empty batches are left out of the index
+        db.Index('ix_stock_batch_fefo', 'medicine_id', db.text('(expiry_date IS NULL)'), 'expiry_date', 'id',
+                 sqlite_where=db.text('quantity > 0'),
+                 postgresql_where=db.text('quantity > 0')),
+        db.Index('ix_stock_batch_expiry', 'expiry_date',
+                 sqlite_where=db.text('quantity > 0'),
+                 postgresql_where=db.text('quantity > 0')),
+    )
+
+# ==================== STOCK LEDGER ====================
+
+class StockMovement(db.Model):
+    # One change to a medicine's quantity, appended in the same transaction (ledger.py).
+    # Never updated or deleted; no foreign key, so the history outlives the medicine
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    balance = db.Column(db.Integer, nullable=False)  # the medicine's quantity after this movement
+    reason = db.Column(db.String(20), nullable=False)  # sale, receipt, adjustment, import, opening, removal
+    reference = db.Column(db.String(50))  # e.g. sales_order:12, purchase_order:7
+    user_id = db.Column(db.Integer)  # NULL for jobs and CLI commands
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        # A medicine's history, and the scan from a checkpoint to a point in time
+        db.Index('ix_stock_movement_medicine_created_at', 'medicine_id', 'created_at'),
+        db.Index('ix_stock_movement_created_at', 'created_at'),
+    )
+
+class StockCheckpoint(db.Model):
+    # Every medicine's quantity as of taken_at: its StockSnapshot rows (zeros left out)
+    id = db.Column(db.Integer, primary_key=True)
+    taken_at = db.Column(db.DateTime, nullable=False, unique=True)
+    medicines = db.Column(db.Integer, nullable=False, default=0)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class StockSnapshot(db.Model):
+    checkpoint_id = db.Column(db.Integer, db.ForeignKey('stock_checkpoint.id'), primary_key=True)
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+
+# ==================== PRECOMPUTED STATS ====================
+
+class DashboardStats(db.Model):
+    # One row per branch (id = branch id) kept current by stats.py as medicines and sales change
+    id = db.Column(db.Integer, primary_key=True)
+    total_medicines = db.Column(db.Integer, nullable=False, default=0)
+    low_stock_count = db.Column(db.Integer, nullable=False, default=0)
+    expired_count = db.Column(db.Integer, nullable=False, default=0)
+    expired_as_of = db.Column(db.Date, nullable=False)  # expired means expiry_date < this day
+    category_counts = db.Column(db.JSON, nullable=False, default=dict)
+    month_start = db.Column(db.Date, nullable=False)
+    monthly_revenue = db.Column(db.Float, nullable=False, default=0)
+    # Written by the nightly expiry sweep (jobs.py), as of expiry_swept_on
+    expired_stock_units = db.Column(db.Integer, nullable=False, default=0)  # units in expired in-stock batches
+    expired_batches = db.Column(db.Integer, nullable=False, default=0)
+    expiring_batches = db.Column(db.Integer, nullable=False, default=0)  # in stock, expiring within 30 days
+    expiry_swept_on = db.Column(db.Date)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DailySales(db.Model):
+    # Per-branch, per-day revenue bucket
+    branch_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+
+class MedicineDailySales(db.Model):
+    # Units and revenue per medicine per closed day, rolled up nightly from sale
+    day = db.Column(db.Date, primary_key=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey('medicine.id'), primary_key=True)
+    units = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    sales_count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_medicine_daily_sales_medicine_day', 'medicine_id', 'day'),
+    )
+
+# ==================== POS SYNC ====================
+
+class ChangeCounter(db.Model):
+    # One row (id 1): the last medicine change version handed out (sync.py)
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    pruned_through = db.Column(db.BigInteger, nullable=False, default=0)  # tombstones up to this version are gone
+
+class MedicineTombstone(BranchOwned, db.Model):
+    # A deleted medicine, kept for the changefeed until the cleanup job prunes it
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, nullable=False)
+    change_version = db.Column(db.BigInteger, nullable=False, default=_change_version)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_medicine_tombstone_change_version', 'branch_id', 'change_version'),
+        db.Index('ix_medicine_tombstone_deleted_at', 'deleted_at'),
+    )
+
+# ==================== BACKGROUND JOBS ====================
+
+class ReportJob(BranchOwned, db.Model):
+    # A PDF report rendered in the background by report_jobs.py
+    id = db.Column(db.String(32), primary_key=True)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    data_version = db.Column(db.String(40), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    file_path = db.Column(db.String(500))
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('ix_report_job_range_version', 'branch_id', 'start_date', 'end_date', 'data_version'),
+    )
+
+class JobRun(db.Model):
+    # One run of a scheduled job (scheduler.py)
+    id = db.Column(db.Integer, primary_key=True)
+    job = db.Column(db.String(100), nullable=False)
+    scheduled_for = db.Column(db.DateTime)  # the local time slot of a daily job
+    owner = db.Column(db.String(100))  # host:pid of the worker that ran it
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, ok, failed
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    duration_ms = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_job_run_job_started_at', 'job', 'started_at'),
+    )
+
+class SchedulerLock(db.Model):
+    # A lease: the worker named in owner runs scheduled jobs until expires_at
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100), nullable=False)
+    acquired_at = db.Column(db.DateTime, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,215 @@
+"""Replenishment: draft purchase orders from sales velocity.
+
+Each run looks at the whole catalogue in a handful of set-based queries --
+none per medicine:
+
+* daily units sold per medicine over the last 90 days (from the nightly
+  rollup, see jobs.py), folded into 7, 28 and 90-day window totals and the
+  28-day variance by conditional sums in one grouped query;
+* each supplier's lead time, the average gap between ordering and delivery
+  of its completed orders over the last year;
+* each medicine's current supplier and price, from its latest purchase order;
+* the units already on order (draft or pending).
+
+Demand is a blend of the windows, weighted towards the recent ones. The
+reorder point is the demand over the lead time plus safety stock
+(``REORDER_SERVICE_Z`` standard deviations of daily demand over the lead
+time), never below the medicine's own ``reorder_level``. A medicine whose
+stock plus what is on order is at or below that point gets a draft order
+topping it up to ``REORDER_REVIEW_DAYS`` of demand beyond the reorder point.
+Drafts are inserted in bulk and wait for someone to approve them, which
+makes them ordinary pending orders.
+
+Medicines that have not sold in 90 days, or have never been bought from a
+supplier, are left alone; the latter are counted so they can be set up.
+
+In a request the run covers the current branch (branches.py); the nightly
+job sees every branch, and each draft goes to its medicine's branch.
+"""
+import math
+import time
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import case, func, insert, select, update
+
+from models import db, Medicine, MedicineDailySales, PurchaseOrder, Sale
+import branches
+import stats as dashboard_stats
+
+# Days per window and the weight of its daily rate in the blended demand
+WINDOWS = ((7, 0.5), (28, 0.3), (90, 0.2))
+VARIANCE_DAYS = 28
+LEAD_TIME_HISTORY_DAYS = 365
+OPEN_STATUSES = ('draft', 'pending')
+
+Suggestion = namedtuple('Suggestion', 'medicine_id supplier_id daily_demand lead_days '
+                                      'reorder_point position quantity unit_price branch_id')
+ReorderRun = namedtuple('ReorderRun', 'checked suggestions orders_created no_supplier seconds')
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def _days_between(start, end):
+    if _dialect() == 'sqlite':
+        return func.julianday(end) - func.julianday(start)
+    return func.extract('epoch', end - start) / 86400
+
+
+# ==================== INPUTS ====================
+
+def demand(today):
+    """``{medicine_id: (units per day, standard deviation of daily units)}``.
+
+    Today's sales are left out, as the day is not over. Reads the nightly
+    per-medicine rollup when it reaches yesterday, the sales table otherwise.
+    """
+    horizon = max(days for days, _ in WINDOWS)
+    rolled = dashboard_stats.rolled_through(db.session.connection())
+    if rolled is not None and rolled >= today - timedelta(days=1):
+        daily = (select(MedicineDailySales.medicine_id, MedicineDailySales.units,
+                        MedicineDailySales.day.label('at'))
+                 .where(MedicineDailySales.day >= today - timedelta(days=horizon),
+                        MedicineDailySales.day < today)
+                 .subquery())
+        if branches.current() is not None:
+            # The rollup is not branch-owned; the scoped medicine ids narrow it
+            daily = select(daily).where(daily.c.medicine_id.in_(select(Medicine.id))).subquery()
+        start = today
+    else:
+        start = datetime.combine(today, datetime.min.time())
+        day = func.date(Sale.sale_date)
+        # One row per medicine and day; ``at`` carries the day as a datetime to compare with
+        daily = (select(Sale.medicine_id, func.sum(Sale.quantity).label('units'),
+                        func.max(Sale.sale_date).label('at'))
+                 .where(Sale.sale_date >= start - timedelta(days=horizon), Sale.sale_date < start)
+                 .group_by(Sale.medicine_id, day)
+                 .subquery())
+
+    def since(days, value):
+        return func.sum(case((daily.c.at >= start - timedelta(days=days), value), else_=0))
+
+    rows = db.session.execute(
+        select(daily.c.medicine_id,
+               since(VARIANCE_DAYS, daily.c.units),
+               since(VARIANCE_DAYS, daily.c.units * daily.c.units),
+               *[since(days, daily.c.units) for days, _ in WINDOWS])
+        .group_by(daily.c.medicine_id)
+    )
+    result = {}
+    for medicine_id, units, squares, *totals in rows:
+        rate = sum(weight * total / days for (days, weight), total in zip(WINDOWS, totals))
+        mean = units / VARIANCE_DAYS
+        result[medicine_id] = (rate, math.sqrt(max(squares / VARIANCE_DAYS - mean * mean, 0)))
+    return result
+
+
+def lead_times(today):
+    """``{supplier_id: average days from order to delivery}`` over the last year."""
+    since = datetime.combine(today - timedelta(days=LEAD_TIME_HISTORY_DAYS), datetime.min.time())
+    return dict(db.session.execute(
+        select(PurchaseOrder.supplier_id,
+               func.avg(_days_between(PurchaseOrder.order_date, PurchaseOrder.delivery_date)))
+        .where(PurchaseOrder.status == 'completed',
+               PurchaseOrder.delivery_date.isnot(None),
+               PurchaseOrder.order_date >= since)
+        .group_by(PurchaseOrder.supplier_id)
+    ).all())
+
+
+def sources():
+    """``{medicine_id: (supplier_id, unit_price)}`` from each medicine's latest order."""
+    ranked = (select(PurchaseOrder.medicine_id, PurchaseOrder.supplier_id, PurchaseOrder.unit_price,
+                     func.row_number().over(partition_by=PurchaseOrder.medicine_id,
+                                            order_by=(PurchaseOrder.order_date.desc(),
+                                                      PurchaseOrder.id.desc())).label('latest'))
+              .where(PurchaseOrder.supplier_id.isnot(None), PurchaseOrder.status != 'cancelled')
+              .subquery())
+    rows = db.session.execute(select(ranked.c.medicine_id, ranked.c.supplier_id, ranked.c.unit_price)
+                              .where(ranked.c.latest == 1))
+    return {medicine_id: (supplier_id, price) for medicine_id, supplier_id, price in rows}
+
+
+def on_order():
+    """``{medicine_id: units}`` in draft and pending orders."""
+    return dict(db.session.execute(
+        select(PurchaseOrder.medicine_id, func.sum(PurchaseOrder.quantity))
+        .where(PurchaseOrder.status.in_(OPEN_STATUSES))
+        .group_by(PurchaseOrder.medicine_id)
+    ).all())
+
+
+# ==================== PLANNING ====================
+
+def plan(today=None):
+    """``(suggestions, medicines checked, ids needing stock but without a supplier)``."""
+    config = current_app.config
+    today = today or date.today()
+    velocity = demand(today)
+    leads, supplied, ordered = lead_times(today), sources(), on_order()
+
+    suggestions, no_supplier, checked = [], [], 0
+    medicines = db.session.execute(select(Medicine.id, Medicine.quantity, Medicine.reorder_level,
+                                          Medicine.branch_id))
+    for medicine_id, quantity, reorder_level, branch_id in medicines:
+        checked += 1
+        if medicine_id not in velocity:
+            continue
+        rate, deviation = velocity[medicine_id]
+        supplier_id, unit_price = supplied.get(medicine_id, (None, None))
+        lead = leads.get(supplier_id) or config['REORDER_LEAD_DAYS']
+        reorder_point = max(rate * lead + config['REORDER_SERVICE_Z'] * deviation * math.sqrt(lead),
+                            reorder_level or 0)
+        position = (quantity or 0) + ordered.get(medicine_id, 0)
+        if position > reorder_point:
+            continue
+        if supplier_id is None:
+            no_supplier.append(medicine_id)
+            continue
+        order_quantity = math.ceil(reorder_point + rate * config['REORDER_REVIEW_DAYS'] - position)
+        suggestions.append(Suggestion(medicine_id, supplier_id, round(rate, 2), round(lead, 1),
+                                      round(reorder_point, 1), position, max(order_quantity, 1),
+                                      unit_price, branch_id))
+    return suggestions, checked, no_supplier
+
+
+def create_drafts(suggestions):
+    """Insert a draft purchase order per suggestion in one statement; returns the count."""
+    if not suggestions:
+        return 0
+    now = datetime.utcnow()
+    db.session.execute(insert(PurchaseOrder.__table__), [
+        dict(branch_id=s.branch_id, supplier_id=s.supplier_id, medicine_id=s.medicine_id, quantity=s.quantity,
+             unit_price=s.unit_price, total_amount=round(s.quantity * s.unit_price, 2),
+             status='draft', order_date=now,
+             notes=(f'Auto reorder: {s.daily_demand:g}/day, {s.lead_days:g}-day lead time, '
+                    f'reorder point {s.reorder_point:g}, {s.position} in stock or on order'))
+        for s in suggestions
+    ])
+    return len(suggestions)
+
+
+def run(today=None, dry_run=False):
+    """Plan and (unless ``dry_run``) create and commit the drafts."""
+    started = time.perf_counter()
+    suggestions, checked, no_supplier = plan(today)
+    created = 0
+    if not dry_run:
+        created = create_drafts(suggestions)
+        db.session.commit()
+    return ReorderRun(checked, suggestions, created, no_supplier,
+                      round(time.perf_counter() - started, 2))
+
+
+def approve(order_id):
+    """Turn a draft into a pending order; False when it is not a draft."""
+    result = db.session.execute(
+        update(PurchaseOrder.__table__)
+        .where(PurchaseOrder.__table__.c.id == order_id, PurchaseOrder.__table__.c.status == 'draft',
+               branches.scope(PurchaseOrder.__table__.c.branch_id))
+        .values(status='pending', order_date=datetime.utcnow())
+    )
+    return result.rowcount == 1
@@ -0,0 +1,204 @@
+"""Background PDF report generation.
+
+``download_report()`` used to render every sale and purchase in the range
+into one HTML string and run xhtml2pdf inside the request. Now a request
+submits a ``ReportJob`` and a small per-process thread pool renders it:
+
+* the HTML is streamed from the template to a temporary file in chunks and
+  xhtml2pdf writes the PDF straight to disk, so nothing is held twice;
+* rows are read with ``yield_per`` and the medicine/supplier names are
+  joined in, instead of one lazy load per row;
+* finished files are reused for the same date range as long as the data in
+  that range is unchanged (see ``data_version``), so a repeated request is
+  served from disk without rendering again.
+
+Jobs live in the database, so any gunicorn worker can answer a status poll
+or serve the file, whichever worker rendered it. A job belongs to the
+branch that asked for it and is rendered inside that branch (branches.py).
+"""
+import hashlib
+import os
+import tempfile
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, load_only
+
+from models import db, Medicine, PurchaseOrder, ReportJob, Sale, Supplier
+import branches
+import reporting
+
+ROW_BATCH = 500
+
+_executor = None
+
+
+def _pool(app):
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=app.config['REPORT_WORKERS'],
+                                       thread_name_prefix='report')
+    return _executor
+
+
+def report_dir(app):
+    path = app.config['REPORT_DIR'] or os.path.join(app.instance_path, 'reports')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# ==================== DATA ====================
+
+def data_version(start_date, end_date):
+    """Fingerprint of the rows a report for this range contains.
+
+    Count, highest id and total of the sales and completed purchases in the
+    range, read from the date indexes, and the branch. Any sale or purchase
+    added, removed, completed or re-priced in the range changes it.
+    """
+    start, end = reporting.date_range(start_date, end_date)
+    sales = db.session.query(
+        func.count(Sale.id), func.max(Sale.id), func.sum(Sale.total_amount)
+    ).filter(Sale.sale_date >= start, Sale.sale_date < end).one()
+    purchases = db.session.query(
+        func.count(PurchaseOrder.id), func.max(PurchaseOrder.id), func.sum(PurchaseOrder.total_amount)
+    ).filter(PurchaseOrder.status == 'completed',
+             PurchaseOrder.order_date >= start,
+             PurchaseOrder.order_date < end).one()
+    raw = repr((branches.current(), tuple(sales), tuple(purchases)))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def report_context(start_date, end_date):
+    """Template variables for pdf_report.html, with rows as streaming iterators."""
+    start, end = reporting.date_range(start_date, end_date)
+    sales = (Sale.query
+             .options(load_only(Sale.sale_date, Sale.quantity, Sale.total_amount),
+                      joinedload(Sale.medicine).load_only(Medicine.name))
+             .filter(Sale.sale_date >= start, Sale.sale_date < end)
+             .order_by(Sale.sale_date, Sale.id)
+             .yield_per(ROW_BATCH))
+    purchase_filter = (PurchaseOrder.status == 'completed',
+                       PurchaseOrder.order_date >= start,
+                       PurchaseOrder.order_date < end)
+    purchases = (PurchaseOrder.query
+                 .options(load_only(PurchaseOrder.order_date, PurchaseOrder.total_amount),
+                          joinedload(PurchaseOrder.supplier).load_only(Supplier.name),
+                          joinedload(PurchaseOrder.medicine).load_only(Medicine.name))
+                 .filter(*purchase_filter)
+                 .order_by(PurchaseOrder.order_date, PurchaseOrder.id)
+                 .yield_per(ROW_BATCH))
+
+    total_credit = reporting.sales_summary(start, end).revenue
+    total_debit = db.session.query(func.sum(PurchaseOrder.total_amount))\
+        .filter(*purchase_filter).scalar() or 0
+    return dict(sales=sales,
+                purchases=purchases,
+                total_credit=total_credit,
+                total_debit=total_debit,
+                net_balance=total_credit - total_debit,
+                start_date=start_date.strftime('%Y-%m-%d'),
+                end_date=end_date.strftime('%Y-%m-%d'))
+
+
+# ==================== RENDERING ====================
+
+def pdf_renderer():
+    """xhtml2pdf's ``pisa``, imported on first use.
+
+    With reportlab and pyhanko it is about half of the app's import time and
+    memory, which CLI commands, the scheduler sidecar and workers that never
+    render a report have no use for. A preloading gunicorn master imports it
+    up front instead, to share it with its workers (see gunicorn.conf.py).
+    """
+    from xhtml2pdf import pisa
+    return pisa
+
+
+def render_pdf(app, start_date, end_date, version):
+    """Render the report for the range into the report directory; returns its path."""
+    directory = report_dir(app)
+    final_path = os.path.join(
+        directory, f'PharmaSync_Report_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}_{version[:12]}.pdf'
+    )
+    template = app.jinja_env.get_template('pdf_report.html')
+    context = report_context(start_date, end_date)
+    app.update_template_context(context)
+
+    with tempfile.TemporaryFile('w+', encoding='utf-8', dir=directory) as html, \
+            tempfile.NamedTemporaryFile('wb', dir=directory, suffix='.part', delete=False) as pdf:
+        for chunk in template.generate(context):
+            html.write(chunk)
+        html.seek(0)
+        status = pdf_renderer().CreatePDF(html, dest=pdf)
+    if status.err:
+        os.unlink(pdf.name)
+        raise RuntimeError(f'Error generating PDF: {status.err}')
+    os.replace(pdf.name, final_path)
+    return final_path
+
+
+def _run(app, job_id, branch_id):
+    with app.app_context(), branches.use(branch_id):
+        try:
+            job = db.session.get(ReportJob, job_id)
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            db.session.commit()
+            try:
+                path = render_pdf(app, job.start_date, job.end_date, job.data_version)
+            except Exception as e:
+                db.session.rollback()
+                job.status = 'failed'
+                job.error = str(e)
+                app.logger.exception('Report job %s failed', job_id)
+            else:
+                job.status = 'done'
+                job.file_path = path
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+        finally:
+            db.session.remove()
+
+
+# ==================== PUBLIC API ====================
+
+def is_stale(job, timeout):
+    """A queued/running job whose worker probably died (e.g. a restarted process)."""
+    return job.status in ('queued', 'running') and job.created_at < datetime.utcnow() - timeout
+
+
+def submit(start_date, end_date):
+    """Return a job for the range: a cached finished one, one in progress, or a new one."""
+    app = current_app._get_current_object()
+    version = data_version(start_date, end_date)
+    timeout = timedelta(seconds=app.config['REPORT_JOB_TIMEOUT'])
+
+    candidates = ReportJob.query.filter_by(
+        start_date=start_date, end_date=end_date, data_version=version
+    ).order_by(ReportJob.created_at.desc()).all()
+    for job in candidates:
+        if job.status == 'done' and job.file_path and os.path.exists(job.file_path):
+            return job
+        if job.status in ('queued', 'running') and not is_stale(job, timeout):
+            return job
+
+    job = ReportJob(id=uuid.uuid4().hex, start_date=start_date, end_date=end_date,
+                    data_version=version)
+    db.session.add(job)
+    db.session.commit()
+    _pool(app).submit(_run, app, job.id, branches.current())
+    return job
+
+
+def to_dict(job):
+    return dict(id=job.id,
+                status=job.status,
+                start_date=job.start_date.isoformat(),
+                end_date=job.end_date.isoformat(),
+                error=job.error,
+                created_at=job.created_at.isoformat() if job.created_at else None,
+                finished_at=job.finished_at.isoformat() if job.finished_at else None)
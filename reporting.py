@@ -0,0 +1,211 @@
+"""Report metrics computed in SQL.
+
+Every function here is a single aggregate query: the database does the
+summing and grouping and Python only sees one row per bucket, category or
+medicine, however many sales are in the range. Ranges are half-open,
+``start <= stamp < end``, as ``date_range`` builds them. They cover the current
+branch, as every ORM query does (branches.py), except ``branch_rollup``,
+which sets all branches side by side.
+"""
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import case, func
+
+from models import db, Branch, Medicine, PurchaseOrder, Sale
+import branches
+
+GRAINS = ('day', 'week', 'month')
+
+SalesSummary = namedtuple('SalesSummary', 'revenue count units')
+StockSummary = namedtuple('StockSummary', 'value units')
+Margin = namedtuple('Margin', 'revenue cost gross_margin margin_pct uncosted_revenue')
+Turnover = namedtuple('Turnover', 'units_sold units_on_hand turnover days_of_stock')
+BranchFigures = namedtuple('BranchFigures', 'branch_id code name revenue sales_count units purchases '
+                                            'medicines low_stock stock_value')
+
+
+def date_range(start_date, end_date):
+    """``(start, end)`` for the days ``start_date`` to ``end_date``, both included.
+
+    ``end`` is the midnight after ``end_date`` and is not itself in the
+    range, so the last second of the day (timestamps keep microseconds) is.
+    """
+    return (datetime.combine(start_date, datetime.min.time()),
+            datetime.combine(end_date + timedelta(days=1), datetime.min.time()))
+
+
+def _in_range(start, end):
+    return (Sale.sale_date >= start, Sale.sale_date < end)
+
+
+def _dialect():
+    return db.session.get_bind().dialect.name
+
+
+def bucket(column, grain):
+    """SQL expression for the start of the day/week/month ``column`` falls in.
+
+    Weeks start on Monday.
+    """
+    if grain not in GRAINS:
+        raise ValueError(f'Unknown grain {grain!r}; expected one of {", ".join(GRAINS)}')
+    if _dialect() == 'sqlite':
+        if grain == 'day':
+            return func.date(column)
+        if grain == 'week':
+            # 'weekday 0' moves forward to Sunday; back six days is that week's Monday
+            return func.date(column, 'weekday 0', '-6 days')
+        return func.date(column, 'start of month')
+    return func.date(func.date_trunc(grain, column))
+
+
+def _as_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, str):
+        return date.fromisoformat(value)
+    return value
+
+
+# ==================== SALES ====================
+
+def sales_summary(start, end):
+    revenue, count, units = db.session.query(
+        func.coalesce(func.sum(Sale.total_amount), 0),
+        func.count(Sale.id),
+        func.coalesce(func.sum(Sale.quantity), 0),
+    ).filter(*_in_range(start, end)).one()
+    return SalesSummary(revenue, count, units)
+
+
+def revenue_by_period(start, end, grain='day'):
+    """``[(period_start, revenue, sales_count), ...]`` oldest first."""
+    period = bucket(Sale.sale_date, grain)
+    rows = db.session.query(
+        period, func.sum(Sale.total_amount), func.count(Sale.id)
+    ).filter(*_in_range(start, end)).group_by(period).order_by(period).all()
+    return [(_as_date(p), revenue, count) for p, revenue, count in rows]
+
+
+def top_medicines(start, end, limit=10):
+    """``[(name, units, revenue), ...]`` best sellers by units."""
+    return db.session.query(
+        Medicine.name,
+        func.sum(Sale.quantity),
+        func.sum(Sale.total_amount)
+    ).join(Sale, Medicine.id == Sale.medicine_id)\
+     .filter(*_in_range(start, end))\
+     .group_by(Medicine.id, Medicine.name)\
+     .order_by(func.sum(Sale.quantity).desc()).limit(limit).all()
+
+
+def revenue_by_category(start, end):
+    """``[(category, units, revenue, sales_count), ...]`` highest revenue first."""
+    return db.session.query(
+        Medicine.category,
+        func.sum(Sale.quantity),
+        func.sum(Sale.total_amount),
+        func.count(Sale.id)
+    ).join(Sale, Medicine.id == Sale.medicine_id)\
+     .filter(*_in_range(start, end))\
+     .group_by(Medicine.category)\
+     .order_by(func.sum(Sale.total_amount).desc()).all()
+
+
+# ==================== STOCK ====================
+
+def stock_summary():
+    value, units = db.session.query(
+        func.coalesce(func.sum(Medicine.quantity * Medicine.price), 0),
+        func.coalesce(func.sum(Medicine.quantity), 0),
+    ).one()
+    return StockSummary(value, units)
+
+
+def stock_by_category():
+    """``[(category, medicines, units, value), ...]`` highest value first."""
+    value = func.sum(Medicine.quantity * Medicine.price)
+    return db.session.query(
+        Medicine.category, func.count(Medicine.id), func.sum(Medicine.quantity), value
+    ).group_by(Medicine.category).order_by(value.desc()).all()
+
+
+# ==================== MARGIN & TURNOVER ====================
+
+def unit_costs(until=None):
+    """Subquery of weighted average unit cost per medicine from completed purchases."""
+    query = db.session.query(
+        PurchaseOrder.medicine_id.label('medicine_id'),
+        (func.sum(PurchaseOrder.total_amount) / func.sum(PurchaseOrder.quantity)).label('unit_cost'),
+    ).filter(PurchaseOrder.status == 'completed', PurchaseOrder.quantity > 0)
+    if until is not None:
+        query = query.filter(PurchaseOrder.order_date <= until)
+    return query.group_by(PurchaseOrder.medicine_id).subquery('unit_costs')
+
+
+def margin(start, end):
+    """Gross margin of the range, costing sales at the average purchase price.
+
+    Sales of medicines never bought through a completed purchase order have
+    no known cost; their revenue is reported as ``uncosted_revenue`` and left
+    out of the margin percentage.
+    """
+    costs = unit_costs(until=end)
+    costed = costs.c.unit_cost.isnot(None)
+    revenue, cost, costed_revenue = db.session.query(
+        func.coalesce(func.sum(Sale.total_amount), 0),
+        func.coalesce(func.sum(Sale.quantity * costs.c.unit_cost), 0),
+        func.coalesce(func.sum(case((costed, Sale.total_amount), else_=0)), 0),
+    ).outerjoin(costs, costs.c.medicine_id == Sale.medicine_id)\
+     .filter(*_in_range(start, end)).one()
+    gross = costed_revenue - cost
+    pct = (gross / costed_revenue * 100) if costed_revenue else None
+    return Margin(revenue, cost, gross, pct, revenue - costed_revenue)
+
+
+def turnover(sales, stock, days):
+    """Units sold against units on hand, from ``sales_summary``/``stock_summary``.
+
+    ``turnover`` is units sold / units on hand over the ``days`` of the range;
+    ``days_of_stock`` is how long the current stock lasts at that rate.
+    """
+    days = max(days, 1)
+    ratio = sales.units / stock.units if stock.units else None
+    days_of_stock = stock.units / (sales.units / days) if sales.units else None
+    return Turnover(sales.units, stock.units, ratio, days_of_stock)
+
+
+# ==================== BRANCHES ====================
+
+def branch_rollup(start, end):
+    """``[BranchFigures, ...]`` for every branch, by branch code.
+
+    Each figure is one query grouped by ``branch_id`` over the
+    branch-leading indexes, run once per database (the shared one, then
+    each branch with its own; see ``branches.databases``) rather than once
+    per branch.
+    """
+    sales, purchases, stock = {}, {}, {}
+    for _ in branches.databases():
+        for branch_id, *figures in db.session.query(
+                Sale.branch_id, func.sum(Sale.total_amount), func.count(Sale.id), func.sum(Sale.quantity)
+        ).filter(*_in_range(start, end)).group_by(Sale.branch_id):
+            sales[branch_id] = figures
+        purchases.update(db.session.query(PurchaseOrder.branch_id, func.sum(PurchaseOrder.total_amount))
+                         .filter(PurchaseOrder.status == 'completed',
+                                 PurchaseOrder.order_date >= start, PurchaseOrder.order_date < end)
+                         .group_by(PurchaseOrder.branch_id).all())
+        for branch_id, *figures in db.session.query(
+                Medicine.branch_id, func.count(Medicine.id),
+                func.sum(case((Medicine.quantity <= Medicine.reorder_level, 1), else_=0)),
+                func.sum(Medicine.quantity * Medicine.price)
+        ).group_by(Medicine.branch_id):
+            stock[branch_id] = figures
+    rows = []
+    for branch in db.session.query(Branch).order_by(Branch.code):
+        revenue, count, units = sales.get(branch.id, (0, 0, 0))
+        medicines, low, value = stock.get(branch.id, (0, 0, 0))
+        rows.append(BranchFigures(branch.id, branch.code, branch.name, revenue or 0, count, units or 0,
+                                  purchases.get(branch.id) or 0, medicines, low or 0, value or 0))
+    return rows
@@ -0,0 +1,229 @@
+"""Scheduled background jobs, safe to run from every gunicorn worker.
+
+Jobs are declared once with ``@job``::
+
+    @job('expiry-sweep', at='00:05')          # daily, server local time
+    def expiry_sweep(app): ...
+
+    @job('cache-warm', every=timedelta(minutes=10))
+
+Every worker starts a scheduler thread on its first request (after any
+fork, so ``gunicorn --preload`` is fine), or ``flask scheduler`` runs the
+same loop as a sidecar process. Only one of them is the *leader*: the
+worker holding the lease in ``scheduler_lock``, taken and renewed with a
+conditional UPDATE that succeeds only for the current owner or once the
+lease has expired. A worker that dies simply stops renewing, and another
+takes over within ``SCHEDULER_LEASE`` seconds.
+
+Each run is recorded in ``job_run`` with its status, duration and result.
+Whether a job is due is decided from that history, so a restart or a new
+leader neither repeats nor skips a daily slot; a missed slot (the server was
+down at 00:05) runs as soon as a leader is up again. A failed run is logged
+and tried again at the next slot or interval.
+"""
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, JobRun, SchedulerLock
+
+LEADER = 'leader'
+
+Job = namedtuple('Job', 'name fn at every')
+
+JOBS = {}
+
+lock_table = SchedulerLock.__table__
+run_table = JobRun.__table__
+
+
+def job(name, at=None, every=None):
+    """Register ``fn(app)`` to run daily ``at='HH:MM'`` or ``every`` timedelta.
+
+    Whatever the function returns is stored as the run's result.
+    """
+    if (at is None) == (every is None):
+        raise ValueError('A job runs either at a time of day or every interval.')
+
+    def decorator(fn):
+        JOBS[name] = Job(name, fn, at, every)
+        return fn
+    return decorator
+
+
+def worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+
+
+# ==================== LEADER LOCK ====================
+
+def acquire(owner, lease):
+    """Take or renew the leader lease for ``lease`` seconds; True when held."""
+    now = datetime.utcnow()
+    values = dict(owner=owner, expires_at=now + timedelta(seconds=lease))
+    try:
+        taken = db.session.execute(
+            update(lock_table)
+            .where(lock_table.c.name == LEADER,
+                   or_(lock_table.c.owner == owner, lock_table.c.expires_at < now))
+            .values(**values)
+        ).rowcount == 1
+        if not taken:
+            exists = db.session.execute(select(lock_table.c.owner)
+                                        .where(lock_table.c.name == LEADER)).first()
+            if exists is None:
+                db.session.execute(insert(lock_table).values(name=LEADER, acquired_at=now, **values))
+                taken = True
+        db.session.commit()
+        return taken
+    except IntegrityError:
+        # Another worker created the row first
+        db.session.rollback()
+        return False
+
+
+def release(owner):
+    db.session.execute(delete(lock_table).where(lock_table.c.name == LEADER,
+                                                lock_table.c.owner == owner))
+    db.session.commit()
+
+
+# ==================== DUE JOBS ====================
+
+def _slot(at, now):
+    """The latest daily slot at or before local ``now``."""
+    hour, minute = (int(part) for part in at.split(':'))
+    slot = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    return slot if slot <= now else slot - timedelta(days=1)
+
+
+def _last_run(name):
+    return db.session.execute(
+        select(run_table.c.status, run_table.c.started_at)
+        .where(run_table.c.job == name)
+        .order_by(run_table.c.started_at.desc(), run_table.c.id.desc())
+        .limit(1)
+    ).first()
+
+
+def due(job_, now_local, now_utc, timeout):
+    """``(is_due, scheduled_for)`` from the job's run history.
+
+    A daily job is due when no run has been recorded for its latest slot;
+    runs started by hand (``flask run-job``) have no slot and do not count.
+    """
+    last = _last_run(job_.name)
+    if last is not None and last.status == 'running' and last.started_at > now_utc - timeout:
+        return False, None  # still running (or its worker died less than ``timeout`` ago)
+    if job_.at is not None:
+        slot = _slot(job_.at, now_local)
+        done = db.session.execute(select(func.max(run_table.c.scheduled_for))
+                                  .where(run_table.c.job == job_.name)).scalar()
+        return done is None or done < slot, slot
+    return last is None or last.started_at <= now_utc - job_.every, None
+
+
+def run_job(app, job_, owner, scheduled_for=None):
+    """Run one job now, recording it in the history; returns the JobRun id."""
+    started = time.perf_counter()
+    run_id = db.session.execute(insert(run_table).values(
+        job=job_.name, scheduled_for=scheduled_for, owner=owner, status='running',
+        started_at=datetime.utcnow())).inserted_primary_key[0]
+    db.session.commit()
+    status, result, error = 'ok', None, None
+    try:
+        result = job_.fn(app)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        status, error = 'failed', traceback.format_exc()
+        app.logger.exception('Scheduled job %s failed', job_.name)
+    db.session.execute(update(run_table).where(run_table.c.id == run_id).values(
+        status=status, result=None if result is None else str(result), error=error,
+        finished_at=datetime.utcnow(), duration_ms=round((time.perf_counter() - started) * 1000, 1)))
+    db.session.commit()
+    return run_id
+
+
+def tick(app, owner):
+    """Run every due job if this worker is (or becomes) the leader; returns the names run."""
+    config = app.config
+    ran = []
+    if not acquire(owner, config['SCHEDULER_LEASE']):
+        return ran
+    timeout = timedelta(seconds=config['SCHEDULER_JOB_TIMEOUT'])
+    for job_ in list(JOBS.values()):
+        is_due, slot = due(job_, datetime.now(), datetime.utcnow(), timeout)
+        if not is_due:
+            continue
+        # Renew before each job so a long run does not let the lease lapse
+        if not acquire(owner, config['SCHEDULER_LEASE']):
+            break
+        run_job(app, job_, owner, slot)
+        ran.append(job_.name)
+    return ran
+
+
+# ==================== RUNNER ====================
+
+class Scheduler:
+    """The tick loop, in a daemon thread or in the foreground."""
+
+    def __init__(self, app):
+        self.app = app
+        self.owner = worker_id()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def run(self):
+        interval = self.app.config['SCHEDULER_TICK']
+        while not self.stopped.is_set():
+            with self.app.app_context():
+                try:
+                    tick(self.app, self.owner)
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception('Scheduler tick failed')
+                finally:
+                    db.session.remove()
+            self.stopped.wait(interval)
+        with self.app.app_context():
+            release(self.owner)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def history(limit=50):
+    return db.session.execute(select(run_table).order_by(run_table.c.started_at.desc(),
+                                                         run_table.c.id.desc()).limit(limit)).all()
+
+
+def init_app(app):
+    """Start a scheduler thread in each worker process on its first request."""
+    if not app.config['SCHEDULER_IN_PROCESS']:
+        return
+    started = {}
+    guard = threading.Lock()
+
+    @app.before_request
+    def _start_scheduler():
+        pid = os.getpid()
+        if pid in started:
+            return
+        with guard:
+            if pid not in started:
+                started[pid] = Scheduler(app)
+                started[pid].start()
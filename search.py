@@ -0,0 +1,247 @@
+"""Full-text medicine search.
+
+On SQLite, ``medicine_fts`` is an FTS5 index over name, generic name and
+manufacturer. It is an external-content table (it stores no copy of the
+text) kept in sync with ``medicine`` by triggers, so ORM writes, bulk
+inserts and raw SQL all update it. Lookups are a term-index search instead
+of the ``LIKE '%term%'`` table scan:
+
+* every word typed is matched as a prefix (``para`` finds "Paracetamol");
+* a word that matches nothing is retried against the index vocabulary,
+  allowing one typo (two for longer words): ``paracetmol`` still matches;
+  the first two letters must be right or merely swapped;
+* autocomplete ranks by BM25 with name weighted above generic name and
+  manufacturer, among the current branch's medicines (the index and its
+  vocabulary cover every branch).
+
+Other databases (or SQLite builds without FTS5) fall back to the old
+substring filter (case-insensitive, as LIKE is on SQLite).
+"""
+import re
+
+from sqlalchemy import or_, text
+
+from models import db, Medicine
+import branches
+
+FTS_TABLE = 'medicine_fts'
+VOCAB_TABLE = 'medicine_fts_vocab'
+
+# bm25() column weights: name, generic_name, manufacturer
+RANK_WEIGHTS = (10.0, 4.0, 1.0)
+
+CREATE_SQL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        name, generic_name, manufacturer,
+        content='medicine', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {VOCAB_TABLE} USING fts5vocab({FTS_TABLE}, 'row')",
+    f"""CREATE TRIGGER IF NOT EXISTS medicine_fts_insert AFTER INSERT ON medicine BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, name, generic_name, manufacturer)
+        VALUES (new.id, new.name, new.generic_name, new.manufacturer);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS medicine_fts_delete AFTER DELETE ON medicine BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, generic_name, manufacturer)
+        VALUES ('delete', old.id, old.name, old.generic_name, old.manufacturer);
+    END""",
+    # Only fires when a searchable column is written, not on stock updates
+    f"""CREATE TRIGGER IF NOT EXISTS medicine_fts_update
+        AFTER UPDATE OF name, generic_name, manufacturer ON medicine BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, generic_name, manufacturer)
+        VALUES ('delete', old.id, old.name, old.generic_name, old.manufacturer);
+        INSERT INTO {FTS_TABLE}(rowid, name, generic_name, manufacturer)
+        VALUES (new.id, new.name, new.generic_name, new.manufacturer);
+    END""",
+]
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+_available = set()
+
+
+# ==================== SCHEMA ====================
+
+def fts5_supported(conn):
+    if conn.dialect.name != 'sqlite':
+        return False
+    return bool(conn.exec_driver_sql("SELECT sqlite_compileoption_used('ENABLE_FTS5')").scalar())
+
+
+def create_index(conn):
+    """Create the FTS table, vocabulary view and triggers, then (re)build it."""
+    for statement in CREATE_SQL:
+        conn.exec_driver_sql(statement)
+    conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def index_available(conn):
+    key = str(conn.engine.url)
+    if key not in _available and conn.dialect.name == 'sqlite':
+        found = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,)
+        ).first()
+        if found:
+            _available.add(key)
+    return key in _available
+
+
+# ==================== QUERY BUILDING ====================
+
+def _words(term):
+    return [w.lower() for w in _WORD.findall(term or '')]
+
+
+def typo_distance(word, term, limit):
+    """Edit distance from ``word`` to the closest prefix of ``term`` and to all of it.
+
+    Optimal string alignment (a swap of neighbours is one edit), restricted
+    to a band of ``limit`` around the diagonal. Anything over ``limit`` comes
+    back as ``limit + 1``.
+    """
+    over = limit + 1
+    if len(term) > len(word) + limit:
+        term, whole = term[:len(word) + limit], False
+    else:
+        whole = True
+    previous2, previous = None, list(range(len(term) + 1))
+    for i, ca in enumerate(word, 1):
+        row = [i] + [over] * len(term)
+        best = i
+        for j in range(max(1, i - limit), min(len(term), i + limit) + 1):
+            cb = term[j - 1]
+            value = previous[j - 1] + (ca != cb)
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if row[j - 1] + 1 < value:
+                value = row[j - 1] + 1
+            if j > 1 and i > 1 and ca == term[j - 2] and word[i - 2] == cb and previous2[j - 2] + 1 < value:
+                value = previous2[j - 2] + 1
+            if value > over:
+                value = over
+            row[j] = value
+            if value < best:
+                best = value
+        if best > limit:
+            return over, over
+        previous2, previous = previous, row
+    return min(min(previous), over), (min(previous[-1], over) if whole else over)
+
+
+def _typo_limit(word):
+    if len(word) < 4:
+        return 0
+    return 1 if len(word) < 8 else 2
+
+
+def _bigrams(word):
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
+
+def _near_terms(conn, word, max_terms=8):
+    """Vocabulary terms within the typo limit of ``word``.
+
+    Only terms starting with the same two letters (or those two swapped) are
+    considered, which keeps the candidate set small on a large formulary.
+    """
+    limit = _typo_limit(word)
+    if not limit:
+        return []
+    word_bigrams = _bigrams(word)
+    scored = []
+    for start in {word[:2], word[1] + word[0]}:
+        rows = conn.exec_driver_sql(
+            f"SELECT term, doc FROM {VOCAB_TABLE} WHERE term >= ? AND term < ?",
+            (start, start + '\U0010ffff'),
+        ).all()
+        for term, doc in rows:
+            # One edit (incl. a swap) breaks at most three bigrams; cheap reject.
+            # The word may be a typo'd prefix, so only look at the term's head.
+            if len(word_bigrams - _bigrams(term[:len(word) + limit])) > 3 * limit:
+                continue
+            prefix, whole = typo_distance(word, term, limit)
+            if prefix <= limit:
+                scored.append((prefix, whole, -doc, term))
+    if not scored:
+        return []
+    # Keep only the closest spellings; whole-word matches and common terms first
+    scored.sort()
+    best = scored[0][0]
+    return [term for distance, _, _, term in scored[:max_terms] if distance == best]
+
+
+def _quote(word):
+    return '"' + word.replace('"', '""') + '"'
+
+
+def _has_match(conn, expression):
+    return conn.exec_driver_sql(
+        f"SELECT 1 FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH ? LIMIT 1", (expression,)
+    ).first() is not None
+
+
+def match_expression(conn, term, fuzzy=True):
+    """FTS5 MATCH string for ``term``: each word as a prefix, ANDed.
+
+    Words that match nothing on their own are widened to near vocabulary
+    terms when ``fuzzy`` is set. Returns None when there is nothing to search.
+    """
+    parts = []
+    for word in _words(term):
+        prefix = _quote(word) + '*'
+        if fuzzy and not _has_match(conn, prefix):
+            alternatives = [_quote(t) for t in _near_terms(conn, word)]
+            if alternatives:
+                prefix = '(' + ' OR '.join([prefix] + alternatives) + ')'
+        parts.append(prefix)
+    return ' '.join(parts) or None
+
+
+# ==================== PUBLIC API ====================
+
+def filter_clause(term):
+    """A WHERE clause restricting ``Medicine`` to rows matching ``term``."""
+    conn = db.session.connection()
+    if not index_available(conn):
+        # icontains: LIKE is case-insensitive on SQLite but not on PostgreSQL
+        return or_(Medicine.name.icontains(term),
+                   Medicine.generic_name.icontains(term),
+                   Medicine.manufacturer.icontains(term))
+    expression = match_expression(conn, term)
+    if expression is None:
+        return text('1 = 1')
+    return Medicine.id.in_(
+        text(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :fts_query')
+        .bindparams(fts_query=expression)
+    )
+
+
+def autocomplete(term, limit=10):
+    """Best matches for ``term`` as dicts, most relevant first."""
+    conn = db.session.connection()
+    columns = (Medicine.id, Medicine.name, Medicine.generic_name, Medicine.manufacturer,
+               Medicine.category, Medicine.quantity, Medicine.price)
+    if not index_available(conn):
+        rows = (db.session.query(*columns).filter(filter_clause(term))
+                .order_by(Medicine.name).limit(limit).all())
+        return [row._asdict() for row in rows]
+
+    expression = match_expression(conn, term)
+    if expression is None:
+        return []
+    weights = ', '.join(str(w) for w in RANK_WEIGHTS)
+    params = dict(fts_query=expression, limit=limit)
+    in_branch = ''
+    if branches.current() is not None:
+        # Ranked within the branch, so its best matches are not cut off by the LIMIT
+        in_branch = (f'AND EXISTS (SELECT 1 FROM medicine WHERE medicine.id = {FTS_TABLE}.rowid '
+                     'AND medicine.branch_id = :branch_id)')
+        params['branch_id'] = branches.current()
+    ranked = (text(f"""SELECT rowid AS id, bm25({FTS_TABLE}, {weights}) AS score
+                       FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :fts_query {in_branch}
+                       ORDER BY score LIMIT :limit""")
+              .bindparams(**params)
+              .columns(id=db.Integer, score=db.Float)
+              .subquery('ranked'))
+    rows = (db.session.query(*columns).join(ranked, ranked.c.id == Medicine.id)
+            .order_by(ranked.c.score).all())
+    return [row._asdict() for row in rows]
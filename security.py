@@ -0,0 +1,167 @@
+"""Password hashing and login throttling.
+
+Password hashes are slow on purpose (scrypt or PBKDF2, tens of
+milliseconds of CPU each), and at a shift change many staff sign in at
+once. ``verify()`` and ``hash_password()`` therefore run on a small
+per-process pool of ``PASSWORD_HASH_WORKERS`` threads; hashlib releases the
+GIL while it hashes, so the worker keeps serving other requests meanwhile.
+Under gevent workers, whose threads are greenlets, the hub's pool of real
+threads is used instead, as a greenlet hashing inline would stall every
+other connection of the worker. At most ``PASSWORD_HASH_QUEUE`` more
+requests wait for a thread; beyond that ``Busy`` is raised and the login
+page answers 503 straight away, rather than queueing work the client has
+given up on.
+
+Before a login attempt spends any of that, ``throttle()`` takes a token
+from two in-process token buckets, one per client address and one per
+account: a burst of ``LOGIN_*_BURST`` attempts, refilled at
+``LOGIN_*_PER_MINUTE``. The per-address bucket is generous, as a pharmacy
+shares one address; the per-account one stops password guessing. Buckets
+are per process, so the effective limits grow with the number of workers.
+
+A hash made with other parameters than ``PASSWORD_HASH_METHOD`` is
+replaced by a current one at the next successful login (``verify()``
+returns it), so raising the cost needs no password resets. Logging in as
+an unknown email costs the same hash as a known one.
+
+Pages check the login from the signed session cookie only; nothing here
+runs on requests other than login and registration.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, request
+from werkzeug.security import check_password_hash, generate_password_hash
+
+_dummy = {}
+
+
+class Busy(Exception):
+    """Every hashing thread is taken and the queue is full."""
+
+
+# ==================== HASHING ====================
+
+def _gevent_threadpool():
+    # gevent is optional: only there under `gunicorn -k gevent`
+    try:
+        from gevent import get_hub, monkey
+    except ImportError:
+        return None
+    return get_hub().threadpool if monkey.is_module_patched('threading') else None
+
+
+class PasswordPool:
+    """``workers`` hashing threads, started on first use, and room for ``queue`` waiting calls."""
+
+    def __init__(self, workers, queue):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise Busy()
+        try:
+            native = _gevent_threadpool()
+            if native is not None:
+                return native.spawn(fn, *args).get()
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password')
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+
+def _prefix(password_hash):
+    # 'scrypt:32768:8:1' of 'scrypt:32768:8:1$salt$hash'
+    return password_hash.split('$', 1)[0]
+
+
+def _current(method):
+    """A throwaway hash made with ``method``: its prefix marks current hashes,
+    and unknown emails are checked against it."""
+    if method not in _dummy:
+        _dummy[method] = generate_password_hash('', method=method)
+    return _dummy[method]
+
+
+def _check(stored, password, method):
+    dummy = _current(method)
+    if not check_password_hash(stored or dummy, password) or stored is None:
+        return False, None
+    if _prefix(stored) == _prefix(dummy):
+        return True, None
+    return True, generate_password_hash(password, method=method)
+
+
+def verify(stored, password):
+    """``(matches, new_hash)``: whether ``password`` matches ``stored`` (None for
+    no such user) and, when the hash is outdated, its replacement.
+
+    Raises ``Busy`` when no hashing thread is free.
+    """
+    return current_app.extensions['pharmasync_passwords'].run(
+        _check, stored, password or '', current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def hash_password(password):
+    """A hash of ``password`` with the current method; raises ``Busy`` like ``verify``."""
+    return current_app.extensions['pharmasync_passwords'].run(
+        generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+# ==================== THROTTLING ====================
+
+class TokenBuckets:
+    """Token buckets by key: ``burst`` tokens each, refilled at ``per_minute``.
+
+    Only the ``max_keys`` most recently used keys are kept; a dropped
+    bucket comes back full, which is where an idle one would be anyway.
+    """
+
+    def __init__(self, burst, per_minute, max_keys):
+        self.burst = burst
+        self.rate = per_minute / 60
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, now=None):
+        """Take a token for ``key``; 0 when there was one, else seconds until there is."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+def throttle(email):
+    """Seconds the client must wait before trying to log in as ``email``; 0 to go ahead.
+
+    Takes a token from the client address's bucket and the account's.
+    """
+    addresses, accounts = current_app.extensions['pharmasync_login_buckets']
+    wait = addresses.take(request.remote_addr)
+    if email:
+        wait = max(wait, accounts.take(email.strip().lower()))
+    return math.ceil(wait)
+
+
+def init_app(app):
+    app.extensions['pharmasync_passwords'] = PasswordPool(app.config['PASSWORD_HASH_WORKERS'],
+                                                          app.config['PASSWORD_HASH_QUEUE'])
+    max_keys = app.config['LOGIN_BUCKETS']
+    app.extensions['pharmasync_login_buckets'] = (
+        TokenBuckets(app.config['LOGIN_IP_BURST'], app.config['LOGIN_IP_PER_MINUTE'], max_keys),
+        TokenBuckets(app.config['LOGIN_ACCOUNT_BURST'], app.config['LOGIN_ACCOUNT_PER_MINUTE'], max_keys),
+    )
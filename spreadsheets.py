@@ -0,0 +1,250 @@
+"""Streaming CSV and XLSX exports of the report data.
+
+Three sheets, for a date range: the sales, the completed purchases (the
+report's credits and debits) and the stock valuation at the end of the
+range. Each is one SELECT run with ``yield_per``: a server-side cursor on
+PostgreSQL, SQLite's own row-by-row stepping otherwise. The response is
+written one partition of ``ROW_BATCH`` rows at a time, so memory stays the
+same for a hundred rows or ten million, and the first bytes leave as soon
+as the first partition has been read.
+
+XLSX is written here rather than with a spreadsheet library, which would
+build the whole workbook before sending any of it. A workbook is a zip of
+XML parts. ``zipfile`` can write to a stream it cannot seek (each member's
+sizes follow its data), and a ``_Pipe`` hands whatever it has written so
+far to the response. Rows use inline strings, so no shared-string table
+has to be collected first. Floats, which are all amounts here, get a
+number format. Dates and times become Excel date serials.
+
+Stock at the end of a past range is rebuilt from the stock ledger
+(``ledger.quantities_as_of``) and valued at today's prices.
+"""
+import csv
+import io
+import re
+import zipfile
+from collections import namedtuple
+from datetime import date, datetime
+from xml.sax.saxutils import escape, quoteattr
+
+from sqlalchemy import select
+
+from models import db, Medicine, PurchaseOrder, Sale, Supplier
+import ledger
+import reporting
+
+ROW_BATCH = 1000
+DATASETS = ('sales', 'purchases', 'stock')
+MIMETYPES = {'csv': 'text/csv',
+             'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'}
+
+Sheet = namedtuple('Sheet', 'title columns statement')
+
+
+# ==================== DATA ====================
+
+def sales_sheet(start_date, end_date):
+    start, end = reporting.date_range(start_date, end_date)
+    return Sheet('Sales',
+                 ('Date', 'Sale ID', 'Order ID', 'Medicine', 'Batch', 'Quantity', 'Unit Price', 'Amount',
+                  'Customer'),
+                 select(Sale.sale_date, Sale.id, Sale.order_id, Medicine.name, Medicine.batch_number,
+                        Sale.quantity, Sale.unit_price, Sale.total_amount, Sale.customer_name)
+                 .outerjoin(Medicine, Medicine.id == Sale.medicine_id)
+                 .where(Sale.sale_date >= start, Sale.sale_date < end)
+                 .order_by(Sale.sale_date, Sale.id))
+
+
+def purchases_sheet(start_date, end_date):
+    start, end = reporting.date_range(start_date, end_date)
+    return Sheet('Purchases',
+                 ('Order Date', 'Order ID', 'Delivered', 'Supplier', 'Medicine', 'Quantity', 'Unit Price',
+                  'Amount'),
+                 select(PurchaseOrder.order_date, PurchaseOrder.id, PurchaseOrder.delivery_date, Supplier.name,
+                        Medicine.name, PurchaseOrder.quantity, PurchaseOrder.unit_price,
+                        PurchaseOrder.total_amount)
+                 .outerjoin(Supplier, Supplier.id == PurchaseOrder.supplier_id)
+                 .outerjoin(Medicine, Medicine.id == PurchaseOrder.medicine_id)
+                 .where(PurchaseOrder.status == 'completed',
+                        PurchaseOrder.order_date >= start, PurchaseOrder.order_date < end)
+                 .order_by(PurchaseOrder.order_date, PurchaseOrder.id))
+
+
+def stock_sheet(start_date, end_date, today=None):
+    """Stock at the end of ``end_date``: the medicines' quantities when that is
+    today or later, the ledger's otherwise (``LookupError`` before it began)."""
+    today = today or date.today()
+    columns = ('Medicine ID', 'Medicine', 'Category', 'Batch', 'Quantity', 'Unit Price', 'Value', 'Expiry')
+    if end_date >= today:
+        quantity = Medicine.quantity
+        statement = select(Medicine.id).where(Medicine.quantity != 0)
+    else:
+        _, end = reporting.date_range(end_date, end_date)
+        held = ledger.quantities_as_of(db.session.connection(), end).subquery()
+        quantity = held.c.quantity
+        statement = select(Medicine.id).join(held, held.c.medicine_id == Medicine.id).where(held.c.quantity != 0)
+    statement = statement.add_columns(Medicine.name, Medicine.category, Medicine.batch_number, quantity,
+                                      Medicine.price, quantity * Medicine.price, Medicine.expiry_date)
+    return Sheet(f'Stock {end_date:%Y-%m-%d}', columns, statement.order_by(Medicine.name, Medicine.id))
+
+
+SHEETS = {'sales': sales_sheet, 'purchases': purchases_sheet, 'stock': stock_sheet}
+
+
+def sheet(dataset, start_date, end_date):
+    return SHEETS[dataset](start_date, end_date)
+
+
+def partitions(statement, batch_size=ROW_BATCH):
+    """Lists of up to ``batch_size`` rows, fetched as they are asked for."""
+    return db.session.execute(statement.execution_options(yield_per=batch_size)).partitions()
+
+
+# ==================== CSV ====================
+
+def csv_chunks(sheet, batch_size=ROW_BATCH):
+    """``sheet`` as CSV text, one chunk per partition of rows."""
+    buf = io.StringIO()
+    # Excel only takes CSV for UTF-8 with a byte-order mark
+    buf.write('﻿')
+    writer = csv.writer(buf)
+    writer.writerow(sheet.columns)
+    for rows in partitions(sheet.statement, batch_size):
+        writer.writerows(rows)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+# ==================== XLSX ====================
+
+class _Pipe(io.RawIOBase):
+    """Where zipfile writes; ``take()`` returns what was written since the last call."""
+
+    def __init__(self):
+        self._parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+_RELATIONSHIPS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+_PACKAGE_RELATIONSHIPS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml'
+
+# Cell styles (cellXfs): 0 plain, 1 date, 2 date and time, 3 amount, 4 header
+_DATE, _DATETIME, _AMOUNT, _HEADER = 1, 2, 3, 4
+_STYLES = (
+    f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<styleSheet xmlns="{_MAIN}">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="5"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="14" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+# The header row stays in view while scrolling
+_SHEET_HEAD = (
+    f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<worksheet xmlns="{_MAIN}">'
+    '<sheetViews><sheetView workbookViewId="0">'
+    '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+    '</sheetView></sheetViews><sheetData>'
+).encode()
+_SHEET_TAIL = b'</sheetData></worksheet>'
+_EPOCH = datetime(1899, 12, 30)
+# Characters XML 1.0 does not allow at all
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+
+def _package(titles):
+    """The workbook's fixed parts for sheets named ``titles``, as ``(name, xml)``."""
+    sheets = range(1, len(titles) + 1)
+    yield '[Content_Types].xml', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        f'<Override PartName="/xl/workbook.xml" ContentType="{_CONTENT_TYPE}.sheet.main+xml"/>'
+        f'<Override PartName="/xl/styles.xml" ContentType="{_CONTENT_TYPE}.styles+xml"/>'
+        + ''.join(f'<Override PartName="/xl/worksheets/sheet{n}.xml" ContentType="{_CONTENT_TYPE}.worksheet+xml"/>'
+                  for n in sheets)
+        + '</Types>')
+    yield '_rels/.rels', (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{_PACKAGE_RELATIONSHIPS}">'
+        f'<Relationship Id="rId1" Type="{_RELATIONSHIPS}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>')
+    yield 'xl/workbook.xml', (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        f'<workbook xmlns="{_MAIN}" xmlns:r="{_RELATIONSHIPS}"><sheets>'
+        + ''.join(f'<sheet name={quoteattr(title)} sheetId="{n}" r:id="rId{n}"/>'
+                  for n, title in zip(sheets, titles))
+        + '</sheets></workbook>')
+    yield 'xl/_rels/workbook.xml.rels', (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Relationships xmlns="{_PACKAGE_RELATIONSHIPS}">'
+        + ''.join(f'<Relationship Id="rId{n}" Type="{_RELATIONSHIPS}/worksheet" Target="worksheets/sheet{n}.xml"/>'
+                  for n in sheets)
+        + f'<Relationship Id="rId{len(titles) + 1}" Type="{_RELATIONSHIPS}/styles" Target="styles.xml"/>'
+        '</Relationships>')
+    yield 'xl/styles.xml', _STYLES
+
+
+def _cell(value, style=0):
+    # Cells carry no reference; each row lists all of its cells in order
+    if value is None:
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, datetime):
+        delta = value - _EPOCH
+        return f'<c s="{_DATETIME}"><v>{delta.days + delta.seconds / 86400 + delta.microseconds / 86400e6}</v></c>'
+    if isinstance(value, date):
+        return f'<c s="{_DATE}"><v>{(value - _EPOCH.date()).days}</v></c>'
+    if isinstance(value, int):
+        return f'<c><v>{value}</v></c>'
+    if isinstance(value, float):
+        return f'<c s="{_AMOUNT}"><v>{value!r}</v></c>'
+    text = escape(_INVALID_XML.sub('', str(value)))
+    style = f' s="{style}"' if style else ''
+    return f'<c t="inlineStr"{style}><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _row(values, style=0):
+    return '<row>' + ''.join(_cell(value, style) for value in values) + '</row>'
+
+
+def xlsx_chunks(sheets, batch_size=ROW_BATCH):
+    """A workbook with one worksheet per ``Sheet``, as bytes, one chunk per partition of rows."""
+    pipe = _Pipe()
+    with zipfile.ZipFile(pipe, 'w', zipfile.ZIP_DEFLATED) as book:
+        for name, xml in _package([sheet.title for sheet in sheets]):
+            book.writestr(name, xml)
+        yield pipe.take()
+        for n, sheet in enumerate(sheets, 1):
+            # The size is unknown up front; zip64 keeps sheets over 2 GiB valid
+            with book.open(f'xl/worksheets/sheet{n}.xml', 'w', force_zip64=True) as part:
+                part.write(_SHEET_HEAD)
+                part.write(_row(sheet.columns, _HEADER).encode())
+                for rows in partitions(sheet.statement, batch_size):
+                    part.write(''.join(_row(row) for row in rows).encode())
+                    yield pipe.take()
+                part.write(_SHEET_TAIL)
+    yield pipe.take()
@@ -0,0 +1,364 @@
+"""Precomputed dashboard statistics.
+
+Each branch's dashboard counters live in its ``DashboardStats`` row (the
+id is the branch id) and its revenue in per-day ``DailySales`` buckets. An
+``after_flush`` hook applies the delta of every Medicine and Sale
+insert/update/delete to its branch's row in the same transaction as the
+change itself, so reading the dashboard is one primary-key lookup.
+
+Time moves some numbers without any write: medicines expire and months end.
+``current()`` rolls the row forward on read, counting only the medicines
+whose expiry date passed since the last roll-over (an expiry_date index
+range) and re-summing the new month from the daily buckets.
+
+Nightly jobs (jobs.py) add what is too heavy to keep per write: units and
+revenue per medicine per closed day (``MedicineDailySales``), and how much
+in-stock batch stock has expired or is about to.
+"""
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event, func, inspect, select, update
+from sqlalchemy.orm.base import NO_VALUE
+
+from models import db, Branch, DailySales, DashboardStats, Medicine, MedicineDailySales, Sale, StockBatch
+import dbconfig
+
+_MEDICINE_KEYS = ('quantity', 'reorder_level', 'expiry_date', 'category')
+_UNKNOWN = object()
+
+stats_table = DashboardStats.__table__
+daily_table = DailySales.__table__
+medicine_daily_table = MedicineDailySales.__table__
+batch_table = StockBatch.__table__
+medicine_table = Medicine.__table__
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def categories(stats):
+    """``[(category, count), ...]`` like the old GROUP BY, uncategorised first."""
+    items = [((name or None), count) for name, count in stats.category_counts.items()]
+    return sorted(items, key=lambda item: (item[0] is not None, item[0] or ''))
+
+
+def _branch(branch_id=None):
+    return branch_id or dbconfig.current_branch() or dbconfig.DEFAULT_BRANCH
+
+
+def branch_ids(conn):
+    """The branches whose counters live in ``conn``'s database: the current
+    one, or every branch without a database of its own."""
+    if dbconfig.current_branch() is not None:
+        return [dbconfig.current_branch()]
+    own = dbconfig.branch_engines(db)
+    return [branch_id for branch_id in conn.execute(select(Branch.id).order_by(Branch.id)).scalars()
+            if branch_id not in own] or [dbconfig.DEFAULT_BRANCH]
+
+
+# ==================== FULL REBUILD ====================
+
+def _medicine_counters(conn, as_of, branch_id):
+    in_branch = Medicine.branch_id == branch_id
+    total = conn.execute(select(func.count(Medicine.id)).where(in_branch)).scalar()
+    low = conn.execute(select(func.count(Medicine.id))
+                       .where(in_branch, Medicine.quantity <= Medicine.reorder_level)).scalar()
+    expired = conn.execute(select(func.count(Medicine.id))
+                           .where(in_branch, Medicine.expiry_date < as_of)).scalar()
+    by_category = conn.execute(select(Medicine.category, func.count(Medicine.id))
+                               .where(in_branch)
+                               .group_by(Medicine.category)).all()
+    category_counts = {}
+    for name, count in by_category:
+        # NULL and '' are both "no category"
+        category_counts[name or ''] = category_counts.get(name or '', 0) + count
+    return dict(total_medicines=total,
+                low_stock_count=low,
+                expired_count=expired,
+                expired_as_of=as_of,
+                category_counts=category_counts)
+
+
+def rebuild_branch(conn, branch_id, today=None):
+    """Recompute one branch's counters and daily buckets from the base tables."""
+    today = today or date.today()
+    sale_day = func.date(Sale.sale_date)
+    conn.execute(daily_table.delete().where(daily_table.c.branch_id == branch_id))
+    conn.execute(daily_table.insert().from_select(
+        ['branch_id', 'day', 'revenue', 'sales_count'],
+        select(Sale.branch_id, sale_day, func.sum(Sale.total_amount), func.count(Sale.id))
+        .where(Sale.branch_id == branch_id)
+        .group_by(Sale.branch_id, sale_day)
+    ))
+    values = _medicine_counters(conn, today, branch_id)
+    values.update(month_start=month_start(today),
+                  monthly_revenue=_revenue_since(conn, branch_id, month_start(today)),
+                  updated_at=datetime.utcnow())
+    conn.execute(stats_table.delete().where(stats_table.c.id == branch_id))
+    conn.execute(stats_table.insert().values(id=branch_id, **values))
+
+
+def rebuild(conn, today=None):
+    """Recompute everything from the base tables (first run, or after bulk SQL)."""
+    today = today or date.today()
+    for branch_id in branch_ids(conn):
+        rebuild_branch(conn, branch_id, today)
+    conn.execute(medicine_daily_table.delete())
+    roll_up(conn, today)
+
+
+def _revenue_since(conn, branch_id, start):
+    return conn.execute(select(func.sum(DailySales.revenue))
+                        .where(DailySales.branch_id == branch_id, DailySales.day >= start)).scalar() or 0
+
+
+# ==================== NIGHTLY ROLLUPS ====================
+
+def rolled_through(conn):
+    """The last day in the per-medicine rollup, or None before the first run."""
+    return conn.execute(select(func.max(MedicineDailySales.day))).scalar()
+
+
+def roll_up(conn, today=None, lookback=0):
+    """Sum closed days of sales into ``MedicineDailySales``; returns the days rolled.
+
+    Covers the days after the last rolled one through yesterday, all history
+    on the first run. ``lookback`` re-rolls that many already rolled days
+    as well, for sales imported late with past dates.
+    """
+    today = today or date.today()
+    last = rolled_through(conn)
+    if last is not None and not isinstance(last, date):
+        last = date.fromisoformat(last)
+    start = None if last is None else last + timedelta(days=1 - lookback)
+    end = datetime.combine(today, datetime.min.time())
+    in_range = [Sale.sale_date < end, Sale.medicine_id.isnot(None)]
+    if start is not None:
+        if start >= today:
+            return 0
+        in_range.append(Sale.sale_date >= datetime.combine(start, datetime.min.time()))
+        conn.execute(medicine_daily_table.delete().where(medicine_daily_table.c.day >= start,
+                                                         medicine_daily_table.c.day < today))
+    sale_day = func.date(Sale.sale_date)
+    conn.execute(medicine_daily_table.insert().from_select(
+        ['day', 'medicine_id', 'units', 'revenue', 'sales_count'],
+        select(sale_day, Sale.medicine_id, func.sum(Sale.quantity), func.sum(Sale.total_amount),
+               func.count(Sale.id))
+        .where(*in_range)
+        .group_by(sale_day, Sale.medicine_id)
+    ))
+    first = start or conn.execute(select(func.min(MedicineDailySales.day))).scalar()
+    if first is None:
+        return 0
+    if not isinstance(first, date):
+        first = date.fromisoformat(first)
+    return (today - first).days
+
+
+def sweep_expiry(conn, today=None, expiring_days=30):
+    """Roll every branch's counters over to ``today`` and record expired and expiring batch stock."""
+    today = today or date.today()
+    ids = branch_ids(conn)
+    rows = {row.id: row for row in conn.execute(select(stats_table).where(stats_table.c.id.in_(ids)))}
+    for branch_id in ids:
+        if branch_id in rows:
+            roll_forward(conn, rows[branch_id], today)
+        else:
+            rebuild_branch(conn, branch_id, today)
+    # Batch stock per branch, each figure in one grouped query
+    branch = medicine_table.c.branch_id
+    batch_branches = batch_table.join(medicine_table, medicine_table.c.id == batch_table.c.medicine_id)
+    in_stock = (batch_table.c.quantity > 0, branch.in_(ids))
+    expired = {branch_id: (units, count) for branch_id, units, count in conn.execute(
+        select(branch, func.coalesce(func.sum(batch_table.c.quantity), 0), func.count(batch_table.c.id))
+        .select_from(batch_branches)
+        .where(*in_stock, batch_table.c.expiry_date < today)
+        .group_by(branch)
+    )}
+    expiring = dict(conn.execute(
+        select(branch, func.count(batch_table.c.id))
+        .select_from(batch_branches)
+        .where(*in_stock, batch_table.c.expiry_date.between(today, today + timedelta(days=expiring_days)))
+        .group_by(branch)
+    ).all())
+    for branch_id in ids:
+        units, batches = expired.get(branch_id, (0, 0))
+        conn.execute(update(stats_table).where(stats_table.c.id == branch_id).values(
+            expired_stock_units=units, expired_batches=batches, expiring_batches=expiring.get(branch_id, 0),
+            expiry_swept_on=today))
+    return dict(branches=len(ids),
+                expired_batches=sum(batches for _, batches in expired.values()),
+                expired_units=sum(units for units, _ in expired.values()),
+                expiring_batches=sum(expiring.values()))
+
+
+# ==================== READ PATH ====================
+
+def roll_forward(conn, row, today):
+    """Bring expiry and month totals up to ``today``. Returns True if changed."""
+    values = {}
+    if row.expired_as_of < today:
+        newly_expired = conn.execute(select(func.count(Medicine.id)).where(
+            Medicine.branch_id == row.id,
+            Medicine.expiry_date >= row.expired_as_of, Medicine.expiry_date < today
+        )).scalar()
+        values.update(expired_count=stats_table.c.expired_count + newly_expired,
+                      expired_as_of=today)
+    if row.month_start != month_start(today):
+        values.update(month_start=month_start(today),
+                      monthly_revenue=_revenue_since(conn, row.id, month_start(today)))
+    if not values:
+        return False
+    # Guard on the old markers so two workers rolling at once apply it once
+    conn.execute(update(stats_table)
+                 .where(stats_table.c.id == row.id,
+                        stats_table.c.expired_as_of == row.expired_as_of,
+                        stats_table.c.month_start == row.month_start)
+                 .values(updated_at=datetime.utcnow(), **values))
+    return True
+
+
+def current(today=None):
+    """The current branch's up-to-date counters row, building it on first use.
+
+    Read on the primary with the statements that refresh it: on a replica
+    that has not caught up the row just written would not be there yet.
+    """
+    today = today or date.today()
+    branch_id = _branch()
+    conn = db.session.connection()
+    read = select(stats_table).where(stats_table.c.id == branch_id)
+    stats = conn.execute(read).first()
+    if stats is None:
+        rebuild_branch(conn, branch_id, today)
+    elif not roll_forward(conn, stats, today):
+        return stats
+    stats = conn.execute(read).first()
+    db.session.commit()
+    return stats
+
+
+def recent_days(days=7, today=None):
+    """``[(day, revenue, sales_count), ...]`` for the current branch's last
+    ``days`` days, today included, oldest first; days without sales are 0."""
+    today = today or date.today()
+    start = today - timedelta(days=days - 1)
+    found = {day: (revenue, count) for day, revenue, count in db.session.execute(
+        select(DailySales.day, DailySales.revenue, DailySales.sales_count)
+        .where(DailySales.branch_id == _branch(), DailySales.day >= start, DailySales.day <= today))}
+    return [(day, *found.get(day, (0, 0)))
+            for day in (start + timedelta(days=n) for n in range(days))]
+
+
+# ==================== WRITE PATH ====================
+
+def _snapshot(obj, old):
+    """Medicine values before (``old``) or after this flush, without loading.
+
+    Returns _UNKNOWN when a value was never loaded, e.g. a column left out
+    by load_only or a previous value that was expired before the change.
+    """
+    state = inspect(obj)
+    values = []
+    for key in _MEDICINE_KEYS:
+        if old and key in state.committed_state:
+            value = state.committed_state[key]
+        elif key in state.dict:
+            value = state.dict[key]
+        else:
+            value = None if state.pending else NO_VALUE
+        if value is NO_VALUE:
+            return _UNKNOWN
+        values.append(value)
+    return tuple(values)
+
+
+def _facts(values, as_of):
+    quantity, reorder_level, expiry_date, category = values
+    low = quantity is not None and reorder_level is not None and quantity <= reorder_level
+    expired = expiry_date is not None and expiry_date < as_of
+    return int(low), int(expired), category or ''
+
+
+def apply_changes(conn, medicine_changes=(), sales=(), branch_id=None):
+    """Fold changes into a branch's stats row (default: the current branch's).
+
+    ``medicine_changes`` holds ``(before, after)`` pairs of
+    ``(quantity, reorder_level, expiry_date, category)`` tuples, None for an
+    insert's before or a delete's after. ``sales`` holds
+    ``(sale_datetime, total_amount, +1/-1)``.
+    """
+    branch_id = _branch(branch_id)
+    row = conn.execute(select(stats_table).where(stats_table.c.id == branch_id)
+                       .with_for_update()).first()
+    if row is None or any(_UNKNOWN in change for change in medicine_changes):
+        rebuild_branch(conn, branch_id)
+        return
+
+    total = low = expired = revenue = 0
+    category_counts = dict(row.category_counts)
+    for before, after in medicine_changes:
+        for values, sign in ((before, -1), (after, 1)):
+            if values is None:
+                continue
+            is_low, is_expired, category = _facts(values, row.expired_as_of)
+            total += sign
+            low += sign * is_low
+            expired += sign * is_expired
+            category_counts[category] = category_counts.get(category, 0) + sign
+            if not category_counts[category]:
+                del category_counts[category]
+
+    buckets = {}
+    for sold_at, amount, sign in sales:
+        day = (sold_at or datetime.utcnow()).date()
+        bucket = buckets.setdefault(day, [0, 0])
+        bucket[0] += sign * (amount or 0)
+        bucket[1] += sign
+        if day >= row.month_start:
+            revenue += sign * (amount or 0)
+
+    conn.execute(update(stats_table).where(stats_table.c.id == branch_id).values(
+        total_medicines=stats_table.c.total_medicines + total,
+        low_stock_count=stats_table.c.low_stock_count + low,
+        expired_count=stats_table.c.expired_count + expired,
+        category_counts=category_counts,
+        monthly_revenue=stats_table.c.monthly_revenue + revenue,
+        updated_at=datetime.utcnow(),
+    ))
+    for day, (amount, count) in buckets.items():
+        bumped = conn.execute(update(daily_table)
+                              .where(daily_table.c.branch_id == branch_id, daily_table.c.day == day)
+                              .values(revenue=daily_table.c.revenue + amount,
+                                      sales_count=daily_table.c.sales_count + count))
+        if bumped.rowcount == 0:
+            conn.execute(daily_table.insert().values(branch_id=branch_id, day=day, revenue=amount,
+                                                     sales_count=count))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_changes(session, flush_context):
+    # {branch_id: (medicine_changes, sales)}; None when the branch was not loaded
+    changes = {}
+
+    def add(obj, change, is_sale=False):
+        changes.setdefault(inspect(obj).dict.get('branch_id'), ([], []))[is_sale].append(change)
+
+    for obj in session.new:
+        if isinstance(obj, Medicine):
+            add(obj, (None, _snapshot(obj, old=False)))
+        elif isinstance(obj, Sale):
+            add(obj, (obj.sale_date, obj.total_amount, 1), is_sale=True)
+    for obj in session.dirty:
+        if isinstance(obj, Medicine) and session.is_modified(obj, include_collections=False):
+            before, after = _snapshot(obj, old=True), _snapshot(obj, old=False)
+            if before != after:
+                add(obj, (before, after))
+    for obj in session.deleted:
+        if isinstance(obj, Medicine):
+            add(obj, (_snapshot(obj, old=True), None))
+        elif isinstance(obj, Sale):
+            add(obj, (obj.sale_date, obj.total_amount, -1), is_sale=True)
+    for branch_id, (medicine_changes, sales) in changes.items():
+        apply_changes(session.connection(), medicine_changes, sales, branch_id)
@@ -0,0 +1,237 @@
+"""Stock movements that are safe under concurrent requests.
+
+Stock used to be read into Python, checked and written back, so two tills
+selling the last units of a medicine at the same moment could both pass the
+check. Here the check is part of the write::
+
+    UPDATE medicine SET quantity = quantity - :qty
+    WHERE id = :id AND quantity >= :qty
+
+and an update that matches no row means there was not enough stock. A
+basket takes all its medicines in one such statement (the quantities come
+from a CASE on the id), so a sale of five items is still a single check and
+write. The counters in ``stats`` are given the before/after values from
+``RETURNING``, as the ORM hook would for a normal flush, and the units are
+then taken from the medicine's batches first-expiry-first (batches.py).
+Every change is also appended to the stock ledger (ledger.py) in the same
+transaction and queued for the live stock feed (events.py), which
+announces it once the transaction commits. These are Core statements, so
+they carry the current branch's condition themselves (branches.py): a
+medicine of another branch is "not found".
+
+``with_retry`` wraps a unit of work and re-runs it with exponential backoff
+when the database reports a transient conflict (SQLite's "database is
+locked", PostgreSQL serialization failures and deadlocks).
+"""
+import random
+import time
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import case, select, update
+from sqlalchemy.exc import OperationalError
+
+from models import db, Medicine, PurchaseOrder, Sale, SalesOrder
+import batches
+import branches
+import events
+import ledger
+import stats as dashboard_stats
+
+medicine_table = Medicine.__table__
+purchase_order_table = PurchaseOrder.__table__
+
+_SNAPSHOT = (medicine_table.c.quantity, medicine_table.c.reorder_level,
+             medicine_table.c.expiry_date, medicine_table.c.category)
+
+# SQLSTATEs worth retrying: serialization_failure, deadlock_detected
+_RETRY_SQLSTATES = ('40001', '40P01')
+
+
+class OutOfStock(Exception):
+    """One or more medicines lack the stock asked for.
+
+    ``shortages`` holds ``(medicine_id, name, requested, available)``.
+    """
+
+    def __init__(self, shortages):
+        self.shortages = shortages
+        super().__init__('; '.join(
+            f'Insufficient stock for {name}! Only {available} left.'
+            for _, name, _, available in shortages
+        ))
+
+    def to_dict(self):
+        return [dict(medicine_id=medicine_id, name=name, requested=requested, available=available)
+                for medicine_id, name, requested, available in self.shortages]
+
+
+# ==================== RETRIES ====================
+
+def is_transient(error):
+    orig = getattr(error, 'orig', error)
+    if getattr(orig, 'pgcode', None) in _RETRY_SQLSTATES:
+        return True
+    message = str(orig).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def with_retry(work, attempts=None, delay=None):
+    """Run ``work()`` and commit, retrying transient lock errors with backoff."""
+    config = current_app.config
+    attempts = attempts or config['WRITE_RETRIES']
+    delay = config['WRITE_RETRY_DELAY'] if delay is None else delay
+    for attempt in range(1, attempts + 1):
+        try:
+            result = work()
+            db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt == attempts or not is_transient(e):
+                raise
+            # Exponential backoff with jitter so retrying writers spread out
+            time.sleep(delay * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+
+# ==================== MOVEMENTS ====================
+
+def _apply(medicine_id, delta, reason, reference=None, condition=None):
+    """Add ``delta`` to a medicine's stock in one statement; returns the new row or None."""
+    stmt = (update(medicine_table)
+            .where(medicine_table.c.id == medicine_id, branches.scope(medicine_table.c.branch_id))
+            .values(quantity=medicine_table.c.quantity + delta, updated_at=datetime.utcnow())
+            .returning(medicine_table.c.price, *_SNAPSHOT))
+    if condition is not None:
+        stmt = stmt.where(condition)
+    row = db.session.execute(stmt).first()
+    if row is not None:
+        after = tuple(row[1:])
+        before = (after[0] - delta,) + after[1:]
+        conn = db.session.connection()
+        dashboard_stats.apply_changes(conn, [(before, after)])
+        ledger.record(conn, reason, [(medicine_id, delta, row.quantity)], reference)
+        events.stock_changed(medicine_id, row.quantity, delta, row.reorder_level)
+    return row
+
+
+def take(quantities, reason=ledger.SALE, reference=None):
+    """Take stock for several medicines at once: ``{medicine_id: quantity}``.
+
+    One conditional UPDATE covers every medicine; if any of them is short
+    ``OutOfStock`` lists all the shortages. The lines that did fit are then
+    taken but not recorded, so the caller rolls back its transaction (the
+    order written so far with it) before going on. Returns the updated rows
+    keyed by medicine id.
+    """
+    if not quantities:
+        raise ValueError('Nothing to sell.')
+    if any(q <= 0 for q in quantities.values()):
+        raise ValueError('Quantity must be at least 1.')
+    ids = list(quantities)
+    needed = case(quantities, value=medicine_table.c.id)
+    in_branch = branches.scope(medicine_table.c.branch_id)
+    rows = db.session.execute(
+        update(medicine_table)
+        .where(medicine_table.c.id.in_(ids), in_branch, medicine_table.c.quantity >= needed)
+        .values(quantity=medicine_table.c.quantity - needed, updated_at=datetime.utcnow())
+        .returning(medicine_table.c.id, medicine_table.c.price, *_SNAPSHOT)
+    ).all()
+    if len(rows) < len(ids):
+        # Lines that were not updated are still as they were; the caller's rollback undoes the rest
+        taken = {row.id for row in rows}
+        current = db.session.execute(
+            select(medicine_table.c.id, medicine_table.c.name, medicine_table.c.quantity)
+            .where(medicine_table.c.id.in_([i for i in ids if i not in taken]), in_branch)
+        ).all()
+        missing = set(ids) - taken - {row.id for row in current}
+        if missing:
+            raise LookupError(f'Medicine {", ".join(str(i) for i in sorted(missing))} not found.')
+        raise OutOfStock([(row.id, row.name, quantities[row.id], row.quantity) for row in current])
+    conn = db.session.connection()
+    changes = []
+    for row in rows:
+        after = tuple(row[2:])
+        changes.append(((after[0] + quantities[row.id],) + after[1:], after))
+        events.stock_changed(row.id, row.quantity, -quantities[row.id], row.reorder_level)
+    dashboard_stats.apply_changes(conn, changes)
+    ledger.record(conn, reason, [(row.id, -quantities[row.id], row.quantity) for row in rows], reference)
+    # The units come out of the batches that expire first
+    batches.refresh_expiry(conn, batches.consume(conn, quantities))
+    return {row.id: row for row in rows}
+
+
+def decrement(medicine_id, quantity, reason=ledger.SALE, reference=None):
+    """Take ``quantity`` units of one medicine, or raise ``OutOfStock``. Returns the new row."""
+    return take({medicine_id: quantity}, reason, reference)[medicine_id]
+
+
+def increment(medicine_id, quantity, reason=ledger.RECEIPT, reference=None):
+    return _apply(medicine_id, quantity, reason, reference)
+
+
+def sell_order(lines, customer_name=None):
+    """Ring up a basket: ``lines`` is ``[(medicine_id, quantity), ...]``.
+
+    All stock is taken in one statement and the order and its lines are
+    written in the caller's transaction. Lines for the same medicine keep
+    their own rows but are checked against stock together.
+    """
+    quantities = {}
+    for medicine_id, quantity in lines:
+        quantities[medicine_id] = quantities.get(medicine_id, 0) + quantity
+    if any(quantity <= 0 for _, quantity in lines):
+        raise ValueError('Quantity must be at least 1.')
+
+    now = datetime.utcnow()
+    order = SalesOrder(customer_name=customer_name, created_at=now)
+    db.session.add(order)
+    # The header is written first so the ledger's movements can name it
+    db.session.flush()
+    taken = take(quantities, reference=f'sales_order:{order.id}')
+
+    for medicine_id, quantity in lines:
+        price = taken[medicine_id].price
+        order.lines.append(Sale(medicine_id=medicine_id,
+                                quantity=quantity,
+                                unit_price=price,
+                                total_amount=quantity * price,
+                                sale_date=now,
+                                customer_name=customer_name))
+    order.total_amount = sum(line.total_amount for line in order.lines)
+    order.item_count = sum(line.quantity for line in order.lines)
+    db.session.flush()
+    return order
+
+
+def sell(medicine_id, quantity, customer_name=None):
+    """Record a single-line sale; returns the ``Sale``."""
+    return sell_order([(medicine_id, quantity)], customer_name).lines[0]
+
+
+def receive(order_id, batch_number=None, expiry_date=None):
+    """Complete a pending purchase order: its quantity becomes a new stock batch.
+
+    The status change is conditional too, so an order completed twice at
+    once (a double click, two users) only adds its stock once. Returns False
+    when the order is not pending; raises ``LookupError`` when its medicine
+    is gone or belongs to another branch, leaving the caller to roll back.
+    """
+    order = db.session.execute(
+        update(purchase_order_table)
+        .where(purchase_order_table.c.id == order_id, purchase_order_table.c.status == 'pending',
+               branches.scope(purchase_order_table.c.branch_id))
+        .values(status='completed', delivery_date=datetime.utcnow())
+        .returning(purchase_order_table.c.medicine_id, purchase_order_table.c.quantity,
+                   purchase_order_table.c.unit_price)
+    ).first()
+    if order is None:
+        return False
+    # The stock first: its batch is only added once the medicine has taken it
+    if increment(order.medicine_id, order.quantity, reference=f'purchase_order:{order_id}') is None:
+        raise LookupError(f'Medicine {order.medicine_id} not found.')
+    conn = db.session.connection()
+    batches.add(conn, order.medicine_id, order.quantity, batch_number, expiry_date,
+                unit_cost=order.unit_price, purchase_order_id=order_id)
+    batches.refresh_expiry(conn, [order.medicine_id])
+    return True
@@ -0,0 +1,250 @@
+"""Sync for POS terminals that keep selling while the network is down.
+
+A terminal keeps its own copy of the medicine list and a queue of the
+sales it rang up, and exchanges both with the server whenever it can reach
+it (``/api/v1/sync/...`` in api.py).
+
+Pull. Every insert and update of a medicine -- by the ORM, the conditional
+stock UPDATEs, bulk imports -- sets its ``change_version`` from a counter
+row taken once per transaction and held until commit (models.py). Versions
+therefore become visible in increasing order, and "everything after
+version N" never skips a transaction that commits late. ``changes()``
+returns the medicines changed after the terminal's watermark in version
+order, read from the ``(branch_id, change_version, id)`` index, as
+compact rows of ``FIELDS``. Deleted medicines leave a tombstone with a
+version of its own; a terminal applies a page's ``deleted`` before its
+``medicines``, as an id can come back for a new medicine with a later
+version. The terminal stores the returned ``version`` (and
+``after``, while ``more`` is true) and asks again from there. ``since=0``
+is the whole list, to replace the local copy with. Tombstones are pruned
+after ``SYNC_TOMBSTONE_DAYS``; a watermark older than that gets
+``ResyncRequired`` (410) and starts again from 0.
+
+Push. Queued sales go up in batches, each with an id the terminal made
+(a UUID). ``push()`` records the ones whose id is new as sales orders and
+answers ``duplicate`` with the order id for the others, so a batch resent
+after a lost reply is not counted twice. Conflicts are settled like this:
+
+* the sale happened, so it is always recorded, dated when it was rung up
+  and at the price the terminal charged (``price`` conflict when that
+  differs from the current price);
+* the server's stock is authoritative. A line takes what is on hand, down
+  to zero, and the rest is reported as a ``short`` conflict -- the shelf
+  held stock the books did not -- and logged for a stock count. Sales in a
+  batch are applied in the order sent.
+
+A batch is one transaction. It takes the change counter before reading
+stock, which holds off every other stock writer until it commits, so the
+quantities it clamps to cannot move under it.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import and_, delete, event, func, or_, select, update
+
+from models import db, change_version, ChangeCounter, Medicine, MedicineTombstone, Sale, SalesOrder
+import stock
+
+FIELDS = ('id', 'name', 'batch_number', 'price', 'quantity', 'expiry_date')
+PAGE_SIZE = 1000
+MAX_CLIENT_ID = 64
+
+OfflineSale = namedtuple('OfflineSale', 'client_id sold_at customer_name lines')
+Line = namedtuple('Line', 'medicine_id quantity unit_price')
+
+
+class ResyncRequired(Exception):
+    """The watermark is older than the oldest tombstone kept."""
+
+
+# ==================== PULL ====================
+
+def _counter():
+    row = db.session.execute(select(ChangeCounter.version, ChangeCounter.pruned_through)
+                             .where(ChangeCounter.id == 1)).first()
+    return row or (0, 0)
+
+
+def changes(since=0, after=None, limit=PAGE_SIZE):
+    """Medicines changed after version ``since`` (and id ``after`` within it).
+
+    Returns ``version`` and ``after`` to ask from next, ``more`` while
+    there are further pages, ``fields``, the changed ``medicines`` as rows
+    of those fields and the ids ``deleted`` since.
+    """
+    current, pruned = _counter()
+    if since and since < pruned:
+        raise ResyncRequired(f'Changes up to version {pruned} are no longer kept; sync again from 0.')
+    version = Medicine.change_version
+    # Versions above the counter read first belong to commits after it; the next pull gets them
+    query = (select(*[getattr(Medicine, name) for name in FIELDS], version)
+             .where(version <= current)
+             .order_by(version, Medicine.id)
+             .limit(limit + 1))
+    if after is not None:
+        query = query.where(or_(version > since, and_(version == since, Medicine.id > after)))
+    elif since:
+        query = query.where(version > since)
+    rows = db.session.execute(query).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    until = rows[-1].change_version if more else current
+
+    deleted = []
+    if since or after is not None:
+        # A full list (since=0) has nothing to delete from
+        deleted = db.session.scalars(
+            select(MedicineTombstone.medicine_id)
+            .where(MedicineTombstone.change_version > since, MedicineTombstone.change_version <= until)
+            .order_by(MedicineTombstone.change_version, MedicineTombstone.id)
+        ).all()
+    return dict(version=until,
+                after=rows[-1].id if more else None,
+                more=more,
+                fields=list(FIELDS),
+                medicines=[list(row[:len(FIELDS)]) for row in rows],
+                deleted=deleted)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _tombstones(session, flush_context, instances):
+    # Inserted before the flush deletes the medicines; the version comes from the column default
+    for obj in session.deleted:
+        if isinstance(obj, Medicine):
+            session.add(MedicineTombstone(medicine_id=obj.id, branch_id=obj.branch_id))
+
+
+def prune_tombstones(before):
+    """Drop tombstones of medicines deleted before ``before``; returns how many."""
+    through = db.session.execute(select(func.max(MedicineTombstone.change_version))
+                                 .where(MedicineTombstone.deleted_at < before)).scalar()
+    if through is None:
+        return 0
+    pruned = db.session.execute(delete(MedicineTombstone.__table__)
+                                .where(MedicineTombstone.change_version <= through)).rowcount
+    counter = ChangeCounter.__table__
+    db.session.execute(update(counter).where(counter.c.id == 1, counter.c.pruned_through < through)
+                       .values(pruned_through=through))
+    return pruned
+
+
+# ==================== PUSH ====================
+
+def _sold_at(value, now):
+    if not value:
+        return now
+    sold_at = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if sold_at.tzinfo is not None:
+        sold_at = sold_at.astimezone(timezone.utc).replace(tzinfo=None)
+    # A terminal clock running ahead does not date sales in the future
+    return min(sold_at, now)
+
+
+def parse_sale(data, now=None):
+    """An ``OfflineSale`` from a pushed JSON object; ``ValueError`` when malformed.
+
+    ``{"client_id": "...", "created_at": "<ISO 8601>", "customer_name": "...",
+    "lines": [{"medicine_id": 1, "quantity": 2, "unit_price": 4.5}, ...]}``;
+    ``created_at`` (UTC unless it has an offset) and ``unit_price`` are
+    optional.
+    """
+    now = now or datetime.utcnow()
+    if not isinstance(data, dict):
+        raise ValueError('Each sale must be an object.')
+    client_id = data.get('client_id')
+    if not isinstance(client_id, str) or not 0 < len(client_id) <= MAX_CLIENT_ID:
+        raise ValueError(f'client_id must be a string of 1 to {MAX_CLIENT_ID} characters.')
+    try:
+        lines = [Line(int(line['medicine_id']), int(line['quantity']),
+                      None if line.get('unit_price') is None else float(line['unit_price']))
+                 for line in data['lines']]
+        sold_at = _sold_at(data.get('created_at'), now)
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('Expected "lines": [{"medicine_id": ..., "quantity": ...}, ...] '
+                         'and an ISO 8601 "created_at".')
+    if not lines:
+        raise ValueError('Nothing to sell.')
+    if any(line.quantity <= 0 for line in lines):
+        raise ValueError('Quantity must be at least 1.')
+    if any(line.unit_price is not None and line.unit_price < 0 for line in lines):
+        raise ValueError('unit_price cannot be negative.')
+    return OfflineSale(client_id, sold_at, data.get('customer_name'), lines)
+
+
+def _record(sale, on_hand):
+    """Write one offline sale against ``on_hand`` (``{id: [name, quantity, price]}``, updated)."""
+    missing = sorted({line.medicine_id for line in sale.lines} - set(on_hand))
+    if missing:
+        return dict(status='rejected', error=f'Medicine {", ".join(str(i) for i in missing)} not found.')
+
+    wanted = {}
+    for line in sale.lines:
+        wanted[line.medicine_id] = wanted.get(line.medicine_id, 0) + line.quantity
+    taken = {medicine_id: min(quantity, max(on_hand[medicine_id][1], 0))
+             for medicine_id, quantity in wanted.items()}
+
+    order = SalesOrder(client_id=sale.client_id, customer_name=sale.customer_name, created_at=sale.sold_at)
+    db.session.add(order)
+    db.session.flush()
+    if any(taken.values()):
+        stock.take({medicine_id: quantity for medicine_id, quantity in taken.items() if quantity},
+                   reference=f'sales_order:{order.id}')
+
+    conflicts = []
+    for line in sale.lines:
+        price = on_hand[line.medicine_id][2]
+        charged = price if line.unit_price is None else line.unit_price
+        if charged != price:
+            conflicts.append(dict(type='price', medicine_id=line.medicine_id, charged=charged, price=price))
+        order.lines.append(Sale(medicine_id=line.medicine_id,
+                                quantity=line.quantity,
+                                unit_price=charged,
+                                total_amount=line.quantity * charged,
+                                sale_date=sale.sold_at,
+                                customer_name=sale.customer_name))
+    order.total_amount = sum(line.total_amount for line in order.lines)
+    order.item_count = sum(line.quantity for line in order.lines)
+    db.session.flush()
+
+    for medicine_id, quantity in wanted.items():
+        on_hand[medicine_id][1] -= taken[medicine_id]
+        if taken[medicine_id] < quantity:
+            short = quantity - taken[medicine_id]
+            conflicts.append(dict(type='short', medicine_id=medicine_id, requested=quantity,
+                                  taken=taken[medicine_id], short=short))
+            current_app.logger.warning('Offline sale %s (order %d) sold %d more of %s than were in stock',
+                                       sale.client_id, order.id, short, on_hand[medicine_id][0])
+    return dict(status='created', order_id=order.id, total_amount=order.total_amount, conflicts=conflicts)
+
+
+def push(sales):
+    """Record ``OfflineSale``s not seen before, in the caller's transaction.
+
+    Returns one result per sale, in order: ``created`` (with the order id
+    and any ``conflicts``), ``duplicate`` (the order recorded earlier) or
+    ``rejected`` (a medicine that no longer exists).
+    """
+    if not sales:
+        return []
+    # Taken first: other stock writers now wait for this commit (module docstring)
+    change_version(db.session.connection())
+    client_ids = [sale.client_id for sale in sales]
+    seen = dict(db.session.execute(select(SalesOrder.client_id, SalesOrder.id)
+                                   .where(SalesOrder.client_id.in_(client_ids))).all())
+    medicine_ids = {line.medicine_id for sale in sales if sale.client_id not in seen for line in sale.lines}
+    on_hand = {row.id: [row.name, row.quantity or 0, row.price] for row in db.session.execute(
+        select(Medicine.id, Medicine.name, Medicine.quantity, Medicine.price)
+        .where(Medicine.id.in_(medicine_ids)).with_for_update()
+    )} if medicine_ids else {}
+
+    results = []
+    for sale in sales:
+        if sale.client_id in seen:
+            results.append(dict(status='duplicate', order_id=seen[sale.client_id]))
+            continue
+        result = _record(sale, on_hand)
+        if result['status'] == 'created':
+            seen[sale.client_id] = result['order_id']
+        results.append(result)
+    return [dict(client_id=sale.client_id, **result) for sale, result in zip(sales, results)]
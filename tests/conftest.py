@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# app.py builds its app at import, so the database is chosen before any test imports it
+_directory = tempfile.mkdtemp(prefix='pharmasync-test-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_directory, 'test.db')
+os.environ['SCHEDULER_IN_PROCESS'] = '0'
+
+
+@pytest.fixture
+def app():
+    import app as appmod
+    from models import db
+
+    appmod.init_db()
+    with appmod.app.app_context():
+        yield appmod.app
+        db.session.remove()
+        db.drop_all()
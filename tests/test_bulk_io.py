@@ -0,0 +1,26 @@
+from models import db, ChangeCounter, Medicine
+import bulk_io
+import sync
+
+
+def test_reimported_export_gets_a_new_change_version(app):
+    result = bulk_io.import_records('medicines', [
+        (2, dict(name='Paracetamol', category='Tablet', quantity='10', price='2.5', batch_number='B1')),
+    ])
+    assert result.ok
+    exported = [row for rows in bulk_io.export_rows('medicines') for row in rows]
+
+    medicine = Medicine.query.filter_by(batch_number='B1').one()
+    medicine.quantity = 4
+    db.session.commit()
+    edited = medicine.change_version
+    before = db.session.get(ChangeCounter, 1).version
+
+    result = bulk_io.import_records('medicines', enumerate(exported, 2))
+    assert result.ok and result.updated == 1
+
+    medicine = Medicine.query.filter_by(batch_number='B1').one()
+    assert medicine.quantity == 10
+    assert medicine.change_version > edited
+    assert sync.changes(since=before)['medicines'] == [
+        [medicine.id, 'Paracetamol', 'B1', 2.5, 10, None]]
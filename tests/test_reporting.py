@@ -0,0 +1,19 @@
+from datetime import date, datetime
+
+from models import db, Medicine, Sale
+import reporting
+import spreadsheets
+
+
+def test_range_includes_the_last_second_of_the_day(app):
+    medicine = Medicine(name='Paracetamol', price=2.5, quantity=10)
+    db.session.add(medicine)
+    db.session.flush()
+    for stamp in (datetime(2026, 3, 1), datetime(2026, 3, 31, 23, 59, 59, 900000), datetime(2026, 4, 1)):
+        db.session.add(Sale(medicine_id=medicine.id, quantity=1, unit_price=2.5, total_amount=2.5, sale_date=stamp))
+    db.session.commit()
+
+    start, end = reporting.date_range(date(2026, 3, 1), date(2026, 3, 31))
+    assert reporting.sales_summary(start, end).count == 2
+    sheet = spreadsheets.sales_sheet(date(2026, 3, 1), date(2026, 3, 31))
+    assert len(db.session.execute(sheet.statement).all()) == 2
@@ -0,0 +1,76 @@
+"""The web pages, one blueprint per area of the app.
+
+* ``auth``: login, registration and logout
+* ``inventory``: the dashboard and the medicine pages
+* ``purchasing``: purchase orders, reorder drafts and suppliers
+* ``sales``: the sales list, the new-sale form and the POS API
+* ``reports``: the reports page and the PDF report jobs
+* ``transfer``: bulk import and export
+* ``live``: the Server-Sent Events stock feed (see events.py)
+
+Endpoints are named after their blueprint (``url_for('inventory.inventory')``).
+The JSON API is the separate ``api_v1`` blueprint in api.py.
+"""
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import abort, current_app, flash, redirect, request, session, url_for
+
+from listing import paginate_keyset
+import branches
+
+# ==================== DECORATORS ====================
+
+def login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            flash('Please log in to access this page.', 'error')
+            return redirect(url_for('auth.login'))
+        return f(*args, **kwargs)
+    return decorated_function
+
+def admin_required(f):
+    # Cross-branch pages and branch switching (inside login_required)
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('role') != branches.ADMIN_ROLE:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+# ==================== HELPERS ====================
+
+def report_dates(args=None):
+    # Report range from ?start_date=&end_date= (YYYY-MM-DD), defaulting to the last 30 days
+    args = request.args if args is None else args
+    start_date = args.get('start_date')
+    end_date = args.get('end_date')
+
+    if not start_date:
+        start_date = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    if not end_date:
+        end_date = datetime.now().strftime('%Y-%m-%d')
+
+    return (datetime.strptime(start_date, '%Y-%m-%d').date(),
+            datetime.strptime(end_date, '%Y-%m-%d').date())
+
+def paginate(query, keys):
+    # Cursor pagination for the list pages (?after=... / ?before=...)
+    return paginate_keyset(query, keys,
+                           after=request.args.get('after'),
+                           before=request.args.get('before'),
+                           per_page=current_app.config['LIST_PER_PAGE'])
+
+def utility_processor():
+    return dict(now=datetime.now())
+
+# ==================== REGISTRATION ====================
+
+def init_app(app):
+    """Register every page blueprint and the template globals."""
+    from views import auth, inventory, live, purchasing, reports, sales, transfer
+
+    app.context_processor(utility_processor)
+    for module in (auth, inventory, purchasing, sales, reports, transfer, live):
+        app.register_blueprint(module.bp)
@@ -0,0 +1,122 @@
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Branch, User
+from views import admin_required, login_required
+import security
+
+bp = Blueprint('auth', __name__)
+
+def enter_branch(branch_id, branch_name):
+    # Every query of the session's later requests is scoped to it (branches.py)
+    session['branch_id'] = branch_id
+    session['branch_name'] = branch_name
+
+def busy(template):
+    flash('Too many sign-ins at once. Please try again in a moment.', 'error')
+    return render_template(template), 503, {'Retry-After': '1'}
+
+@bp.route('/')
+def index():
+    if 'user_id' in session:
+        return redirect(url_for('inventory.dashboard'))
+    return redirect(url_for('auth.login'))
+
+@bp.route('/login', methods=['GET', 'POST'])
+def login():
+    if 'user_id' in session:
+        return redirect(url_for('inventory.dashboard'))
+
+    if request.method == 'POST':
+        email = request.form.get('email')
+        password = request.form.get('password')
+        remember = request.form.get('remember')
+
+        wait = security.throttle(email)
+        if wait:
+            flash(f'Too many login attempts. Please wait {wait} seconds.', 'error')
+            return render_template('login.html'), 429, {'Retry-After': str(wait)}
+
+        # The user and their branch in one query; the hash is checked off the request thread
+        user = db.session.execute(
+            select(User.id, User.username, User.email, User.role, User.password,
+                   Branch.id.label('branch_id'), Branch.name.label('branch_name'))
+            .join(Branch, Branch.id == User.branch_id)
+            .where(User.email == email)
+        ).first()
+        try:
+            matches, new_hash = security.verify(user.password if user else None, password)
+        except security.Busy:
+            return busy('login.html')
+
+        if matches:
+            if new_hash:
+                # Hashed with older parameters; the password is at hand to upgrade it
+                db.session.execute(update(User).where(User.id == user.id, User.password == user.password)
+                                   .values(password=new_hash))
+                db.session.commit()
+            session['user_id'] = user.id
+            session['username'] = user.username
+            session['email'] = user.email
+            session['role'] = user.role
+            enter_branch(user.branch_id, user.branch_name)
+            if remember:
+                session.permanent = True
+            flash('Login successful!', 'success')
+            return redirect(url_for('inventory.dashboard'))
+        else:
+            flash('Invalid email or password', 'error')
+
+    return render_template('login.html')
+
+@bp.route('/register', methods=['GET', 'POST'])
+def register():
+    if 'user_id' in session:
+        return redirect(url_for('inventory.dashboard'))
+
+    if request.method == 'POST':
+        username = request.form.get('username')
+        email = request.form.get('email')
+        password = request.form.get('password')
+
+        try:
+            hashed_password = security.hash_password(password)
+        except security.Busy:
+            return busy('register.html')
+        new_user = User(username=username, email=email, password=hashed_password)
+
+        # The unique constraints decide; which one only matters when one fails
+        db.session.add(new_user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if User.query.filter_by(username=username).first():
+                flash('Username already exists!', 'error')
+            else:
+                flash('Email already registered!', 'error')
+            return render_template('register.html')
+
+        flash('Registration successful! Please log in.', 'success')
+        return redirect(url_for('auth.login'))
+
+    return render_template('register.html')
+
+@bp.route('/logout')
+def logout():
+    session.clear()
+    flash('You have been logged out successfully.', 'success')
+    return redirect(url_for('auth.login'))
+
+@bp.route('/branch', methods=['POST'])
+@login_required
+@admin_required
+def switch_branch():
+    branch = db.session.get(Branch, request.form.get('branch_id', type=int))
+    if branch is None:
+        flash('No such branch.', 'error')
+    else:
+        enter_branch(branch.id, branch.name)
+        flash(f'Now working in {branch.name}.', 'success')
+    return redirect(url_for('inventory.dashboard'))
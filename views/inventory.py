@@ -0,0 +1,210 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from sqlalchemy.orm import load_only
+from datetime import datetime, timedelta
+
+from models import db, Medicine, PurchaseOrder, Sale, StockBatch
+from views import login_required, paginate
+import batches
+import cache
+import dbconfig
+import events
+import filters
+import ledger
+import stats as dashboard_stats
+import search as medicine_search
+
+bp = Blueprint('inventory', __name__)
+
+@bp.route('/dashboard')
+@login_required
+@dbconfig.replica_reads
+def dashboard():
+    # Counters are maintained incrementally by stats.py (one row read)
+    stats = dashboard_stats.current()
+
+    # Last 7 days of sales from the per-day revenue buckets
+    today = datetime.now().date()
+    last_7_days = dashboard_stats.recent_days(7, today)
+
+    # Get low stock medicines (partial index holds only low-stock rows)
+    low_stock_medicines = Medicine.query.filter(
+        Medicine.quantity <= Medicine.reorder_level
+    ).order_by(Medicine.quantity).limit(5).all()
+
+    # Get batches expiring soon (next 30 days) from the in-stock expiry index
+    expiring_soon = db.session.query(
+        Medicine.name, StockBatch.batch_number, StockBatch.expiry_date, StockBatch.quantity
+    ).join(StockBatch.medicine).filter(
+        StockBatch.quantity > 0,
+        StockBatch.expiry_date.between(today, today + timedelta(days=30))
+    ).order_by(StockBatch.expiry_date).limit(5).all()
+
+    return render_template('dashboard.html',
+                         total_medicines=stats.total_medicines,
+                         low_stock_count=stats.low_stock_count,
+                         expired_count=stats.expired_count,
+                         expiry_sweep=stats if stats.expiry_swept_on == today else None,
+                         monthly_revenue=stats.monthly_revenue,
+                         low_stock_medicines=low_stock_medicines,
+                         expiring_soon=expiring_soon,
+                         categories=dashboard_stats.categories(stats),
+                         last_7_days=last_7_days)
+
+@bp.route('/inventory')
+@login_required
+@dbconfig.replica_reads
+@cache.cached_page('medicine')
+def inventory():
+    # Get filter parameters
+    search = request.args.get('search', '')
+    category = request.args.get('category', '')
+    stock_status = request.args.get('stock', '')
+    sort, keys = filters.medicine_sort(request.args)
+
+    # Build query (only the columns the table shows)
+    query = Medicine.query.options(load_only(
+        Medicine.name, Medicine.manufacturer, Medicine.category,
+        Medicine.quantity, Medicine.price, Medicine.expiry_date
+    )).filter(*filters.medicine_conditions(search, category, stock_status))
+
+    # Apply sorting (id breaks ties so the cursor is unambiguous)
+    medicines = paginate(query, keys)
+
+    # Get all categories for filter
+    categories = cache.remember('medicine-categories', ('medicine',), (), lambda: [
+        c[0] for c in db.session.query(Medicine.category).distinct().all() if c[0]
+    ])
+
+    return render_template('inventory.html',
+                         medicines=medicines,
+                         categories=categories,
+                         search=search,
+                         selected_category=category,
+                         stock_status=stock_status,
+                         sort=sort)
+
+@bp.route('/medicine/autocomplete')
+@login_required
+def medicine_autocomplete():
+    term = request.args.get('q', '')
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify(medicine_search.autocomplete(term, limit=limit))
+
+@bp.route('/medicine/<int:id>')
+@login_required
+@cache.cached_page('medicine', 'purchase_order', 'sale', 'stock_batch', 'stock_movement')
+def medicine_details(id):
+    medicine = Medicine.query.get_or_404(id)
+
+    # Get recent purchase orders for this medicine
+    recent_purchases = PurchaseOrder.query.filter_by(medicine_id=id).order_by(
+        PurchaseOrder.order_date.desc()
+    ).limit(5).all()
+
+    # Get recent sales for this medicine
+    recent_sales = Sale.query.filter_by(medicine_id=id).order_by(
+        Sale.sale_date.desc()
+    ).limit(5).all()
+
+    # Batches on the shelf, in the order sales take them
+    stock_batches = StockBatch.query.filter(
+        StockBatch.medicine_id == id, StockBatch.quantity > 0
+    ).order_by(*batches.FEFO_ORDER).all()
+
+    return render_template('medicine_details.html',
+                         medicine=medicine,
+                         recent_purchases=recent_purchases,
+                         recent_sales=recent_sales,
+                         stock_batches=stock_batches,
+                         stock_movements=ledger.history(db.session, id, since=medicine.created_at))
+
+@bp.route('/medicine/add', methods=['GET', 'POST'])
+@login_required
+def add_medicine():
+    if request.method == 'POST':
+        try:
+            expiry_date = datetime.strptime(request.form.get('expiry_date'), '%Y-%m-%d').date() if request.form.get('expiry_date') else None
+
+            medicine = Medicine(
+                name=request.form.get('name'),
+                generic_name=request.form.get('generic_name'),
+                category=request.form.get('category'),
+                manufacturer=request.form.get('manufacturer'),
+                quantity=int(request.form.get('quantity', 0)),
+                price=float(request.form.get('price')),
+                expiry_date=expiry_date,
+                batch_number=request.form.get('batch_number'),
+                description=request.form.get('description'),
+                location=request.form.get('location'),
+                reorder_level=int(request.form.get('reorder_level', 10))
+            )
+
+            db.session.add(medicine)
+            db.session.flush()
+            # Opening stock becomes the medicine's first batch
+            conn = db.session.connection()
+            batches.reconcile(conn, [medicine.id])
+            ledger.record(conn, ledger.OPENING, [(medicine.id, medicine.quantity, medicine.quantity)])
+            db.session.commit()
+
+            flash('Medicine added successfully!', 'success')
+            return redirect(url_for('inventory.inventory')) # Goes back to list after saving
+        except Exception as e:
+            flash(f'Error: {str(e)}', 'error')
+
+    return render_template('add_medicine.html')
+
+@bp.route('/medicine/<int:id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_medicine(id):
+    medicine = Medicine.query.get_or_404(id)
+
+    if request.method == 'POST':
+        try:
+            before = medicine.quantity
+            medicine.name = request.form.get('name')
+            medicine.generic_name = request.form.get('generic_name')
+            medicine.category = request.form.get('category')
+            medicine.manufacturer = request.form.get('manufacturer')
+            medicine.quantity = int(request.form.get('quantity', 0))
+            medicine.price = float(request.form.get('price'))
+            medicine.batch_number = request.form.get('batch_number')
+            medicine.description = request.form.get('description')
+            medicine.location = request.form.get('location')
+            medicine.reorder_level = int(request.form.get('reorder_level', 10))
+
+            if request.form.get('expiry_date'):
+                medicine.expiry_date = datetime.strptime(request.form.get('expiry_date'), '%Y-%m-%d').date()
+
+            medicine.updated_at = datetime.utcnow()
+            db.session.flush()
+            # A single batch is corrected in place; quantity changes are stock
+            # adjustments against the batches (see batches.reconcile)
+            conn = db.session.connection()
+            batches.relabel(conn, id, medicine.batch_number, medicine.expiry_date)
+            batches.reconcile(conn, [id])
+            delta = medicine.quantity - (before or 0)
+            ledger.record(conn, ledger.ADJUSTMENT, [(id, delta, medicine.quantity)])
+            events.stock_changed(id, medicine.quantity, delta, medicine.reorder_level)
+            db.session.commit()
+
+            flash('Medicine updated successfully!', 'success')
+            return redirect(url_for('inventory.medicine_details', id=id))
+        except Exception as e:
+            flash(f'Error updating medicine: {str(e)}', 'error')
+
+    return render_template('edit_medicine.html', medicine=medicine)
+
+@bp.route('/medicine/<int:id>/delete', methods=['POST'])
+@login_required
+def delete_medicine(id):
+    medicine = Medicine.query.get_or_404(id)
+    try:
+        # The ledger keeps the medicine's history; its last movement empties it
+        ledger.record(db.session.connection(), ledger.REMOVAL, [(id, -(medicine.quantity or 0), 0)])
+        db.session.delete(medicine)
+        db.session.commit()
+        flash('Medicine deleted successfully!', 'success')
+    except Exception as e:
+        flash(f'Error deleting medicine: {str(e)}', 'error')
+    return redirect(url_for('inventory.inventory'))
@@ -0,0 +1,24 @@
+from flask import Blueprint, request, current_app, Response, abort
+
+from views import login_required
+import branches
+import events
+
+bp = Blueprint('live', __name__)
+
+@bp.route('/live/stock')
+@login_required
+def stock_feed():
+    # Server-Sent Events; holds no database connection while it waits (see events.py)
+    broker = events.broker()
+    if broker is None:
+        abort(404)
+    # An id from another worker or before a restart picks up from here instead of reloading the page
+    after = broker.resume(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    config = current_app.config
+    response = Response(events.stream(broker, after, config['EVENTS_HEARTBEAT'], config['EVENTS_STREAM_SECONDS'],
+                                      branches.current()),
+                        mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx passes events through unbuffered
+    return response
@@ -0,0 +1,159 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort
+from sqlalchemy.orm import joinedload, load_only
+from datetime import datetime
+
+from listing import SortKey
+from models import db, Medicine, Supplier, PurchaseOrder
+from views import login_required, paginate
+import cache
+import reorder
+import stock
+
+bp = Blueprint('purchasing', __name__)
+
+@bp.route('/purchase-orders')
+@login_required
+def purchase_orders():
+    status_filter = request.args.get('status', '')
+
+    query = PurchaseOrder.query
+
+    if status_filter and status_filter != 'all':
+        query = query.filter(PurchaseOrder.status == status_filter)
+
+    query = query.options(
+        load_only(PurchaseOrder.quantity, PurchaseOrder.total_amount,
+                  PurchaseOrder.status, PurchaseOrder.order_date),
+        joinedload(PurchaseOrder.supplier).load_only(Supplier.name),
+        joinedload(PurchaseOrder.medicine).load_only(Medicine.name, Medicine.category)
+    )
+    orders = paginate(query, [SortKey(PurchaseOrder.order_date, descending=True),
+                              SortKey(PurchaseOrder.id, descending=True)])
+
+    # The form dropdowns only need id and name
+    suppliers = db.session.query(Supplier.id, Supplier.name).order_by(Supplier.name).all()
+    medicines = db.session.query(Medicine.id, Medicine.name).order_by(Medicine.name).all()
+
+    return render_template('purchase_orders.html',
+                         orders=orders,
+                         suppliers=suppliers,
+                         medicines=medicines,
+                         status_filter=status_filter)
+
+@bp.route('/purchase-order/add', methods=['POST'])
+@login_required
+def add_purchase_order():
+    # Looked up through the branch-scoped queries: another branch's ids are not found
+    supplier = Supplier.query.filter_by(id=request.form.get('supplier_id', type=int)).first_or_404()
+    medicine = Medicine.query.filter_by(id=request.form.get('medicine_id', type=int)).first_or_404()
+    try:
+        quantity = int(request.form.get('quantity'))
+        unit_price = float(request.form.get('unit_price'))
+        total_amount = quantity * unit_price
+
+        order = PurchaseOrder(
+            supplier_id=supplier.id,
+            medicine_id=medicine.id,
+            quantity=quantity,
+            unit_price=unit_price,
+            total_amount=total_amount,
+            notes=request.form.get('notes')
+        )
+
+        db.session.add(order)
+        db.session.commit()
+
+        flash('Purchase order created successfully!', 'success')
+    except Exception as e:
+        flash(f'Error creating purchase order: {str(e)}', 'error')
+
+    return redirect(url_for('purchasing.purchase_orders'))
+
+@bp.route('/purchase-order/<int:id>/complete', methods=['POST'])
+@login_required
+def complete_purchase_order(id):
+    try:
+        # Status change and stock increment are both conditional single statements
+        expiry = request.form.get('expiry_date')
+        completed = stock.with_retry(lambda: stock.receive(
+            id, request.form.get('batch_number') or None,
+            datetime.strptime(expiry, '%Y-%m-%d').date() if expiry else None))
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error completing purchase order: {str(e)}', 'error')
+        return redirect(url_for('purchasing.purchase_orders'))
+
+    if completed:
+        flash('Purchase order completed and stock updated!', 'success')
+    elif db.session.get(PurchaseOrder, id) is None:
+        abort(404)
+    else:
+        flash('Purchase order is no longer pending.', 'error')
+    return redirect(url_for('purchasing.purchase_orders'))
+
+@bp.route('/purchase-order/<int:id>/approve', methods=['POST'])
+@login_required
+def approve_purchase_order(id):
+    if stock.with_retry(lambda: reorder.approve(id)):
+        flash('Draft approved; the purchase order is now pending.', 'success')
+    elif db.session.get(PurchaseOrder, id) is None:
+        abort(404)
+    else:
+        flash('Purchase order is not a draft.', 'error')
+    return redirect(url_for('purchasing.purchase_orders', status='draft'))
+
+@bp.route('/purchase-orders/reorder', methods=['POST'])
+@login_required
+def run_reorder():
+    result = reorder.run()
+    message = f'{result.orders_created} draft order(s) created from {result.checked} medicines.'
+    if result.no_supplier:
+        message += f' {len(result.no_supplier)} medicine(s) need stock but have no supplier on record.'
+    flash(message, 'success')
+    return redirect(url_for('purchasing.purchase_orders', status='draft'))
+
+@bp.route('/purchase-order/<int:id>/cancel', methods=['POST'])
+@login_required
+def cancel_purchase_order(id):
+    order = PurchaseOrder.query.get_or_404(id)
+
+    try:
+        order.status = 'cancelled'
+        db.session.commit()
+        flash('Purchase order cancelled!', 'success')
+    except Exception as e:
+        flash(f'Error cancelling purchase order: {str(e)}', 'error')
+
+    return redirect(url_for('purchasing.purchase_orders'))
+
+@bp.route('/suppliers')
+@login_required
+@cache.cached_page('supplier')
+def suppliers():
+    suppliers = Supplier.query.all()
+    return render_template('suppliers.html', suppliers=suppliers)
+
+@bp.route('/suppliers/add', methods=['GET', 'POST'])
+@login_required
+def add_supplier():
+    if request.method == 'POST':
+        name = request.form.get('name')
+        contact = request.form.get('contact_person')
+        phone = request.form.get('phone')
+        email = request.form.get('email')
+        address = request.form.get('address')
+
+        new_supplier = Supplier(
+            name=name,
+            contact_person=contact,
+            phone=phone,
+            email=email,
+            address=address
+        )
+
+        db.session.add(new_supplier)
+        db.session.commit()
+        flash('Supplier added successfully!', 'success')
+        return redirect(url_for('purchasing.suppliers'))
+
+    return render_template('add_supplier.html')
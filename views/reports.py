@@ -0,0 +1,138 @@
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file, abort,
+                   current_app, Response, stream_with_context)
+import os
+
+from models import ReportJob
+from views import admin_required, login_required, report_dates
+import analytics
+import cache
+import dbconfig
+import report_jobs
+import reporting
+import spreadsheets
+
+bp = Blueprint('reports', __name__)
+
+@bp.route('/reports')
+@login_required
+@dbconfig.replica_reads
+@cache.cached_page('medicine', 'sale', 'purchase_order')
+def reports():
+    start_date, end_date = report_dates()
+    start, end = reporting.date_range(start_date, end_date)
+
+    grain = request.args.get('grain', 'day')
+    if grain not in reporting.GRAINS:
+        grain = 'day'
+
+    # All totals are aggregated in SQL; Python only formats one row per group
+    def figures():
+        sales = reporting.sales_summary(start, end)
+        stock = reporting.stock_summary()
+        return dict(total_sales=sales.revenue,
+                    sales_count=sales.count,
+                    top_medicines=[tuple(r) for r in reporting.top_medicines(start, end)],
+                    stock_value=stock.value,
+                    revenue_by_period=[tuple(r) for r in reporting.revenue_by_period(start, end, grain)],
+                    category_sales=[tuple(r) for r in reporting.revenue_by_category(start, end)],
+                    category_stock=[tuple(r) for r in reporting.stock_by_category()],
+                    margin=reporting.margin(start, end),
+                    turnover=reporting.turnover(sales, stock, (end_date - start_date).days + 1))
+
+    # Forecast from closed days, whatever the range; cached for the day
+    forecast_days, forecast = analytics.outlook()
+
+    return render_template('reports.html',
+                           forecast_days=forecast_days,
+                           forecast=forecast,
+                           analytics_history_days=analytics.HISTORY_DAYS,
+                           start_date=start_date.strftime('%Y-%m-%d'),
+                           end_date=end_date.strftime('%Y-%m-%d'),
+                           grain=grain,
+                           grains=reporting.GRAINS,
+                           **cache.remember('reports', ('medicine', 'sale', 'purchase_order'),
+                                            (start, end, grain), figures))
+
+@bp.route('/reports/branches')
+@login_required
+@admin_required
+@cache.cached_page('branch', 'medicine', 'sale', 'purchase_order')
+def branch_rollup():
+    start_date, end_date = report_dates()
+    start, end = reporting.date_range(start_date, end_date)
+    # One grouped query per figure, whatever the number of branches
+    return render_template('branch_rollup.html',
+                           start_date=start_date.strftime('%Y-%m-%d'),
+                           end_date=end_date.strftime('%Y-%m-%d'),
+                           rows=reporting.branch_rollup(start, end))
+
+@bp.route('/reports/export/<any(sales, purchases, stock, report):dataset>.<any(csv, xlsx):fmt>')
+@login_required
+@dbconfig.replica_reads
+def export_report(dataset, fmt):
+    start_date, end_date = report_dates()
+    # 'report' is every sheet in one workbook; a CSV holds only one
+    if dataset == 'report' and fmt == 'csv':
+        abort(404)
+    try:
+        sheets = [spreadsheets.sheet(name, start_date, end_date)
+                  for name in (spreadsheets.DATASETS if dataset == 'report' else (dataset,))]
+    except LookupError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('reports.reports', start_date=start_date, end_date=end_date))
+
+    # Streamed a batch of rows at a time, straight from the cursor
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    if fmt == 'csv':
+        chunks = spreadsheets.csv_chunks(sheets[0], batch_size)
+    else:
+        chunks = spreadsheets.xlsx_chunks(sheets, batch_size)
+    response = Response(stream_with_context(chunks), mimetype=spreadsheets.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename=PharmaSync_{dataset.title()}_{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}.{fmt}'
+    )
+    return response
+
+@bp.route('/reports/download')
+@login_required
+def download_report():
+    start_date, end_date = report_dates()
+
+    # Rendered by the background pool; a finished, still-current file is reused
+    job = report_jobs.submit(start_date, end_date)
+    if job.status == 'done':
+        return send_report(job)
+    return render_template('report_job.html', job=job)
+
+@bp.route('/reports/jobs', methods=['POST'])
+@login_required
+def create_report_job():
+    start_date, end_date = report_dates(request.form)
+    job = report_jobs.submit(start_date, end_date)
+    return jsonify(report_job_json(job)), 200 if job.status == 'done' else 202
+
+@bp.route('/reports/jobs/<job_id>')
+@login_required
+def report_job_status(job_id):
+    job = ReportJob.query.get_or_404(job_id)
+    return jsonify(report_job_json(job))
+
+@bp.route('/reports/jobs/<job_id>/download')
+@login_required
+def download_report_job(job_id):
+    job = ReportJob.query.get_or_404(job_id)
+    if job.status != 'done':
+        return jsonify(report_job_json(job)), 409
+    return send_report(job)
+
+def report_job_json(job):
+    data = report_jobs.to_dict(job)
+    data['status_url'] = url_for('reports.report_job_status', job_id=job.id)
+    data['download_url'] = url_for('reports.download_report_job', job_id=job.id)
+    return data
+
+def send_report(job):
+    if not job.file_path or not os.path.exists(job.file_path):
+        abort(404)
+    return send_file(job.file_path, mimetype='application/pdf', as_attachment=True,
+                     download_name=f'PharmaSync_Report_{job.start_date:%Y-%m-%d}.pdf')
@@ -0,0 +1,93 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
+from sqlalchemy.orm import joinedload, load_only
+
+from listing import SortKey
+from models import db, Medicine, Sale, SalesOrder
+from views import login_required, paginate
+import stock
+
+bp = Blueprint('sales', __name__)
+
+@bp.route('/sales')
+@login_required
+def sales_orders():
+    # Fetch one page of sales joined with medicine names
+    query = Sale.query.options(
+        load_only(Sale.sale_date, Sale.order_id, Sale.quantity, Sale.unit_price, Sale.total_amount),
+        joinedload(Sale.medicine).load_only(Medicine.name)
+    )
+    sales = paginate(query, [SortKey(Sale.sale_date, descending=True),
+                             SortKey(Sale.id, descending=True)])
+    return render_template('sales_orders.html', sales=sales)
+
+@bp.route('/sales/new', methods=['GET', 'POST'])
+@login_required
+def new_sales_order():
+    if request.method == 'POST':
+        try:
+            lines = [(int(med_id), int(qty)) for med_id, qty in zip(request.form.getlist('medicine_id'),
+                                                                    request.form.getlist('quantity'))
+                     if med_id and qty]
+
+            # All lines are checked and deducted in one UPDATE, in one transaction
+            order = stock.with_retry(lambda: stock.sell_order(lines, request.form.get('customer_name')))
+
+            flash(f'Sales order #{order.id} completed: {len(lines)} item(s), ₹{order.total_amount:,.2f}. Revenue updated.', 'success')
+            return redirect(url_for('sales.sales_orders'))
+
+        except stock.OutOfStock as e:
+            db.session.rollback()
+            flash(str(e), 'error')
+            return redirect(url_for('sales.new_sales_order'))
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error processing order: {str(e)}', 'error')
+
+    # GET: Show the form to create an order
+    # In-stock rows come from the quantity index; sorting the few columns here avoids a table scan
+    medicines = db.session.query(Medicine.id, Medicine.name, Medicine.price, Medicine.quantity)\
+        .filter(Medicine.quantity > 0).all()
+    return render_template('add_sales_order.html', medicines=sorted(medicines, key=lambda m: m.name))
+
+# ==================== POS API ====================
+
+def sales_order_json(order):
+    return dict(id=order.id,
+                customer_name=order.customer_name,
+                created_at=order.created_at.isoformat(),
+                total_amount=order.total_amount,
+                item_count=order.item_count,
+                lines=[dict(medicine_id=line.medicine_id,
+                            quantity=line.quantity,
+                            unit_price=line.unit_price,
+                            total_amount=line.total_amount) for line in order.lines])
+
+@bp.route('/api/sales-orders', methods=['POST'])
+@login_required
+def api_create_sales_order():
+    # {"customer_name": "...", "lines": [{"medicine_id": 1, "quantity": 2}, ...]}
+    data = request.get_json(silent=True) or {}
+    try:
+        lines = [(int(line['medicine_id']), int(line['quantity'])) for line in data['lines']]
+    except (KeyError, TypeError, ValueError):
+        return jsonify(error='Expected {"lines": [{"medicine_id": ..., "quantity": ...}, ...]}'), 400
+    try:
+        order = stock.with_retry(lambda: stock.sell_order(lines, data.get('customer_name')))
+    except stock.OutOfStock as e:
+        db.session.rollback()
+        return jsonify(error='insufficient_stock', shortages=e.to_dict()), 409
+    except LookupError as e:
+        db.session.rollback()
+        return jsonify(error=str(e)), 422
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify(error=str(e)), 400
+    response = jsonify(sales_order_json(order))
+    response.headers['Location'] = url_for('sales.api_sales_order', order_id=order.id)
+    return response, 201
+
+@bp.route('/api/sales-orders/<int:order_id>')
+@login_required
+def api_sales_order(order_id):
+    order = SalesOrder.query.options(joinedload(SalesOrder.lines)).get_or_404(order_id)
+    return jsonify(sales_order_json(order))
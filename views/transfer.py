@@ -0,0 +1,37 @@
+from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app, Response, stream_with_context
+from datetime import datetime
+import io
+
+from views import login_required
+import bulk_io
+
+bp = Blueprint('transfer', __name__)
+
+@bp.route('/import', methods=['GET', 'POST'])
+@login_required
+def bulk_import():
+    result = None
+    if request.method == 'POST':
+        entity = request.form.get('entity')
+        upload = request.files.get('file')
+        if entity not in bulk_io.ENTITIES or not upload or not upload.filename:
+            flash('Choose what to import and a file.', 'error')
+            return redirect(url_for('transfer.bulk_import'))
+        fmt = bulk_io.detect_format(upload.filename)
+        # The upload is already spooled to disk by werkzeug; read it as text, row by row
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        result = bulk_io.import_file(entity, stream, fmt, current_app.config['IMPORT_BATCH_SIZE'])
+        if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+            return jsonify(result.to_dict()), 200 if result.ok else 422
+    return render_template('import.html', result=result,
+                           entities=bulk_io.ENTITIES, formats=bulk_io.FORMATS)
+
+@bp.route('/export/<any(medicines, suppliers, sales):entity>.<any(csv, json, ndjson):fmt>')
+@login_required
+def bulk_export(entity, fmt):
+    chunks = bulk_io.export_chunks(entity, fmt, current_app.config['IMPORT_BATCH_SIZE'])
+    response = Response(stream_with_context(chunks), mimetype=bulk_io.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename=pharmasync_{entity}_{datetime.now():%Y%m%d}.{fmt}'
+    )
+    return response